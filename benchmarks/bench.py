@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""
+bench: Time the hot stages of pymesh in isolation on synthetic packings.
+
+    python benchmarks/bench.py run -o results.json
+    python benchmarks/bench.py run --scales 100 1000 --stages read_packing pack_info -o quick.json
+    python benchmarks/bench.py compare baseline.json results.json
+
+Stages that need gmsh are skipped if gmsh isn't available, and are limited
+to --max-gmsh-beads beads since OCC booleans on 10^5+ beads take hours.
+"""
+
+from pymesh import ConfigHandler, Logger, __version__
+from pymesh.packedBed import PackedBed
+from pymesh.container import Container
+from pymesh.log import peak_rss_mb
+
+from packings import lattice_packing, random_packing, write_xyzd
+
+from importlib.machinery import SourceFileLoader
+from importlib.util import spec_from_loader, module_from_spec
+from pathlib import Path
+from rich.console import Console
+from rich.table import Table
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+
+STAGES = [
+    'read_packing',
+    'get_bounds',
+    'pack_info',
+    'generate',
+    'stack_by_plane_cuts',
+    'set_mesh_fields',
+    'fragment',
+    'add_nodes_multi',
+    'write_fragments',
+]
+
+GMSH_STAGES = STAGES[3:]
+
+console = Console()
+
+def load_script(name):
+    """
+    Import one of the scripts in bin/ as a module
+    """
+    loader = SourceFileLoader(name.replace('-', '_'), str(ROOT / 'bin' / name))
+    module = module_from_spec(spec_from_loader(loader.name, loader))
+    ## Registered so that its functions can be pickled for multiprocessing
+    sys.modules[loader.name] = module
+    loader.exec_module(module)
+    return module
+
+def make_config(packing_file, nbeads, logger):
+    config = ConfigHandler(logger)
+    config.config = {
+        'packedbed': {
+            'packing_file': { 'filename': str(packing_file), 'dataformat': '<d' },
+            'nbeads': nbeads,
+        },
+        'mesh': {
+            'size': 0.5,
+            'size_method': 'field',
+            'field': {
+                'threshold': {
+                    'size_in': 0.2,
+                    'size_out': 0.4,
+                    'rad_min_factor': 0.4,
+                    'rad_max_factor': 0.6,
+                },
+            },
+        },
+    }
+    config.load()
+    return config
+
+def box_around(packedBed, margin=0.0):
+    b = packedBed.get_bounds()
+    return [
+        b['xmin'] - margin, b['ymin'] - margin, b['zmin'] - margin,
+        b['xdelta'] + 2 * margin, b['ydelta'] + 2 * margin, b['zdelta'] + 2 * margin,
+    ]
+
+def box_through(packedBed):
+    """ Box whose faces pass through the outermost bead centers: every boundary bead is cut. """
+    x, y, z = np.array([ (b.x, b.y, b.z) for b in packedBed.beads ]).T
+    return [ x.min(), y.min(), z.min(), np.ptp(x), np.ptp(y), np.ptp(z) ]
+
+class Bench:
+    """
+    Runs the benchmark stages for a single packing.
+
+    Every stage method sets up its own state, and returns the time taken
+    by the code under test only.
+    """
+
+    def __init__(self, packing_file, nbeads, logger):
+        self.packing_file = packing_file
+        self.nbeads = nbeads
+        self.logger = logger
+        self.config = make_config(packing_file, nbeads, logger)
+
+    def packed_bed(self):
+        return PackedBed(self.config, generate=False, logger=self.logger)
+
+    def gmsh_model(self):
+        import gmsh
+        if not gmsh.isInitialized():
+            gmsh.initialize()
+            gmsh.option.setNumber('General.Terminal', 0)
+        gmsh.clear()
+        gmsh.model.add('bench')
+        return gmsh
+
+    def read_packing(self):
+        packedBed = self.packed_bed()
+        start = time.perf_counter()
+        packedBed.read_packing()
+        return time.perf_counter() - start
+
+    def get_bounds(self):
+        packedBed = self.packed_bed()
+        start = time.perf_counter()
+        packedBed.updateBounds()
+        packedBed.get_bounds()
+        return time.perf_counter() - start
+
+    def pack_info(self):
+        pack_info = load_script('pack-info')
+        packedBed = self.packed_bed()
+        b = packedBed.get_bounds()
+        container = Container('cylinder', [0.0, 0.0, b['zmin'], 0.0, 0.0, b['zdelta'], b['R']], generate=False, logger=self.logger)
+        start = time.perf_counter()
+        pack_info.process(packedBed, container, npartype=10, nrad=4)
+        return time.perf_counter() - start
+
+    def generate(self):
+        self.gmsh_model()
+        packedBed = self.packed_bed()
+        start = time.perf_counter()
+        packedBed.generate()
+        return time.perf_counter() - start
+
+    def stack_by_plane_cuts(self):
+        self.gmsh_model()
+        packedBed = self.packed_bed()
+        container = Container('box', box_through(packedBed), logger=self.logger)
+        packedBed.generate()
+        start = time.perf_counter()
+        packedBed.stack_by_plane_cuts(container)
+        return time.perf_counter() - start
+
+    def set_mesh_fields(self):
+        self.gmsh_model()
+        packedBed = self.packed_bed()
+        packedBed.generate()
+        start = time.perf_counter()
+        packedBed.set_mesh_fields()
+        return time.perf_counter() - start
+
+    def fragment(self):
+        from pymesh.column import Column
+        self.gmsh_model()
+        packedBed = self.packed_bed()
+        container = Container('box', box_around(packedBed, packedBed.rmax), logger=self.logger)
+        packedBed.generate()
+        column = Column(container, packedBed, fragment=False, logger=self.logger)
+        start = time.perf_counter()
+        column.fragment(packedBed.dimTags, container.dimTags, removeObject=True, removeTool=True, cleanFragments=True)
+        return time.perf_counter() - start
+
+    def add_nodes_multi(self):
+        from pymesh.tools import store_mesh, add_nodes_multi, add_elements_multi
+        gmsh = self.gmsh_model()
+        packedBed = self.packed_bed()
+
+        gmsh.model.add('reference')
+        gmsh.model.occ.addSphere(0, 0, 0, 1)
+        gmsh.model.occ.synchronize()
+        gmsh.model.mesh.setSize(gmsh.model.getEntities(0), 0.3)
+        gmsh.model.mesh.generate(2)
+        m, _, _ = store_mesh(2)
+        gmsh.model.setCurrent('bench')
+
+        offsets = [ (b.x, b.y, b.z, b.r) for b in packedBed.beads ]
+        start = time.perf_counter()
+        _, tagss = add_nodes_multi(m, 0, offsets)
+        gmsh.model.mesh.destroyMeshCaches()
+        ## addElementsCustom() only exists in gmsh patched with custom_mesh_copy.patch
+        if hasattr(gmsh.model.mesh, 'addElementsCustom'):
+            add_elements_multi(m, 0, 0, tagss)
+            gmsh.model.mesh.destroyMeshCaches()
+        return time.perf_counter() - start
+
+    def write_fragments(self):
+        from pymesh.column import Column
+        gmsh = self.gmsh_model()
+        packedBed = self.packed_bed()
+        container = Container('box', box_around(packedBed, packedBed.rmax), logger=self.logger)
+        packedBed.generate()
+        column = Column(container, packedBed, fragment=True, logger=self.logger)
+        gmsh.model.mesh.setSize(gmsh.model.getEntities(0), 2 * packedBed.rmax)
+        gmsh.model.mesh.generate(2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                start = time.perf_counter()
+                column.write_fragments('bench', '.vtk')
+                return time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+
+def gmsh_available():
+    try:
+        import gmsh
+        ## pymesh imports gmsh lazily: force loading it
+        gmsh.isInitialized
+        return True
+    except (ImportError, OSError, AttributeError):
+        return False
+
+def metadata():
+    meta = {
+        'pymesh_version': __version__,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+    if gmsh_available():
+        import gmsh
+        meta['gmsh_api'] = gmsh.GMSH_API_VERSION
+    return meta
+
+def run(args):
+    logger = Logger()
+    has_gmsh = gmsh_available()
+
+    if not has_gmsh:
+        logger.warn('gmsh is not available. Skipping stages:', ", ".join(GMSH_STAGES))
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for kind in args.kinds:
+            for nbeads in args.scales:
+                packing_file = Path(tmpdir) / f'{kind}-{nbeads}.xyzd'
+                if args.packing == 'lattice':
+                    packing = lattice_packing(nbeads, kind, seed=args.seed)
+                else:
+                    packing = random_packing(nbeads, kind, seed=args.seed, nproc=args.nproc)
+                write_xyzd(packing_file, packing)
+                bench = Bench(packing_file, nbeads, logger)
+
+                for stage in args.stages:
+                    if stage in GMSH_STAGES and (not has_gmsh or nbeads > args.max_gmsh_beads):
+                        continue
+
+                    times = [ getattr(bench, stage)() for _ in range(args.repeat) ]
+                    result = {
+                        'stage': stage,
+                        'kind': kind,
+                        'nbeads': nbeads,
+                        'time': min(times),
+                        'times': times,
+                        'peak_rss_mb': peak_rss_mb(),
+                    }
+                    results.append(result)
+                    logger.note(f"{stage:>20} {kind:>5} {nbeads:>8}: {result['time']:.4f} s")
+
+    if has_gmsh:
+        import gmsh
+        if gmsh.isInitialized():
+            gmsh.finalize()
+
+    with open(args.output, 'w') as fp:
+        json.dump({ 'meta': metadata(), 'results': results }, fp, indent=4)
+
+def compare(args):
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    with open(args.current) as fp:
+        current = json.load(fp)
+
+    key = lambda r: (r['stage'], r['kind'], r['nbeads'])
+    old = { key(r): r for r in baseline['results'] }
+
+    table = Table(title=f"{args.baseline} -> {args.current}")
+    for column in [ 'stage', 'kind', 'nbeads', 'baseline [s]', 'current [s]', 'ratio' ]:
+        table.add_column(column, justify='right')
+
+    regressions = 0
+    for r in current['results']:
+        if key(r) not in old:
+            continue
+        t0 = old[key(r)]['time']
+        t1 = r['time']
+        ratio = t1 / t0 if t0 > 0 else float('inf')
+        if ratio > 1 + args.threshold:
+            style = 'bold red'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            style = 'bold green'
+        else:
+            style = None
+        table.add_row(r['stage'], r['kind'], str(r['nbeads']), f"{t0:.4f}", f"{t1:.4f}", f"{ratio:.2f}", style=style)
+
+    console.print(table)
+
+    if regressions:
+        console.print(f"{regressions} regression(s) above {args.threshold:.0%}", style='bold red')
+        sys.exit(1)
+
+def main():
+    ap = argparse.ArgumentParser()
+    sp = ap.add_subparsers(dest='command', required=True)
+
+    run_ap = sp.add_parser('run', help='Run benchmarks')
+    run_ap.add_argument('-o', '--output', default='bench.json', help='Output json file')
+    run_ap.add_argument('--scales', nargs='+', type=int, default=[100, 1000, 10000, 100000, 1000000], help='Number of beads')
+    run_ap.add_argument('--kinds', nargs='+', default=['mono', 'poly'], choices=['mono', 'poly'], help='Packing types')
+    run_ap.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='Stages to benchmark')
+    run_ap.add_argument('--repeat', type=int, default=3, help='Repetitions per stage. The minimum time is reported.')
+    run_ap.add_argument('--max-gmsh-beads', type=int, default=2000, help='Largest packing to run gmsh stages on')
+    run_ap.add_argument('--packing', default='lattice', choices=['lattice', 'random'], help='Jittered lattice (instant) or random packings from PackingGenerator')
+    run_ap.add_argument('--seed', type=int, default=0, help='Random seed for packing generation')
+    run_ap.add_argument('--nproc', type=int, default=1, help='Threads for random packing generation')
+    run_ap.set_defaults(func=run)
+
+    compare_ap = sp.add_parser('compare', help='Compare two benchmark results')
+    compare_ap.add_argument('baseline', help='Baseline results json')
+    compare_ap.add_argument('current', help='Current results json')
+    compare_ap.add_argument('--threshold', type=float, default=0.1, help='Relative change considered significant')
+    compare_ap.set_defaults(func=compare)
+
+    args = ap.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Synthetic packings for benchmarks
+
+lattice_packing() places beads on a jittered cubic lattice, so packings of
+any size are generated in a fraction of a second and never contain
+overlapping beads. They are not physically realistic packings, but they
+exercise the same code paths with a controlled number of beads.
+
+random_packing() uses pymesh's PackingGenerator for realistic random packings
+at a given porosity. Its time is linear in the number of beads: ~7 s for
+2*10^4 beads, ~30 s for 10^5, and ~5 minutes for 10^6 on a single core.
+"""
+
+from pymesh.packingGenerator import PackingGenerator
+
+import numpy as np
+
+def lattice_packing(nbeads, kind='mono', radius=0.5, spread=0.2, gap=0.05, seed=0):
+    """
+    Generate a packing of nbeads beads as an (nbeads, 4) array of x, y, z, r.
+
+    kind = mono: all beads have the given radius
+    kind = poly: lognormal radii with the given relative spread, clipped to [0.5, 1.0] * radius
+
+    The lattice spacing is 2 * radius * (1 + gap), the bed is (nearly) cubic,
+    and starts at z = 0 with its axis on x = y = 0.
+    """
+    rng = np.random.default_rng(seed)
+
+    if kind == 'mono':
+        radii = np.full(nbeads, radius)
+    elif kind == 'poly':
+        radii = radius * rng.lognormal(mean=np.log(0.75), sigma=spread, size=nbeads)
+        radii = np.clip(radii, 0.5 * radius, radius)
+    else:
+        raise ValueError(f"Invalid packing kind: {kind}")
+
+    nside = int(np.ceil(nbeads ** (1/3)))
+    spacing = 2 * radius * (1 + gap)
+
+    index = np.arange(nbeads)
+    ijk = np.stack([index % nside, (index // nside) % nside, index // nside**2], axis=1)
+    centers = (ijk + 0.5) * spacing
+
+    ## Jitter each bead within the slack left by its own radius
+    slack = (spacing / 2 - radii)[:, None]
+    centers += rng.uniform(-1, 1, size=centers.shape) * slack
+
+    centers[:, 0] -= nside * spacing / 2
+    centers[:, 1] -= nside * spacing / 2
+
+    return np.column_stack([centers, radii])
+
+def random_packing(nbeads, kind='mono', radius=0.5, spread=0.2, porosity=0.45, seed=0, nproc=1):
+    """
+    Generate a random packing of nbeads beads in a cylinder, as an (nbeads, 4) array of x, y, z, r.
+    See lattice_packing() for kind and spread. The packing doesn't depend on nproc.
+    """
+    generator = PackingGenerator(
+            shape = 'cylinder',
+            nbeads = nbeads,
+            porosity = porosity,
+            aspect = 2.0,
+            distribution = 'mono' if kind == 'mono' else 'lognormal',
+            radius = radius if kind == 'mono' else 0.75 * radius,
+            std = 0.0 if kind == 'mono' else 0.75 * radius * spread,
+            seed = seed,
+            nproc = nproc,
+            )
+    return generator.generate()
+
+def write_xyzd(filename, packing, dataformat='<d'):
+    """
+    Write a packing array to an xyzd file, readable by PackedBed.read_packing
+    Stores diameters, not radii.
+    """
+    data = packing.astype(np.float64, copy=True)
+    data[:, 3] *= 2
+    data.astype(np.dtype(dataformat)).tofile(filename)
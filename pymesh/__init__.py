@@ -27,16 +27,39 @@ def git_version():
         return None
 
 __version__ = "0.1"
-# If run locally, return the actual git version, otherwise, return the version installed.
-__git_version__ = git_version()
 __author__ = 'Jayghosh Rao'
 __credits__ = 'FZJ/IBG-1/ModSim'
 
-from .configHandler import ConfigHandler
-from .log           import Logger
-from .bead          import Bead
-from .packedBed     import PackedBed
-from .container     import Container
-from .genericModel  import GenericModel
-from .copyMeshModel import CopyMeshModel
-from .column        import Column
+## Public classes, imported on first access so that `import pymesh` stays cheap.
+## NOTE: gmsh itself is only loaded once it's used, see pymesh.lazy
+_exports = {
+    'ConfigHandler'    : '.configHandler',
+    'Logger'           : '.log',
+    'Bead'             : '.bead',
+    'PackedBed'        : '.packedBed',
+    'Container'        : '.container',
+    'GenericModel'     : '.genericModel',
+    'CopyMeshModel'    : '.copyMeshModel',
+    'Column'           : '.column',
+    'PackingGenerator' : '.packingGenerator',
+}
+
+__all__ = [ '__version__', '__git_version__', *_exports ]
+
+def __getattr__(name):
+    if name == '__git_version__':
+        # If run locally, return the actual git version, otherwise, return the version installed.
+        ## Resolved on first access only: it imports GitPython and runs git
+        globals()['__git_version__'] = git_version()
+        return globals()['__git_version__']
+
+    if name in _exports:
+        import importlib
+        value = getattr(importlib.import_module(_exports[name], __name__), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,8 +1,10 @@
-import gmsh
 import numpy as np
 from dataclasses import dataclass
 
 from pymesh.tools import copy_mesh
+from pymesh.lazy import lazy_import
+
+gmsh = lazy_import('gmsh')
 
 @dataclass(init=True, order=True, repr=True, frozen=True)
 class Bead:
@@ -0,0 +1,198 @@
+"""
+GeometryCheckpoint class
+
+contract:
+    - must save the built geometry of a GenericModel: the OCC shapes (BREP), the column sections' surfaces, volumes, walls and periodic surface pairs, and the beads
+    - must key the checkpoint by a hash of everything that changes the geometry: packing file, pymesh version, geometry-relevant config
+    - must restore the model from a matching checkpoint, ready for set_mesh_size() and mesh(), and rebuild otherwise
+
+Files: <output stem>.geometry.brep and <output stem>.geometry.json
+
+Mesh settings (mesh.*, except mesh.method), output.*, general.nproc,
+general.time_limits, general.progress_interval, general.verbosity and gmsh
+options other than Geometry.* are not part of the key: changing them reuses
+the checkpoint.
+
+OCC renumbers entities when importing the BREP, so entities are matched to
+their saved tags by bounding box and mass. The checkpoint is ignored if any
+surface or volume can't be matched uniquely.
+"""
+
+from pymesh.packedBed import PackedBed
+from pymesh.container import Container
+from pymesh.column import Column
+from pymesh.spatial import CellGrid
+from pymesh.log import Logger
+from pymesh.lazy import lazy_import
+from pymesh import __version__
+
+from pathlib import Path
+
+import hashlib
+import json
+
+import numpy as np
+
+gmsh = lazy_import('gmsh')
+
+## Relative tolerance on bounding boxes (w.r.t. the model size) and masses when matching entities
+MATCH_TOLERANCE = 1e-6
+
+## Config keys that don't change the geometry
+NON_GEOMETRY_KEYS = [ 'output', 'general.nproc', 'general.checkpoint', 'recovery.enabled', 'general.time_limits', 'general.progress_interval', 'general.verbosity' ]
+
+class GeometryCheckpoint:
+
+    def __init__(self, config, logger=Logger(level=1)):
+        self.logger = logger
+        self.config = config
+
+        stem = Path(config.output_filename).stem
+        self.brep = Path(stem + '.geometry.brep')
+        self.data = Path(stem + '.geometry.json')
+
+    def key(self):
+        """
+        Hash of the packing file, pymesh version and geometry-relevant config
+        """
+        config = json.loads(json.dumps(self.config.config, default=str))
+
+        mesh = config.pop('mesh', {}) or {}
+        config['mesh'] = { 'method': mesh.get('method', 'generic') }
+        config['gmsh'] = { option: value for option, value in (config.get('gmsh', {}) or {}).items() if option.startswith('Geometry.') }
+        for key in NON_GEOMETRY_KEYS:
+            *parents, last = key.split('.')
+            section = config
+            for parent in parents:
+                section = section.get(parent, {}) if isinstance(section, dict) else {}
+            if isinstance(section, dict):
+                section.pop(last, None)
+
+        sha = hashlib.sha1()
+        sha.update(json.dumps(config, sort_keys=True).encode())
+        sha.update(__version__.encode())
+        packing = Path(self.config.packing_file_name)
+        if packing.exists():
+            with open(packing, 'rb') as fp:
+                for block in iter(lambda: fp.read(1 << 24), b''):
+                    sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def signatures(dim):
+        """
+        Tags, and bounding boxes and masses of all entities of dimension dim
+        """
+        tags = [ tag for _, tag in gmsh.model.getEntities(dim) ]
+        signatures = [ list(gmsh.model.getBoundingBox(dim, tag)) + [ gmsh.model.occ.getMass(dim, tag) ] for tag in tags ]
+        return np.array(tags, dtype=np.int64), np.array(signatures, dtype=np.float64).reshape(-1, 7)
+
+    def match(self, old_tags, old_signatures, new_tags, new_signatures):
+        """
+        Map of saved tags to the tags of the imported entities with the same bounding box and mass
+        @output: { old tag: new tag }, or None if some entity has no unique match
+        """
+        if len(old_tags) != len(new_tags):
+            return None
+        if not len(old_tags):
+            return {}
+
+        lo, hi = new_signatures[:, :3].min(axis=0), new_signatures[:, 3:6].max(axis=0)
+        tol = MATCH_TOLERANCE * max(np.linalg.norm(hi - lo), np.finfo(np.float64).tiny)
+
+        centers = lambda s: (s[:, :3] + s[:, 3:6]) / 2
+        grid = CellGrid(centers(new_signatures), tol)
+        iq, jg, _, _ = grid.query(centers(old_signatures), tol)
+
+        box = np.abs(old_signatures[iq, :6] - new_signatures[jg, :6]).max(axis=1) < tol
+        mass = np.abs(old_signatures[iq, 6] - new_signatures[jg, 6]) <= MATCH_TOLERANCE * np.maximum(np.abs(old_signatures[iq, 6]), tol**3)
+        iq, jg = iq[box & mass], jg[box & mass]
+
+        if len(np.unique(iq)) != len(old_tags) or len(iq) != len(old_tags) or len(np.unique(jg)) != len(jg):
+            return None
+
+        return dict(zip(old_tags[iq].tolist(), new_tags[jg].tolist()))
+
+    def save(self, model, sections):
+        """
+        @input: model: built GenericModel, sections: { name: Column }
+        """
+        with self.logger.stage('Writing geometry checkpoint'):
+            gmsh.model.occ.synchronize()
+            gmsh.write(str(self.brep))
+
+            entities = {}
+            for dim in (2, 3):
+                tags, signatures = self.signatures(dim)
+                entities[dim] = { 'tags': tags.tolist(), 'signatures': signatures.tolist() }
+
+            data = {
+                'key': self.key(),
+                'entities': entities,
+                'beads': model.packedBed.to_array().tolist(),
+                'original_index': model.packedBed.original_index.tolist(),
+                'bead_entities': [ tag for _, tag in model.packedBed.entities ],
+                'sections': {
+                    name: {
+                        'container': { 'shape': column.container.shape, 'size': list(column.container.size) },
+                        'entities': [ tag for _, tag in getattr(column, 'entities', []) ],
+                        'surfaces': column.surfaces,
+                        'volumes': column.volumes,
+                        'walls': column.walls,
+                        'periodic': column.periodic,
+                    } for name, column in sections.items()
+                },
+            }
+            self.data.write_text(json.dumps(data))
+
+        self.logger.note(f"Wrote geometry checkpoint {self.brep}")
+
+    def load(self, model):
+        """
+        Restore the packed bed and column sections of model from the checkpoint, if its key matches
+        @output: { name: Column }, or None if the checkpoint can't be used
+        """
+        if not self.brep.exists() or not self.data.exists():
+            return None
+
+        data = json.loads(self.data.read_text())
+        if data.get('key') != self.key():
+            self.logger.note(f"Ignoring {self.brep}: the packing or geometry settings changed")
+            return None
+
+        with self.logger.stage('Reading geometry checkpoint'):
+            gmsh.model.occ.importShapes(str(self.brep), highestDimOnly=False)
+            gmsh.model.occ.synchronize()
+
+            maps = {}
+            for dim in (2, 3):
+                saved = data['entities'][str(dim)]
+                maps[dim] = self.match(np.array(saved['tags'], dtype=np.int64), np.array(saved['signatures'], dtype=np.float64).reshape(-1, 7), *self.signatures(dim))
+                if maps[dim] is None:
+                    self.logger.warn(f"Ignoring {self.brep}: its entities don't match the saved ones")
+                    name = gmsh.model.getCurrent()
+                    gmsh.model.remove()
+                    gmsh.model.add(name)
+                    return None
+
+            surfaces = lambda tags: [ maps[2][t] for t in tags ]
+            volumes = lambda tags: [ maps[3][t] for t in tags ]
+
+            packedBed = PackedBed(self.config, generate=False, packing=np.array(data['beads']).reshape(-1, 4), original_index=data.get('original_index'))
+            packedBed.entities = [ (3, tag) for tag in volumes(data['bead_entities']) ]
+            model.packedBed = packedBed
+
+            sections = {}
+            for name, section in data['sections'].items():
+                container = Container(section['container']['shape'], section['container']['size'], generate=False)
+                column = Column(container, packedBed, fragment=False, logger=self.logger)
+                column.entities = [ (3, tag) for tag in volumes(section['entities']) ]
+                column.surfaces = { key: surfaces(tags) for key, tags in section['surfaces'].items() }
+                column.volumes = { key: volumes(tags) for key, tags in section['volumes'].items() }
+                column.walls = { key: surfaces(tags) for key, tags in section['walls'].items() }
+                column.periodic = [ (maps[2][slave], maps[2][master], affine) for slave, master, affine in section['periodic'] ]
+                column.set_periodic()
+                sections[name] = column
+
+        self.logger.note(f"Resumed from geometry checkpoint {self.brep}")
+        return sections
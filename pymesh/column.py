@@ -8,17 +8,19 @@ contract:
     - setPhysicalNames and Groups
 """
 
-import gmsh
-
 from pymesh.tools import get_surface_normals, filter_surfaces_with_normal, testMesh, remove_all_except
 from pymesh.tools import remove_physical_groups
-from pymesh.log import Logger
+from pymesh.log import Logger, Progress
+from pymesh.hdf5 import HDF5Exporter, HDF5_SUFFIXES
+from pymesh.lazy import lazy_import
 
 from pathlib import Path
 
 import numpy as np
 import numpy.ma as ma
 
+gmsh = lazy_import('gmsh')
+
 class Column:
 
     def __init__(self, container, packedBed, fragment=True, copy=False, periodicity:str='', endFaceSections=1, logger=Logger(level=1)):
@@ -55,6 +57,9 @@ class Column:
                 'particles': []
         }
 
+        ## Periodic surface pairs: (slave, master, affine transformation)
+        self.periodic = []
+
         in_wires, out_wires = self.get_inlet_outlet_wires(endFaceSections)
 
         if not fragment: 
@@ -82,7 +87,6 @@ class Column:
         many volumes it is fragmented into. This is the only thing that matters in our case, hence we remove
         all other volumes to clean up the model.
         """
-        self.logger.out('Fragmenting column')
         factory = gmsh.model.occ
 
         object = factory.copy(object) if copyObject else object
@@ -93,8 +97,9 @@ class Column:
         ## NOTE: Intersection preserves normals. This is so stupid.
         ## Direct fragmentation doesn't preserve surface normals
         ## TODO: File an issue with upstream
-        obj2, _ = factory.intersect(object, tool, removeObject=True, removeTool=False)
-        fragmented, fmap = factory.fragment(obj2, tool, removeObject=removeObject, removeTool=removeTool)
+        with self.logger.stage('Fragmenting column'):
+            obj2, _ = factory.intersect(object, tool, removeObject=True, removeTool=False)
+            fragmented, fmap = factory.fragment(obj2, tool, removeObject=removeObject, removeTool=removeTool)
 
 
         if cleanFragments:
@@ -176,6 +181,20 @@ class Column:
                 elif np.array_equal(n,[0,0,0]):
                     beads.append(s[1])
 
+            if self.packedBed.entities:
+                ## Flat faces of cut beads can be axis aligned too: walls must lie on the container bounds
+                bounds = self.container.get_bounds()
+                tol = 1e-6 * max(bounds['xdelta'], bounds['ydelta'], bounds['zdelta'])
+                for faces, axis, value in [ (xm, 0, bounds['xmin']), (xp, 0, bounds['xmax']), (ym, 1, bounds['ymin']), (yp, 1, bounds['ymax']), (zm, 2, bounds['zmin']), (zp, 2, bounds['zmax']) ]:
+                    for tag in list(faces):
+                        bbox = gmsh.model.getBoundingBox(2, tag)
+                        if abs(bbox[axis] - value) > tol or abs(bbox[axis + 3] - value) > tol:
+                            faces.remove(tag)
+                            beads.append(tag)
+
+                internal = self.internal_particle_surfaces()
+                beads = [ tag for tag in beads if tag not in internal ]
+
             self.walls.update({'x-': xm})
             self.walls.update({'x+': xp})
             self.walls.update({'y-': ym})
@@ -198,7 +217,8 @@ class Column:
             interstitial_surfaces = gmsh.model.getBoundary([ (3,tag) for tag in self.volumes.get('interstitial', []) ], combined=False, oriented=False, recursive=False)
             container_surfaces    = [x for x in interstitial_surfaces if x not in particle_surfaces]
 
-            self.surfaces.update({'particles': [x[1] for x in particle_surfaces]})
+            internal = self.internal_particle_surfaces() if self.packedBed.entities else set()
+            self.surfaces.update({'particles': [x[1] for x in particle_surfaces if x[1] not in internal]})
 
             self.surfaces.update({'walls'    : [container_surfaces[0][1]]})
 
@@ -206,6 +226,16 @@ class Column:
             self.surfaces.update({'inlet': sorted([ tag for _,tag in filter_surfaces_with_normal(container_surfaces, (0,0,-1)) ], reverse=True) })
             self.surfaces.update({'outlet': sorted([ tag for _, tag in filter_surfaces_with_normal(container_surfaces, (0,0,1)) ], reverse=True) })
 
+    def internal_particle_surfaces(self):
+        """
+        Surfaces shared by two particle volumes, such as the interfaces between
+        overlapping fused batches of a bridged bed. They are not part of the
+        particle-interstitial interface.
+        """
+        boundaries = gmsh.model.getBoundary([ (3,tag) for tag in self.volumes.get('particles', []) ], combined=False, oriented=False, recursive=False)
+        tags, counts = np.unique([ tag for _, tag in boundaries ], return_counts=True)
+        return set(tags[counts > 1].tolist())
+
     def get_inlet_outlet_wires(self, N, type='EQUIDISTANT'):
         """
         In cases where I need to apply inlet/outlet conditions to only parts of the surface, divide the surface into concentric rings
@@ -273,8 +303,16 @@ class Column:
                 bboxp = gmsh.model.getBoundingBox(2, sp)
                 bboxp_masked = ma.masked_array(bboxp, mask=mask)
                 if np.allclose(bboxm_masked, bboxp_masked):
+                    self.periodic.append((sp, sm, list(affineTranslation)))
                     gmsh.model.mesh.setPeriodic(2, [sp], [sm], affineTranslation)
 
+    def set_periodic(self):
+        """
+        Reapply the periodic surface pairs, e.g. after restoring the column from a checkpoint
+        """
+        for slave, master, affine in self.periodic:
+            gmsh.model.mesh.setPeriodic(2, [slave], [master], affine)
+
     def set_individual_physical_groups(self, tags, name_prefix, index_offset=1):
         """Set physical groups and names for a list of tags"""
         for index,tag in enumerate(tags):
@@ -309,17 +347,44 @@ class Column:
         gmsh.model.setPhysicalName(3, 5, "interstitial")
         gmsh.model.setPhysicalName(3, 6, "particles")
 
-    def write(self, fname, writeFragments=True, fragmentFormat='.vtk'):
+    def save(self, fname):
+        """
+        Write the physical groups of the model: HDF5/XDMF for .h5 and .hdf5 files, gmsh.write() otherwise
+        """
+        if Path(fname).suffix in HDF5_SUFFIXES:
+            self.hdf5.write(fname)
+        else:
+            gmsh.write(fname)
+
+    def write(self, fname, writeFragments=True, fragmentFormat='.vtk', partitioning=None, hdf5=None):
+        """
+        @input:
+            - partitioning: MeshPartitioning, to also write the mesh in partitions
+            - hdf5: HDF5Exporter with the output options for .h5 files
+        """
+        self.hdf5 = hdf5 or HDF5Exporter(logger=self.logger)
+
         self.set_physical_groups()
-        gmsh.write(fname)
+        with self.logger.stage('Writing mesh') as record:
+            record['file'] = fname
+            self.save(fname)
+
+        if partitioning:
+            with self.logger.stage('Writing partitions') as record:
+                record['file'] = fname
+                record['partitions'] = partitioning.nparts
+                partitioning.write(fname)
 
         if writeFragments:
             basename = Path(fname).stem
             extension = Path(fname).suffix
-            self.write_fragments(basename, fragmentFormat)
+            with self.logger.stage('Writing fragments'):
+                self.write_fragments(basename, fragmentFormat)
 
     def write_fragments(self, basename, extension):
 
+        progress = Progress('fragments written', 5, logger=self.logger)
+
         remove_physical_groups()
 
         gmsh.model.addPhysicalGroup(2, self.surfaces.get('inlet'), 11)
@@ -331,14 +396,16 @@ class Column:
         gmsh.model.addPhysicalGroup(2, self.surfaces.get('walls'), 13)
         gmsh.model.setPhysicalName(2, 13, "walls")
 
-        gmsh.write(basename + '_surfaces_inlet_outlet_walls' + extension)
+        self.save(basename + '_surfaces_inlet_outlet_walls' + extension)
+        progress.update()
 
         remove_physical_groups()
 
         gmsh.model.addPhysicalGroup(2, self.surfaces.get('particles'), 14)
         gmsh.model.setPhysicalName(2, 14, "particles")
 
-        gmsh.write(basename + '_surfaces_particles' + extension)
+        self.save(basename + '_surfaces_particles' + extension)
+        progress.update()
 
         remove_physical_groups()
 
@@ -353,7 +420,8 @@ class Column:
         gmsh.model.addPhysicalGroup(2, self.surfaces.get('particles'), 14)
         gmsh.model.setPhysicalName(2, 14, "particles")
 
-        gmsh.write(basename + '_volumes_interstitial' + extension)
+        self.save(basename + '_volumes_interstitial' + extension)
+        progress.update()
 
         remove_physical_groups()
 
@@ -362,7 +430,8 @@ class Column:
         gmsh.model.addPhysicalGroup(3, self.volumes.get('particles'), 16)
         gmsh.model.setPhysicalName(3, 16, "particles")
 
-        gmsh.write(basename + '_volumes_particles' + extension)
+        self.save(basename + '_volumes_particles' + extension)
+        progress.update()
 
         remove_physical_groups()
 
@@ -371,6 +440,8 @@ class Column:
         self.set_individual_physical_groups(inlet_tags, 'inlet', 110)
         self.set_individual_physical_groups(outlet_tags, 'outlet', 120)
 
-        gmsh.write(basename + '_inlet_outlet_individual' + extension)
+        self.save(basename + '_inlet_outlet_individual' + extension)
+        progress.update()
+        progress.close()
 
         remove_physical_groups()
@@ -14,12 +14,13 @@ contract:
 from ruamel.yaml import YAML
 from pathlib import Path
 
-import gmsh
-
 from functools import reduce
 from itertools import combinations
 
 from pymesh.log import Logger
+from pymesh.lazy import lazy_import
+
+gmsh = lazy_import('gmsh')
 
 class ConfigHandler:
 
@@ -82,6 +83,16 @@ class ConfigHandler:
         self.packedbed_particles_radius_lower_threshold = self.get('packedbed.particles.radius_lower_threshold', 0.0, float)
         self.packedbed_auto_translate            = self.get('packedbed.auto_translate', False, bool)
         self.packedbed_target_volume             = self.get('packedbed.target_volume', 0.0, float)
+        self.packedbed_ordering                  = self.get('packedbed.ordering', '', str(), ['', 'morton', 'hilbert'])
+        self.packedbed_particles_modification    = self.get('packedbed.particles.modification', '', str(), ['', 'bridge', 'cut'])
+        if self.packedbed_particles_modification == 'bridge':
+            self.packedbed_particles_relative_bridge_radius = self.get('packedbed.particles.relative_bridge_radius', 0.2, float)
+            self.packedbed_particles_bridge_offset_ratio    = self.get('packedbed.particles.bridge_offset_ratio', 0.5, float)
+            self.packedbed_particles_fuse_batch_size        = self.get('packedbed.particles.fuse_batch_size', 1000, int)
+            if self.packedbed_particles_bridge_offset_ratio**2 + self.packedbed_particles_relative_bridge_radius**2 >= 1:
+                self.logger.die('packedbed.particles.bridge_offset_ratio is too large: bridges must start inside the beads (offset_ratio^2 + relative_bridge_radius^2 < 1)')
+        self.packedbed_contacts_repair           = self.get('packedbed.contacts.repair', False, bool)
+        self.packedbed_contacts_relative_min_gap = self.get('packedbed.contacts.relative_min_gap', 0.01, float) if self.packedbed_contacts_repair or self.packedbed_particles_modification else 0.0
 
         self.container_shape                     = self.get('container.shape', '', vartype=str(), choices = ['box', 'cylinder', ''])
         self.container_size                      = self.get('container.size', [], vartype=list)
@@ -91,28 +102,64 @@ class ConfigHandler:
         self.container_inlet_length              = self.get('container.inlet_length', 0.0, float)
         self.container_outlet_length             = self.get('container.outlet_length', 0.0, float)
         self.container_end_face_sections         = self.get('container.end_face_sections', 1, int)
+        self.container_wall_gap_snap             = self.get('container.wall_gap.snap', False, bool)
+        if self.container_wall_gap_snap:
+            self.container_wall_gap_relative_epsilon = self.get('container.wall_gap.relative_epsilon', 0.01, float)
+            self.container_wall_gap_mode         = self.get('container.wall_gap.mode', 'nearest', str(), ['nearest', 'intersect', 'clearance'])
 
         self.mesh_method                         = self.get('mesh.method', 'generic', str(), choices = ['generic', 'copymesh'])
         if self.mesh_method == 'copymesh': 
             self.mesh_copymesh_ref_dim = self.get('mesh.copymesh_ref_dim', 3, int, choices=[2,3])
 
-        self.mesh_size_method                    = self.get('mesh.size_method', 'global', str(), ['global', 'field'])
+        self.mesh_size_method                    = self.get('mesh.size_method', 'global', str(), ['global', 'field', 'gap'])
         self.mesh_size                           = self.get('mesh.size', 0.2, float)
         self.mesh_field_threshold_size_in        = self.get('mesh.field.threshold.size_in', self.mesh_size, float)
         self.mesh_field_threshold_size_out       = self.get('mesh.field.threshold.size_out', self.mesh_size, float)
         self.mesh_field_threshold_rad_min_factor = self.get('mesh.field.threshold.rad_min_factor', 1.0, float)
         self.mesh_field_threshold_rad_max_factor = self.get('mesh.field.threshold.rad_max_factor', 1.0, float)
+        if self.mesh_size_method == 'gap':
+            self.mesh_field_gap_size_min         = self.get('mesh.field.gap.size_min', self.mesh_field_threshold_size_out / 8, float)
+            self.mesh_field_gap_elements_across  = self.get('mesh.field.gap.elements_across', 3.0, float)
+            self.mesh_field_gap_grading          = self.get('mesh.field.gap.grading', 0.3, float)
         self.mesh_ref_radius                     = self.get('mesh.ref_radius', 'avg', str(), ['avg', 'max', 'min'])
         self.mesh_generate                       = self.get('mesh.generate', 3, int, [0,1,2,3])
+        self.mesh_quality                        = self.get('mesh.quality', False, bool)
+        self.mesh_renumber                       = self.get('mesh.renumber', '', str(), ['', 'rcm', 'hilbert'])
+        self.mesh_levels                         = self.get('mesh.levels', 1, int)
+        if self.mesh_levels > 1:
+            self.mesh_levels_method              = self.get('mesh.levels_method', 'regenerate', str(), ['regenerate', 'refine'])
+            self.mesh_levels_ratio               = self.get('mesh.levels_ratio', 2.0, float)
 
         self.output_filename                     = self.get('output.filename', 'output.vtk', str())
         self.output_fragment_format              = self.get('output.fragment_format', 'vtk', str())
         self.output_log_timestamp                = self.get('output.log_timestamp', False, bool)
+        self.output_hdf5_float32                 = self.get('output.hdf5.float32', False, bool)
+        self.output_hdf5_compression             = self.get('output.hdf5.compression', 4, int, list(range(10)))
+        self.output_partitions_number            = self.get('output.partitions.number', 0, int)
+        if self.output_partitions_number > 1:
+            self.output_partitions_method        = self.get('output.partitions.method', 'metis', str(), ['metis', 'hilbert'])
+            self.output_partitions_ghost_cells   = self.get('output.partitions.ghost_cells', True, bool)
+
+        self.recovery_enabled                    = self.get('recovery.enabled', False, bool)
+        if self.recovery_enabled:
+            self.recovery_remedies               = self.get('recovery.remedies', ['shrink', 'nudge', 'drop'], list)
+            self.recovery_shrink_factor          = self.get('recovery.shrink_factor', 1e-3, float)
+            self.recovery_nudge_factor           = self.get('recovery.nudge_factor', 1e-3, float)
+            for remedy in self.recovery_remedies:
+                if remedy not in ['shrink', 'nudge', 'drop']:
+                    self.logger.die('recovery.remedies has invalid value! Must be a list of shrink, nudge, drop')
 
         self.general_improved_bbox_calc          = self.get('general.improved_bbox_calc', False)
         self.general_fragment                    = self.get('general.fragment', True, bool)
         self.general_nproc                       = self.get('general.nproc', 1, int)
         self.general_center_bed_in_container     = self.get('general.center_bed_in_container', False, bool)
+        self.general_verbosity                   = self.get('general.verbosity', 2, int)
+        self.general_progress_interval           = self.get('general.progress_interval', 60, int)
+        self.general_time_limits                 = self.get('general.time_limits', {}, dict)
+        for stage, limit in self.general_time_limits.items():
+            if not isinstance(limit, (int, float)):
+                self.logger.die(f"general.time_limits.{stage} has invalid type! {type(limit)} instead of seconds")
+        self.general_checkpoint                  = self.get('general.checkpoint', False, bool)
 
     def set_gmsh_defaults(self):
 
@@ -10,13 +10,15 @@ Container class.
 
 """
 
-import gmsh
 from math import pi as PI
 
 from pymesh.log import Logger
 from pymesh.tools import store_mesh, copy_mesh
+from pymesh.lazy import lazy_import
 
-factory = gmsh.model.occ
+import numpy as np
+
+gmsh = lazy_import('gmsh')
 
 class Container:
 
@@ -47,6 +49,7 @@ class Container:
         """
         Creates the container geometry
         """
+        factory = gmsh.model.occ
         if self.shape == 'box':
             self.entities.append(factory.addBox(*self.size))
         elif self.shape == 'cylinder':
@@ -137,6 +140,7 @@ class Container:
 
     def set_mesh_fields_constant(self, surfaceTags, config):
 
+        factory = gmsh.model.occ
         field = gmsh.model.mesh.field
         factory.synchronize()
 
@@ -197,6 +201,44 @@ class Container:
             'volume': self.volume,
         }
 
+    def wall_distances(self, points):
+        """
+        Signed distances from points to every wall of the container, positive inside.
+
+        @input: points: (N,3) array
+        @output: names: list of W wall names, distances: (N,W), normals: (N,W,3) outward unit normals
+        NOTE: Cylinders are assumed to be aligned with the z axis, as elsewhere.
+        """
+        self.update_bounds()
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        n = len(points)
+
+        names = []
+        distances = []
+        normals = []
+
+        def plane(name, d, normal):
+            names.append(name)
+            distances.append(d)
+            normals.append(np.broadcast_to(np.array(normal, dtype=np.float64), (n, 3)))
+
+        if self.shape == 'box':
+            plane('x0', points[:, 0] - self.xmin, [-1, 0, 0])
+            plane('x1', self.xmax - points[:, 0], [ 1, 0, 0])
+            plane('y0', points[:, 1] - self.ymin, [ 0,-1, 0])
+            plane('y1', self.ymax - points[:, 1], [ 0, 1, 0])
+        elif self.shape == 'cylinder':
+            radial = points[:, :2] - [ self.x, self.y ]
+            rho = np.hypot(radial[:, 0], radial[:, 1])
+            normal = np.zeros((n, 3))
+            normal[:, :2] = np.divide(radial, rho[:, None], out=np.tile([1.0, 0.0], (n, 1)), where=rho[:, None] > 0)
+            plane('wall', self.r - rho, normal)
+
+        plane('z0', points[:, 2] - self.zmin, [ 0, 0,-1])
+        plane('z1', self.zmax - points[:, 2], [ 0, 0, 1])
+
+        return names, np.stack(distances, axis=1), np.stack(normals, axis=1)
+
     def scale(self, factor, cx = 0.0, cy = 0.0, cz = 0.0):
         object.__setattr__(self, 'x', (self.x - cx) * factor)
         object.__setattr__(self, 'y', (self.y - cy) * factor)
@@ -13,17 +13,23 @@ from pymesh.packedBed import PackedBed
 from pymesh.container import Container
 from pymesh.column import Column
 from pymesh.log import Logger
+from pymesh.quality import MeshQuality
+from pymesh.renumber import MeshRenumbering
+from pymesh.partition import MeshPartitioning
+from pymesh.hdf5 import HDF5Exporter
 
 from pymesh.tools import remove_all_except
+from pymesh.lazy import lazy_import
 
 import sys
 
-import gmsh
 from pathlib import Path
 
+gmsh = lazy_import('gmsh')
+
 class CopyMeshModel:
 
-    def __init__(self, config, logger=Logger(level=0)):
+    def __init__(self, config, packing=None, original_index=None, logger=Logger(level=0)):
 
         self.logger = logger
         self.logger.out("Initializing CopyMeshModel")
@@ -42,6 +48,15 @@ class CopyMeshModel:
         self.mesh_size             = config.mesh_size
         self.mesh_size_method      = config.mesh_size_method
         self.mesh_generate         = config.mesh_generate
+        self.mesh_quality          = config.mesh_quality
+        self.mesh_renumber         = config.mesh_renumber
+
+        self.hdf5 = HDF5Exporter(config.output_hdf5_float32, config.output_hdf5_compression, logger=self.logger)
+
+        self.partitioning = None
+        if config.output_partitions_number > 1:
+            self.partitioning = MeshPartitioning(config.output_partitions_number, config.output_partitions_method, config.output_partitions_ghost_cells, logger=self.logger)
+        self.nproc                 = config.general_nproc
 
         self.fragment_format       = config.output_fragment_format if config.output_fragment_format[0] == '.' else f".{config.output_fragment_format}"
 
@@ -54,46 +69,76 @@ class CopyMeshModel:
         if config.container_shape == 'box': 
             self.logger.die("Box containers not implemented with copymesh.")
 
-        self.packedBed = PackedBed(config, generate=False)
-        self.packedBed.write('beads_used.xyzd')
+        if config.packedbed_particles_modification:
+            self.logger.die("packedbed.particles.modification is not implemented with copymesh.")
+
+        self.packedBed = PackedBed(config, generate=False, packing=packing, original_index=original_index)
 
         if not config.container_shape:
+            self.packedBed.write('beads_used.xyzd')
             return
 
         column_container = Container(self.container_shape, self.container_size, generate=False)
 
-        if self.center_bed_in_container:
-            self.packedBed.center_bed_in_bounds(column_container.get_bounds())
+        self.packedBed.fit_to_container(column_container)
+        self.packedBed.write('beads_used.xyzd')
 
-        ntoff, etoff = self.packedBed.copy_mesh(ntoff, etoff, dim=self.copymesh_ref_dim)
-        ntoff, etoff = column_container.copy_mesh(ntoff, etoff, config)
+        with self.logger.stage('Copying bead meshes'):
+            ntoff, etoff = self.packedBed.copy_mesh(ntoff, etoff, dim=self.copymesh_ref_dim)
+        with self.logger.stage('Copying container mesh'):
+            ntoff, etoff = column_container.copy_mesh(ntoff, etoff, config)
         # container_shell = column_container.generate_shell()
 
-        self.logger.out('Creating central column section')
-        self.column = Column(column_container, self.packedBed, fragment=False, copy=False, periodicity='', endFaceSections=config.container_end_face_sections)
+        with self.logger.stage('Creating central column section'):
+            self.column = Column(column_container, self.packedBed, fragment=False, copy=False, periodicity='', endFaceSections=config.container_end_face_sections)
 
-        self.column.entities = gmsh.model.getEntities(dim=3)
-        self.column.separate_volumes()
-        self.column.assign_bounding_surfaces()
+            self.column.entities = gmsh.model.getEntities(dim=3)
+            self.column.separate_volumes()
+            self.column.assign_bounding_surfaces()
 
     def set_mesh_size(self):
-        self.logger.out("Setting mesh size")
-        if self.mesh_size_method == 'field':
-            self.packedBed.set_mesh_fields()
-        elif self.mesh_size_method == 'global':
-            modelEntities = gmsh.model.getEntities()
-            gmsh.model.mesh.setSize(modelEntities, self.mesh_size)
+        with self.logger.stage("Setting mesh size"):
+            if self.mesh_size_method == 'field':
+                self.packedBed.set_mesh_fields()
+            elif self.mesh_size_method == 'global':
+                modelEntities = gmsh.model.getEntities()
+                gmsh.model.mesh.setSize(modelEntities, self.mesh_size)
 
     def mesh(self):
         gmsh.model.occ.synchronize()
         # self.set_mesh_size()
-        self.logger.out("Meshing")
-        gmsh.model.mesh.generate(self.mesh_generate)
+        with self.logger.stage("Meshing"):
+            gmsh.model.mesh.generate(self.mesh_generate)
+        if self.mesh_quality and self.container_shape:
+            self.check_quality()
+
+    def check_quality(self):
+        """
+        Element quality per group, written to <basename>.quality.json
+        """
+        with self.logger.stage("Checking mesh quality"):
+            quality = MeshQuality(MeshQuality.column_groups({ 'column': self.column }), nthreads=self.nproc, logger=self.logger).run()
+
+        quality.print()
+        quality.write(Path(self.fname).stem + '.quality.json')
+
+    def renumber(self):
+        """
+        Bandwidth-reducing renumbering of all nodes and elements, reported in <basename>.renumber.json
+        """
+        with self.logger.stage("Renumbering mesh"):
+            renumbering = MeshRenumbering(self.mesh_renumber, logger=self.logger).run()
+
+        renumbering.print()
+        renumbering.write(Path(self.fname).stem + '.renumber.json')
 
     def write(self):
         basename = Path(self.fname).stem
         extension = Path(self.fname).suffix
 
+        if self.mesh_renumber:
+            self.renumber()
+
         # # This is almost never used in practice
         # self.logger.out("Writing full mesh")
         # gmsh.write(self.fname)
@@ -101,9 +146,9 @@ class CopyMeshModel:
         if not self.container_shape:
             return
 
-        self.column.write(basename + '_column' + extension, fragmentFormat=self.fragment_format)
+        self.column.write(basename + '_column' + extension, fragmentFormat=self.fragment_format, partitioning=self.partitioning, hdf5=self.hdf5)
 
         if self.container_linked :
-            self.inlet.write(basename + '_inlet' + extension, fragmentFormat=self.fragment_format)
-            self.outlet.write(basename + '_outlet' + extension, fragmentFormat=self.fragment_format)
+            self.inlet.write(basename + '_inlet' + extension, fragmentFormat=self.fragment_format, partitioning=self.partitioning, hdf5=self.hdf5)
+            self.outlet.write(basename + '_outlet' + extension, fragmentFormat=self.fragment_format, partitioning=self.partitioning, hdf5=self.hdf5)
 
@@ -0,0 +1,247 @@
+"""
+MeshEstimate class
+
+contract:
+    - must predict node and element counts, peak memory and run time of a config
+    - must only need the preprocessed packed bed and the container: no OCC, no meshing
+    - must report generic and copymesh estimates side by side
+
+Element counts are derived from the local mesh size h: a surface of area A
+needs about A / (sqrt(3)/4 h^2) triangles, and a volume V about
+V / (h^3 / (6 sqrt(2))) tetrahedra (equilateral elements). The mesh size
+follows the threshold fields set by PackedBed.set_mesh_fields() (generic),
+the scaled reference sphere and the container surface field (copymesh), or
+mesh.size (global). Overlapping fields of neighboring beads, periodic
+stacking and mesh size extension from boundaries are not accounted for.
+Expect counts within a factor of ~1.5.
+"""
+
+from pymesh.log import Logger
+
+from math import sqrt, pi
+
+import json
+
+import numpy as np
+
+TRIANGLES_PER_AREA = 4 / sqrt(3)
+TETRAHEDRA_PER_VOLUME = 6 * sqrt(2)
+TETRAHEDRA_PER_NODE = 5.5
+
+## Rough per-item costs for the memory and time estimates.
+## NOTE: These are order-of-magnitude figures. Calibrate them against
+##       peak_rss_mb and wall_time in the .perf.json of representative runs.
+COSTS = {
+    'base_memory'              : 300e6,  # python, numpy, gmsh and OCC libraries
+    'bytes_per_tetrahedron'    : 400,    # gmsh mesh + HXT working memory
+    'bytes_per_triangle'       : 300,
+    'bytes_per_bead_occ'       : 200e3,  # BRep spheres, boolean fragment history
+    'bytes_per_copied_element' : 150,    # copymesh node/element arrays in python
+    'tetrahedra_per_second'    : 5e4,    # per thread
+    'triangles_per_second'     : 5e4,    # per thread
+    'elements_copied_per_second': 1e6,
+    'elements_written_per_second': 1e6,
+    'fragment_seconds_per_bead': 0.05,
+}
+
+## Gauss-Legendre nodes and weights on [0, 1] for the radial integrals
+_nodes, _weights = np.polynomial.legendre.leggauss(32)
+QUAD_NODES = (_nodes + 1) / 2
+QUAD_WEIGHTS = _weights / 2
+
+class MeshEstimate:
+
+    def __init__(self, config, packedBed, container, logger=Logger(level=1)):
+        """
+        @input:
+            - config: loaded ConfigHandler
+            - packedBed: PackedBed after preprocessing (generate=False)
+            - container: Container (generate=False)
+        """
+        self.logger = logger
+
+        self.mesh_method      = config.mesh_method
+        self.mesh_size_method = config.mesh_size_method
+        self.mesh_size        = config.mesh_size
+        self.mesh_generate    = config.mesh_generate
+        self.size_in          = config.mesh_field_threshold_size_in
+        self.size_out         = config.mesh_field_threshold_size_out
+        self.rad_min_factor   = config.mesh_field_threshold_rad_min_factor
+        self.rad_max_factor   = config.mesh_field_threshold_rad_max_factor
+        self.ref_radius       = config.mesh_ref_radius
+        self.copymesh_ref_dim = config.get('mesh.copymesh_ref_dim') or 3
+
+        ## Container surface field used by copymesh
+        self.size_on   = config.get('mesh.field.interstitial_surface_threshold.size_on') or self.size_out
+        self.size_away = config.get('mesh.field.interstitial_surface_threshold.size_away') or self.size_out
+        self.dist_min  = config.get('mesh.field.interstitial_surface_threshold.dist_min') or 0.0
+        self.dist_max  = config.get('mesh.field.interstitial_surface_threshold.dist_max') or 0.0
+
+        gmsh_options = config.get('gmsh') or {}
+        nthreads = gmsh_options.get('General.NumThreads', 1) or 1
+        self.threads2D = gmsh_options.get('Mesh.MaxNumThreads2D', nthreads) or nthreads
+        self.threads3D = gmsh_options.get('Mesh.MaxNumThreads3D', nthreads) or nthreads
+
+        self.radii = np.array([ b.r for b in packedBed.beads ], dtype=np.float64)
+        self.rref = { 'avg': self.radii.mean(), 'max': self.radii.max(), 'min': self.radii.min() }[self.ref_radius]
+
+        container.update_bounds()
+        self.container_volume = container.volume
+        if container.shape == 'box':
+            self.container_area = 2 * (container.dx * container.dy + container.dy * container.dz + container.dx * container.dz)
+        else:
+            self.container_area = 2 * pi * container.r * container.dz + 2 * pi * container.r**2
+
+        self.bead_volume = np.sum(4/3 * pi * self.radii**3)
+        self.bead_area = np.sum(4 * pi * self.radii**2)
+        self.interstitial_volume = max(self.container_volume - self.bead_volume, 0.0)
+
+        self.estimates = { method: self.estimate(method) for method in ['generic', 'copymesh'] }
+
+    def bead_size(self, d, r, method):
+        """
+        Mesh size at distance d from the center of beads of radius r, as set by
+        the threshold fields. (d: (n,k), r: (n,1))
+        """
+        if self.mesh_size_method == 'global' and method == 'generic':
+            return np.full(np.broadcast(d, r).shape, self.mesh_size)
+
+        ratio = r / self.rref
+        size_in = self.size_in * ratio
+        ## copymesh scales the whole reference sphere mesh, generic only scales size_in
+        size_out = self.size_out * ratio if method == 'copymesh' else self.size_out
+
+        dmin = self.rad_min_factor * r
+        dmax = self.rad_max_factor * r
+        t = np.clip((d - dmin) / np.maximum(dmax - dmin, 1e-12 * r), 0.0, 1.0)
+        return size_in + t * (size_out - size_in)
+
+    def bead_integrals(self, method):
+        """
+        Integrals of 1/h^3 over the beads, and of (1/h^3 - 1/size_out^3) over
+        the threshold region outside the beads.
+        """
+        r = self.radii[:, None]
+        d = r * QUAD_NODES[None, :]
+        inside = np.sum(4 * pi * d**2 / self.bead_size(d, r, method)**3 * QUAD_WEIGHTS, axis=1) * self.radii
+
+        if method == 'copymesh' or self.mesh_size_method == 'global':
+            return inside.sum(), 0.0
+
+        dmax = np.maximum(self.rad_max_factor, 1.0) * r
+        d = r + (dmax - r) * QUAD_NODES[None, :]
+        excess = 4 * pi * d**2 * (1 / self.bead_size(d, r, method)**3 - 1 / self.size_out**3)
+        outside = np.sum(excess * QUAD_WEIGHTS, axis=1) * (dmax - r)[:, 0]
+
+        return inside.sum(), outside.sum()
+
+    def wall_integral(self):
+        """
+        Integral of (1/h^3 - 1/size_away^3) over the threshold band along the
+        container walls (copymesh), approximated as a thin shell.
+        """
+        delta = np.array([0.0, self.dist_min, self.dist_max])
+        size = np.array([self.size_on, self.size_on, self.size_away])
+        s = self.dist_max * QUAD_NODES
+        excess = 1 / np.interp(s, delta, size)**3 - 1 / self.size_away**3
+        return self.container_area * self.dist_max * np.sum(excess * QUAD_WEIGHTS)
+
+    def estimate(self, method):
+        """
+        Node/element counts, peak memory and time for a mesh method
+        """
+        inside, outside = self.bead_integrals(method)
+
+        ## Bead surface mesh size
+        surface_size = self.bead_size(self.radii, self.radii, method)
+        bead_triangles = TRIANGLES_PER_AREA * np.sum(4 * pi * self.radii**2 / surface_size**2)
+
+        if method == 'generic':
+            far_size = self.mesh_size if self.mesh_size_method == 'global' else self.size_out
+            container_triangles = TRIANGLES_PER_AREA * self.container_area / far_size**2
+            interstitial = self.interstitial_volume / far_size**3 + outside
+        else:
+            container_triangles = TRIANGLES_PER_AREA * self.container_area / self.size_on**2
+            porosity = self.interstitial_volume / self.container_volume if self.container_volume else 1.0
+            interstitial = self.interstitial_volume / self.size_away**3 + porosity * self.wall_integral()
+
+        bead_tetrahedra = TETRAHEDRA_PER_VOLUME * inside
+        interstitial_tetrahedra = TETRAHEDRA_PER_VOLUME * interstitial
+
+        volume_mesh = self.mesh_generate >= 3
+        if method == 'copymesh' and self.copymesh_ref_dim < 3:
+            bead_tetrahedra = 0.0
+        if not volume_mesh:
+            bead_tetrahedra = interstitial_tetrahedra = 0.0
+
+        triangles = bead_triangles + container_triangles
+        tetrahedra = bead_tetrahedra + interstitial_tetrahedra
+        nodes = tetrahedra / TETRAHEDRA_PER_NODE if volume_mesh else triangles / 2
+
+        memory = COSTS['base_memory'] + COSTS['bytes_per_triangle'] * triangles + COSTS['bytes_per_tetrahedron'] * tetrahedra
+        time = 0.0
+        if method == 'generic':
+            memory += COSTS['bytes_per_bead_occ'] * len(self.radii)
+            time += COSTS['fragment_seconds_per_bead'] * len(self.radii)
+            time += triangles / (COSTS['triangles_per_second'] * self.threads2D)
+            time += tetrahedra / (COSTS['tetrahedra_per_second'] * self.threads3D)
+        else:
+            copied = bead_triangles + bead_tetrahedra
+            memory += COSTS['bytes_per_copied_element'] * copied
+            time += copied / COSTS['elements_copied_per_second']
+            time += container_triangles / (COSTS['triangles_per_second'] * self.threads2D)
+            time += interstitial_tetrahedra / (COSTS['tetrahedra_per_second'] * self.threads3D)
+
+        time += (triangles + tetrahedra) / COSTS['elements_written_per_second']
+
+        return {
+            'bead_triangles': int(bead_triangles),
+            'container_triangles': int(container_triangles),
+            'bead_tetrahedra': int(bead_tetrahedra),
+            'interstitial_tetrahedra': int(interstitial_tetrahedra),
+            'nodes': int(nodes),
+            'elements': int(triangles + tetrahedra),
+            'peak_memory_gb': memory / 1e9,
+            'time_s': time,
+        }
+
+    def report(self):
+        return {
+            'mesh_method': self.mesh_method,
+            'mesh_size_method': self.mesh_size_method,
+            'mesh_generate': self.mesh_generate,
+            'nbeads': len(self.radii),
+            'bead_volume': self.bead_volume,
+            'bead_surface_area': self.bead_area,
+            'container_volume': self.container_volume,
+            'container_surface_area': self.container_area,
+            'interstitial_volume': self.interstitial_volume,
+            'threads2D': self.threads2D,
+            'threads3D': self.threads3D,
+            'costs': COSTS,
+            'estimates': self.estimates,
+        }
+
+    def print(self):
+        from rich.table import Table
+
+        table = Table(title=f"Mesh estimate: {len(self.radii)} beads, mesh.generate = {self.mesh_generate}")
+        table.add_column('', justify='left')
+        for method in self.estimates:
+            table.add_column(method + (' (configured)' if method == self.mesh_method else ''), justify='right')
+
+        for key in self.estimates['generic']:
+            values = [ self.estimates[method][key] for method in self.estimates ]
+            if key == 'peak_memory_gb':
+                row = [ f"{v:.2f}" for v in values ]
+            elif key == 'time_s':
+                row = [ f"{v/3600:.2f} h" if v > 3600 else f"{v:.0f} s" for v in values ]
+            else:
+                row = [ f"{v:,}" for v in values ]
+            table.add_row(key, *row)
+
+        Logger.console.print(table)
+
+    def write(self, fname):
+        with open(fname, 'w') as fp:
+            json.dump(self.report(), fp, indent=4)
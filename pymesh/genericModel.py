@@ -11,15 +11,26 @@ from pymesh.packedBed import PackedBed
 from pymesh.container import Container
 from pymesh.column import Column
 from pymesh.log import Logger
+from pymesh.quality import MeshQuality
+from pymesh.renumber import MeshRenumbering
+from pymesh.partition import MeshPartitioning
+from pymesh.hdf5 import HDF5Exporter
+from pymesh.checkpoint import GeometryCheckpoint
+from pymesh.levels import MeshHierarchy
+from pymesh.recovery import BooleanRecovery
+from pymesh.sizefield import GapSizeField
+from pymesh.estimate import MeshEstimate
+from pymesh.lazy import lazy_import
 
 import sys
 
-import gmsh
 from pathlib import Path
 
+gmsh = lazy_import('gmsh')
+
 class GenericModel:
 
-    def __init__(self, config, logger=Logger(level=0)):
+    def __init__(self, config, packing=None, original_index=None, logger=Logger(level=0)):
 
         self.logger = logger
         self.logger.out("Initializing Model")
@@ -38,19 +49,56 @@ class GenericModel:
         self.mesh_size             = config.mesh_size
         self.mesh_size_method      = config.mesh_size_method
         self.mesh_generate         = config.mesh_generate
+        self.mesh_quality          = config.mesh_quality
+        self.mesh_renumber         = config.mesh_renumber
+        self.mesh_levels           = config.mesh_levels
+        if self.mesh_levels > 1:
+            self.mesh_levels_method = config.mesh_levels_method
+            self.mesh_levels_ratio  = config.mesh_levels_ratio
+
+        self.hdf5 = HDF5Exporter(config.output_hdf5_float32, config.output_hdf5_compression, logger=self.logger)
+
+        self.partitioning = None
+        if config.output_partitions_number > 1:
+            self.partitioning = MeshPartitioning(config.output_partitions_number, config.output_partitions_method, config.output_partitions_ghost_cells, logger=self.logger)
+        self.nproc                 = config.general_nproc
         self.center_bed_in_container = config.general_center_bed_in_container
 
         self.fragment_format       = config.output_fragment_format if config.output_fragment_format[0] == '.' else f".{config.output_fragment_format}"
 
-        self.packedBed = PackedBed(config, generate=False)
+        ## Geometry checkpoints need the separated surfaces and volumes of a fragmented column
+        self.checkpoint = None
+        if config.general_checkpoint and self.container_shape and config.general_fragment:
+            self.checkpoint = GeometryCheckpoint(config, logger=self.logger)
+
+        sections = self.checkpoint.load(self) if self.checkpoint else None
+        if sections:
+            self.resume(config, sections)
+        elif config.recovery_enabled:
+            BooleanRecovery(config, logger=self.logger).build(self, packing, original_index)
+        else:
+            self.build(config, packing, original_index=original_index)
+
+        if self.checkpoint and not sections:
+            self.checkpoint.save(self, self.sections())
+
+    def build(self, config, packing=None, fit=True, original_index=None):
+        """
+        Create the packed bed and the column sections in the current gmsh model.
+
+        @input: packing, original_index as in PackedBed(). fit=False skips centering the bed
+            in the container and snapping beads to its walls, for packings
+            that are already fitted.
+        """
+        self.packedBed = PackedBed(config, generate=False, packing=packing, original_index=original_index)
 
         # if not config.container_shape:
         #     return
 
         column_container = Container(self.container_shape, self.container_size, generate=False)
 
-        if self.center_bed_in_container:
-            self.packedBed.center_bed_in_bounds(column_container.get_bounds())
+        if fit:
+            self.packedBed.fit_to_container(column_container)
 
         self.packedBed.generate()
         column_container.generate()
@@ -65,16 +113,18 @@ class GenericModel:
         ##      ALL the container walls, regardless of what the periodicity
         ##      actually is, as long as it's not an empty string.
         if column_periodicity:
-            self.logger.out('Stacking packed bed')
-            if self.stack_method == 'planecut':
-                self.packedBed.stack_by_plane_cuts(column_container)
-            elif self.stack_method == 'all':
-                self.packedBed.stack_all(column_periodicity, column_container.dx, column_container.dy, column_container.dz)
-            elif self.stack_method == 'volumecut':
-                if self.container_linked:
-                    self.logger.die("ConfigError: container.stack_method = volumecut cannot be used with container.linked = True")
-                else:
-                    self.packedBed.stack_by_volume_cuts(column_container)
+            with self.logger.stage('Stacking packed bed'):
+                if self.stack_method == 'planecut':
+                    self.packedBed.stack_by_plane_cuts(column_container)
+                elif self.stack_method == 'all':
+                    self.packedBed.stack_all(column_periodicity, column_container.dx, column_container.dy, column_container.dz)
+                elif self.stack_method == 'volumecut':
+                    if self.container_linked:
+                        self.logger.die("ConfigError: container.stack_method = volumecut cannot be used with container.linked = True")
+                    else:
+                        self.packedBed.stack_by_volume_cuts(column_container)
+
+        self.packedBed.modify()
 
         self.packedBed.write('beads_used.xyzd')
 
@@ -88,9 +138,9 @@ class GenericModel:
                 self.inlet_length
                 ]
 
-            self.logger.out('Creating inlet column section')
-            inlet_container = Container('box', inlet_size)
-            self.inlet = Column(inlet_container, self.packedBed, fragment=config.general_fragment, copy=True, periodicity=inout_periodicity)
+            with self.logger.stage('Creating inlet column section'):
+                inlet_container = Container('box', inlet_size)
+                self.inlet = Column(inlet_container, self.packedBed, fragment=config.general_fragment, copy=True, periodicity=inout_periodicity)
 
             outlet_size = [
                self.container_size[0],
@@ -100,39 +150,115 @@ class GenericModel:
                self.container_size[4],
                self.outlet_length
                ]
-            self.logger.out('Creating outlet column section')
-            outlet_container = Container('box', outlet_size)
-            self.outlet = Column(outlet_container, self.packedBed, fragment=config.general_fragment, copy=True, periodicity=inout_periodicity)
+            with self.logger.stage('Creating outlet column section'):
+                outlet_container = Container('box', outlet_size)
+                self.outlet = Column(outlet_container, self.packedBed, fragment=config.general_fragment, copy=True, periodicity=inout_periodicity)
+
+        with self.logger.stage('Creating central column section'):
+            self.column = Column(column_container, self.packedBed, fragment=config.general_fragment, copy=False, periodicity=column_periodicity, endFaceSections=config.container_end_face_sections)
+
+        self.setup_gap_field(config, column_container)
+
+    def setup_gap_field(self, config, column_container):
+        """
+        Gaps include the stacked copies. The threshold field estimate is the reference for the report.
+        """
+        if self.mesh_size_method == 'gap':
+            self.gap_field = GapSizeField(config, self.packedBed.to_array(), column_container, logger=self.logger)
+            reference = MeshEstimate(config, self.packedBed, column_container).estimates['generic']
+            self.gap_field_reference = reference['bead_tetrahedra'] + reference['interstitial_tetrahedra']
 
-        self.logger.out('Creating central column section')
-        self.column = Column(column_container, self.packedBed, fragment=config.general_fragment, copy=False, periodicity=column_periodicity, endFaceSections=config.container_end_face_sections)
+    def sections(self):
+        """
+        Column sections of the model: { name: Column }
+        """
+        sections = { 'column': self.column }
+        if self.container_linked:
+            sections.update({ 'inlet': self.inlet, 'outlet': self.outlet })
+        return sections
+
+    def resume(self, config, sections):
+        """
+        Use the packed bed and column sections restored from a geometry checkpoint instead of building them
+        """
+        self.column = sections['column']
+        if self.container_linked:
+            self.inlet = sections['inlet']
+            self.outlet = sections['outlet']
+
+        self.packedBed.write('beads_used.xyzd')
+        self.setup_gap_field(config, self.column.container)
 
     def set_mesh_size(self):
-        self.logger.out("Setting mesh size")
-        if self.mesh_size_method == 'field':
-            self.packedBed.set_mesh_fields()
-        elif self.mesh_size_method == 'global':
-            modelEntities = gmsh.model.getEntities()
-            gmsh.model.mesh.setSize(modelEntities, self.mesh_size)
+        with self.logger.stage("Setting mesh size"):
+            if self.mesh_size_method == 'field':
+                self.packedBed.set_mesh_fields()
+            elif self.mesh_size_method == 'global':
+                modelEntities = gmsh.model.getEntities()
+                gmsh.model.mesh.setSize(modelEntities, self.mesh_size)
+            elif self.mesh_size_method == 'gap':
+                self.gap_field.estimate(self.gap_field_reference)
+                self.gap_field.print()
+                self.gap_field.write(Path(self.fname).stem + '.sizefield.json')
+                self.gap_field.apply()
 
     def mesh(self):
         gmsh.model.occ.synchronize()
         self.set_mesh_size()
-        self.logger.out("Meshing")
-        gmsh.model.mesh.generate(self.mesh_generate)
+        with self.logger.stage("Meshing"):
+            gmsh.model.mesh.generate(self.mesh_generate)
+        if self.mesh_quality:
+            self.check_quality()
+
+    def mesh_hierarchy(self):
+        """
+        Mesh and write every level of a mesh hierarchy (mesh.levels), reported in <basename>.levels.json
+        """
+        hierarchy = MeshHierarchy(self.mesh_levels, self.mesh_levels_method, self.mesh_levels_ratio, logger=self.logger).run(self)
+
+        hierarchy.print()
+        hierarchy.write(Path(self.fname).stem + '.levels.json')
+
+    def check_quality(self, fname=None):
+        """
+        Element quality per column section and group, written to <basename>.quality.json
+        """
+        fname = fname or self.fname
+        columns = self.sections()
+
+        with self.logger.stage("Checking mesh quality"):
+            quality = MeshQuality(MeshQuality.column_groups(columns), nthreads=self.nproc, logger=self.logger).run()
+
+        quality.print()
+        quality.write(Path(fname).stem + '.quality.json')
+
+    def renumber(self, fname=None):
+        """
+        Bandwidth-reducing renumbering of all nodes and elements, reported in <basename>.renumber.json
+        """
+        fname = fname or self.fname
+        with self.logger.stage("Renumbering mesh"):
+            renumbering = MeshRenumbering(self.mesh_renumber, logger=self.logger).run()
+
+        renumbering.print()
+        renumbering.write(Path(fname).stem + '.renumber.json')
+
+    def write(self, fname=None):
+        fname = fname or self.fname
+        basename = Path(fname).stem
+        extension = Path(fname).suffix
 
-    def write(self):
-        basename = Path(self.fname).stem
-        extension = Path(self.fname).suffix
+        if self.mesh_renumber:
+            self.renumber(fname)
 
         if not self.container_shape:
-            self.logger.out("Writing full mesh")
-            gmsh.write(self.fname)
+            with self.logger.stage("Writing full mesh"):
+                gmsh.write(fname)
             return
 
-        self.column.write(basename + '_column' + extension, fragmentFormat=self.fragment_format)
+        self.column.write(basename + '_column' + extension, fragmentFormat=self.fragment_format, partitioning=self.partitioning, hdf5=self.hdf5)
 
         if self.container_linked :
-            self.inlet.write(basename + '_inlet' + extension, fragmentFormat=self.fragment_format)
-            self.outlet.write(basename + '_outlet' + extension, fragmentFormat=self.fragment_format)
+            self.inlet.write(basename + '_inlet' + extension, fragmentFormat=self.fragment_format, partitioning=self.partitioning, hdf5=self.hdf5)
+            self.outlet.write(basename + '_outlet' + extension, fragmentFormat=self.fragment_format, partitioning=self.partitioning, hdf5=self.hdf5)
 
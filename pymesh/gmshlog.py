@@ -0,0 +1,147 @@
+"""
+GmshLogCapture class
+
+contract:
+    - must write gmsh's messages to the gmsh log file as they are emitted, not at the end of the run
+    - must keep a bounded amount of them in memory, however long the run
+    - must tag every message with the pymesh stage running when it was emitted
+
+gmsh prints its messages to stdout (info) and stderr (warnings, errors) with
+General.Terminal = 1. The capture points file descriptors 1 and 2 at pipes,
+drained by one background thread each: every line is echoed to the original
+terminal, and written to the log file as
+
+    [  12.3 s] [Meshing] Info    : Meshing 3D...
+
+with the time since the start of the run and the innermost Logger stage.
+Python's sys.stdout and sys.stderr are pointed at the original terminal
+while capturing, so that pymesh's own output stays out of the gmsh log.
+
+The last info message of gmsh, and its progress ("[ 40%] Meshing surface
+12") if any, are kept in Logger.last_progress for the watchdog.
+
+NOTE: gmsh.logger isn't used: its messages pile up in memory until get() is
+    called, and calling get() from another thread while gmsh is meshing is
+    not thread safe. Output of other C libraries is captured as well.
+"""
+
+from pymesh.log import Logger
+
+import os
+import re
+import sys
+import threading
+import time
+
+## Bytes read from a pipe at once, and longest line kept before it's written out incomplete
+READ_SIZE = 1 << 16
+MAX_LINE = 1 << 20
+
+GMSH_PROGRESS = re.compile(r'^Info\s*:\s*(?:\[\s*(\d+)%\]\s*)?(.*)$')
+
+class GmshLogCapture:
+
+    def __init__(self, fname, logger=Logger(level=1)):
+        self.logger = logger
+        self.fname = fname
+        self.logfile = None
+        self.lock = threading.Lock()
+        self.streams = []
+
+    def tag(self):
+        stage = Logger.stages[-1] if Logger.stages else ''
+        return f"[{time.perf_counter() - Logger.start_time:8.1f} s] [{stage}] "
+
+    def drain(self, fd, terminal):
+        """
+        Copy everything written to the pipe fd to the terminal, and its lines to the log file
+        """
+        partial = b''
+        while True:
+            data = os.read(fd, READ_SIZE)
+            if not data:
+                break
+            os.write(terminal, data)
+
+            *lines, partial = (partial + data).split(b'\n')
+            if len(partial) > MAX_LINE:
+                lines, partial = lines + [ partial ], b''
+            self.write(lines)
+
+        self.write([ partial ] if partial else [])
+        os.close(fd)
+
+    def write(self, lines):
+        if not lines:
+            return
+        tag = self.tag()
+        lines = [ line.decode(errors='replace').rstrip('\r') for line in lines ]
+        with self.lock:
+            self.logfile.write("".join(tag + line + "\n" for line in lines))
+        self.progress(lines)
+
+    @staticmethod
+    def progress(lines):
+        """
+        Record the last info message of gmsh in Logger.last_progress
+        """
+        for line in reversed(lines):
+            match = GMSH_PROGRESS.match(line)
+            if match:
+                percent, message = match.groups()
+                Logger.last_progress = {
+                    'stage': Logger.stages[-1] if Logger.stages else None,
+                    'what': 'gmsh',
+                    'message': message,
+                    'percent': int(percent) if percent else None,
+                    'time': time.perf_counter() - Logger.start_time,
+                }
+                return
+
+    def start(self):
+        """
+        Redirect stdout and stderr to the log file and terminal
+        """
+        self.logfile = open(self.fname, 'w', buffering=1)
+
+        for stream, fd in [ (sys.stdout, 1), (sys.stderr, 2) ]:
+            stream.flush()
+            terminal = os.dup(fd)
+            readfd, writefd = os.pipe()
+            os.dup2(writefd, fd)
+            os.close(writefd)
+
+            thread = threading.Thread(target=self.drain, args=(readfd, terminal), daemon=True, name=f"gmsh-log-{fd}")
+            thread.start()
+            self.streams.append((stream, fd, terminal, thread))
+
+        sys.stdout = os.fdopen(os.dup(self.streams[0][2]), 'w', buffering=1)
+        sys.stderr = os.fdopen(os.dup(self.streams[1][2]), 'w', buffering=1)
+
+        return self
+
+    def stop(self):
+        """
+        Restore stdout and stderr, and write the rest of the captured messages
+        """
+        for stream, fd, terminal, thread in self.streams:
+            ## Closes the last write end of the pipe: the thread reads to the end and exits
+            os.dup2(terminal, fd)
+            thread.join(timeout=10)
+            if thread.is_alive():
+                self.logger.warn(f"{self.fname} may be incomplete: fd {fd} is still open in another process")
+            os.close(terminal)
+
+        if self.streams:
+            sys.stdout.close()
+            sys.stderr.close()
+            sys.stdout, sys.stderr = self.streams[0][0], self.streams[1][0]
+            self.streams = []
+
+        self.logfile.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
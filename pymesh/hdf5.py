@@ -0,0 +1,207 @@
+"""
+HDF5Exporter class
+
+contract:
+    - must write the physical groups of the current gmsh model to HDF5, with an XDMF descriptor for ParaView/VisIt
+    - must stream the mesh entity by entity into chunked, compressed datasets: no full copy of the mesh in memory
+    - must allow reading one physical group without reading the others
+    - h5py is optional: it's only needed when writing .h5 files
+
+Layout of <file>.h5:
+
+    /nodes/coordinates                          (N,3) float64, or float32 with float32=True
+    /nodes/tags                                 (N,) gmsh node tags
+    /<surfaces|volumes|...>/<group>/<type>/connectivity   (K,n) rows of /nodes/coordinates
+    /<surfaces|volumes|...>/<group>/<type>/tags           (K,) gmsh element tags
+    /<surfaces|volumes|...>/<group>/<type>/entities       (K,) gmsh entity of every element
+
+Groups are named after the physical groups (attributes: dim, tag), and <type>
+after the gmsh element type (e.g. tetrahedron_4). Like gmsh.write(), only the
+elements of physical groups are written, and only the nodes of their entities
+and boundaries. Every node is written once.
+
+NOTE: Node ordering within higher order elements is gmsh's, which differs
+    from XDMF's for some types (e.g. Tetrahedron_10).
+"""
+
+from pymesh.log import Logger
+from pymesh.lazy import lazy_import
+
+from pathlib import Path
+from xml.etree import ElementTree
+from xml.dom import minidom
+
+import numpy as np
+
+gmsh = lazy_import('gmsh')
+h5py = lazy_import('h5py')
+
+HDF5_SUFFIXES = [ '.h5', '.hdf5' ]
+
+## Rows per chunk of the 2D datasets: ~1 MB chunks for tetrahedra
+CHUNK_ROWS = 32768
+
+DIM_NAMES = { 0: 'points', 1: 'curves', 2: 'surfaces', 3: 'volumes' }
+
+## gmsh element type: (XDMF topology type, nodes per element)
+XDMF_TOPOLOGIES = {
+    1: ('Polyline', 2),
+    2: ('Triangle', 3),
+    3: ('Quadrilateral', 4),
+    4: ('Tetrahedron', 4),
+    5: ('Hexahedron', 8),
+    6: ('Wedge', 6),
+    7: ('Pyramid', 5),
+    8: ('Edge_3', 3),
+    9: ('Triangle_6', 6),
+    11: ('Tetrahedron_10', 10),
+    15: ('Polyvertex', 1),
+}
+
+class HDF5Exporter:
+
+    def __init__(self, float32=False, compression=4, logger=Logger(level=1)):
+        """
+        @input:
+            - float32: store node coordinates in single precision
+            - compression: gzip level (0-9) of all datasets. 0 disables compression.
+        """
+        self.logger = logger
+        self.float32 = float32
+        self.compression = compression
+
+    def dataset(self, group, name, shape, dtype):
+        """
+        Empty resizable dataset, chunked along the first axis
+        """
+        chunks = (CHUNK_ROWS,) + tuple(shape[1:])
+        options = { 'compression': 'gzip', 'compression_opts': self.compression, 'shuffle': True } if self.compression else {}
+        return group.create_dataset(name, shape=(0,) + tuple(shape[1:]), maxshape=(None,) + tuple(shape[1:]), dtype=dtype, chunks=chunks, **options)
+
+    @staticmethod
+    def append(dataset, values):
+        start = dataset.shape[0]
+        dataset.resize(start + len(values), axis=0)
+        dataset[start:] = values
+
+    def physical_groups(self):
+        """
+        (dim, tag, name, entities) of all physical groups of the current model
+        """
+        groups = []
+        for dim, tag in gmsh.model.getPhysicalGroups():
+            name = gmsh.model.getPhysicalName(dim, tag) or str(tag)
+            groups.append((dim, tag, name, list(gmsh.model.getEntitiesForPhysicalGroup(dim, tag))))
+        return groups
+
+    def write_nodes(self, h5, groups):
+        """
+        Stream the nodes of the groups' entities and their boundaries
+
+        @output: lookup table from node tags to rows of /nodes/coordinates
+        """
+        entities = set((dim, tag) for dim, _, _, tags in groups for tag in tags)
+        if entities:
+            entities |= set(gmsh.model.getBoundary(list(entities), combined=False, oriented=False, recursive=True))
+        ## Boundary tags can be negative, even unoriented
+        entities = sorted(set((dim, abs(tag)) for dim, tag in entities))
+
+        nodes = h5.create_group('nodes')
+        coordinates = self.dataset(nodes, 'coordinates', (0, 3), np.float32 if self.float32 else np.float64)
+        tags = self.dataset(nodes, 'tags', (0,), np.int64)
+
+        lookup = np.full(int(gmsh.model.mesh.getMaxNodeTag()) + 1, -1, dtype=np.int64)
+        for dim, tag in entities:
+            nodeTags, coords, _ = gmsh.model.mesh.getNodes(dim, tag, returnParametricCoord=False)
+            nodeTags, first = np.unique(np.asarray(nodeTags, dtype=np.int64), return_index=True)
+            new = lookup[nodeTags] < 0
+            if not new.any():
+                continue
+            lookup[nodeTags[new]] = tags.shape[0] + np.arange(new.sum())
+            self.append(coordinates, np.reshape(coords, (-1, 3))[first[new]])
+            self.append(tags, nodeTags[new])
+
+        return lookup
+
+    def write_group(self, h5, dim, tag, name, entities, lookup):
+        """
+        Stream the elements of a physical group, per entity and element type
+
+        @output: HDF5 group, { element type: number of elements }
+        """
+        parent = h5.require_group(DIM_NAMES.get(dim, f"dim{dim}"))
+        group = parent.create_group(name if name not in parent else f"{name}_{tag}")
+        group.attrs['dim'] = dim
+        group.attrs['tag'] = tag
+
+        counts = {}
+        for entity in entities:
+            elementTypes, elementTags, nodeTags = gmsh.model.mesh.getElements(dim, entity)
+            for elementType, etags, ntags in zip(elementTypes, elementTags, nodeTags):
+                typename, _, _, numNodes, _, _ = gmsh.model.mesh.getElementProperties(elementType)
+                key = typename.lower().replace(' ', '_')
+                if key not in group:
+                    subgroup = group.create_group(key)
+                    subgroup.attrs['gmsh_type'] = elementType
+                    self.dataset(subgroup, 'connectivity', (0, numNodes), np.int64)
+                    self.dataset(subgroup, 'tags', (0,), np.int64)
+                    self.dataset(subgroup, 'entities', (0,), np.int32)
+
+                subgroup = group[key]
+                rows = lookup[np.reshape(np.asarray(ntags, dtype=np.int64), (-1, numNodes))]
+                self.append(subgroup['connectivity'], rows)
+                self.append(subgroup['tags'], np.asarray(etags, dtype=np.int64))
+                self.append(subgroup['entities'], np.full(len(etags), entity, dtype=np.int32))
+                counts[elementType] = counts.get(elementType, 0) + len(etags)
+
+        return group, counts
+
+    def write_xdmf(self, fname, h5name, nnodes, blocks):
+        """
+        XDMF descriptor: one grid per physical group and element type, sharing the node coordinates
+        """
+        xdmf = ElementTree.Element('Xdmf', Version='3.0')
+        domain = ElementTree.SubElement(xdmf, 'Domain')
+        collection = ElementTree.SubElement(domain, 'Grid', Name=Path(fname).stem, GridType='Collection', CollectionType='Spatial')
+
+        precision = '4' if self.float32 else '8'
+        for path, elementType, count in blocks:
+            if elementType not in XDMF_TOPOLOGIES:
+                self.logger.warn(f"No XDMF topology for gmsh element type {elementType}: {path} is only in the HDF5 file")
+                continue
+            topologyType, numNodes = XDMF_TOPOLOGIES[elementType]
+
+            grid = ElementTree.SubElement(collection, 'Grid', Name=path.strip('/').replace('/', ':'), GridType='Uniform')
+            topology = ElementTree.SubElement(grid, 'Topology', TopologyType=topologyType, NumberOfElements=str(count))
+            if topologyType in ('Polyline', 'Polyvertex'):
+                topology.set('NodesPerElement', str(numNodes))
+            item = ElementTree.SubElement(topology, 'DataItem', Dimensions=f"{count} {numNodes}", NumberType='Int', Precision='8', Format='HDF')
+            item.text = f"{h5name}:{path}/connectivity"
+
+            geometry = ElementTree.SubElement(grid, 'Geometry', GeometryType='XYZ')
+            item = ElementTree.SubElement(geometry, 'DataItem', Dimensions=f"{nnodes} 3", NumberType='Float', Precision=precision, Format='HDF')
+            item.text = f"{h5name}:/nodes/coordinates"
+
+        Path(fname).with_suffix('.xdmf').write_text(minidom.parseString(ElementTree.tostring(xdmf)).toprettyxml(indent='  '))
+
+    def write(self, fname):
+        """
+        Write the physical groups of the current model to fname (.h5) and <stem>.xdmf
+        """
+        groups = self.physical_groups()
+        blocks = []
+
+        with h5py.File(fname, 'w') as h5:
+            h5.attrs['generator'] = 'pymesh'
+            lookup = self.write_nodes(h5, groups)
+
+            for dim, tag, name, entities in groups:
+                group, counts = self.write_group(h5, dim, tag, name, entities, lookup)
+                for elementType, count in counts.items():
+                    key = next(k for k in group if group[k].attrs['gmsh_type'] == elementType)
+                    blocks.append((group[key].name, elementType, count))
+
+            nnodes = h5['nodes/tags'].shape[0]
+
+        self.write_xdmf(fname, Path(fname).name, nnodes, blocks)
+        self.logger.out(f"Wrote {nnodes} nodes and {sum(count for _, _, count in blocks)} elements in {len(groups)} groups to {fname}")
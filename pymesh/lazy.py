@@ -0,0 +1,64 @@
+"""
+Lazy imports
+
+contract:
+    - importing a module lazily must not execute it
+    - the module must be loaded on first attribute access
+    - missing modules must only fail when used, so that tools which don't need them still run
+"""
+
+import importlib.util
+import sys
+import types
+
+class MissingModule(types.ModuleType):
+    """
+    Placeholder for a module that isn't installed. Raises on any attribute access.
+    """
+    def __getattr__(self, attr):
+        raise ModuleNotFoundError(f"No module named '{self.__name__}' (needed for {self.__name__}.{attr})", name=self.__name__)
+
+class UnloadOnError:
+    """
+    Loader wrapper that removes a module from sys.modules if executing it fails,
+    as a failed eager import would. Otherwise the half-executed module would stay
+    importable. (e.g. gmsh, when its shared library can't be loaded)
+    """
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        try:
+            self.loader.exec_module(module)
+        except BaseException:
+            sys.modules.pop(module.__name__, None)
+            raise
+
+def lazy_import(name):
+    """
+    Import a module without executing it. The module is executed on first attribute access.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return MissingModule(name)
+
+    loader = importlib.util.LazyLoader(UnloadOnError(spec.loader))
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def is_loaded(name):
+    """
+    True if the module has been imported and actually executed.
+    NOTE: type() is used, since any attribute access on a lazy module loads it.
+    """
+    module = sys.modules.get(name)
+    return module is not None and type(module) not in (importlib.util._LazyModule, MissingModule)
@@ -0,0 +1,128 @@
+"""
+MeshHierarchy class
+
+contract:
+    - must mesh the geometry of a model at several resolutions, without rebuilding the geometry
+    - must write every level with the model's usual outputs
+    - must report element counts and timings per level
+
+regenerate: every level is meshed from scratch with all mesh sizes (global
+    size, threshold or gap fields) divided by ratio**level, through
+    Mesh.MeshSizeFactor. Levels are not nested, but element quality is
+    the same at all levels.
+
+refine: level 0 is meshed as usual, and every finer level splits all
+    elements of the previous one uniformly (gmsh.model.mesh.refine), which
+    halves the element size and multiplies the number of tetrahedra by 8.
+    Levels are nested: the nodes of a level are nodes of all finer levels.
+
+Level 0 is the coarsest, at the configured mesh size. Level k is written to
+<output stem>_level<k><output suffix>, and all other outputs (sections,
+fragments, partitions, quality, renumbering) follow that name. Counts and
+timings are written to <output stem>.levels.json.
+
+NOTE: Counts are of the whole model: the inlet and outlet sections of linked
+    columns are included.
+"""
+
+from pymesh.log import Logger
+from pymesh.lazy import lazy_import
+
+from pathlib import Path
+
+import json
+
+gmsh = lazy_import('gmsh')
+
+class MeshHierarchy:
+
+    def __init__(self, number, method='regenerate', ratio=2.0, logger=Logger(level=1)):
+        """
+        @input:
+            - number: number of levels
+            - method: 'regenerate' or 'refine'
+            - ratio: element size ratio between consecutive levels (regenerate only, refine always halves the size)
+        """
+        self.logger = logger
+        self.number = number
+        self.method = method
+        self.ratio = 2.0 if method == 'refine' else ratio
+        self.levels = []
+
+    def size_factor(self, level):
+        return self.ratio ** -level
+
+    def run(self, model):
+        """
+        Mesh and write all levels of model, a built GenericModel
+        """
+        gmsh.model.occ.synchronize()
+        model.set_mesh_size()
+
+        stem, suffix = Path(model.fname).stem, Path(model.fname).suffix
+        factor = gmsh.option.getNumber('Mesh.MeshSizeFactor')
+
+        try:
+            for level in range(self.number):
+                fname = f"{stem}_level{level}{suffix}"
+
+                with self.logger.stage("Meshing level") as meshing:
+                    meshing['level'] = level
+                    if level == 0 or self.method == 'regenerate':
+                        gmsh.option.setNumber('Mesh.MeshSizeFactor', factor * self.size_factor(level))
+                        gmsh.model.mesh.clear()
+                        gmsh.model.mesh.generate(model.mesh_generate)
+                    else:
+                        gmsh.model.mesh.refine()
+
+                if model.mesh_quality:
+                    model.check_quality(fname)
+
+                with self.logger.stage("Writing level") as writing:
+                    writing['level'] = level
+                    model.write(fname)
+
+                self.levels.append({
+                    'level': level,
+                    'size_factor': self.size_factor(level),
+                    'file': fname,
+                    'nodes': meshing.get('nodes'),
+                    'triangles': meshing.get('triangles'),
+                    'tetrahedra': meshing.get('tetrahedra'),
+                    'mesh_time': meshing['wall_time'],
+                    'write_time': writing['wall_time'],
+                    'peak_rss_mb': meshing['peak_rss_mb'],
+                })
+
+                self.logger.out(f"Level {level}: {self.levels[-1]['tetrahedra']} tetrahedra in {meshing['wall_time']:.1f} s")
+        finally:
+            gmsh.option.setNumber('Mesh.MeshSizeFactor', factor)
+
+        return self
+
+    def print(self):
+        from rich.table import Table
+
+        table = Table(title=f"Mesh levels ({self.method}, size ratio {self.ratio:g})")
+        for column in [ 'level', 'size factor', 'nodes', 'triangles', 'tetrahedra', 'mesh [s]', 'write [s]', 'peak RSS [MB]', 'file' ]:
+            table.add_column(column, justify='left' if column == 'file' else 'right')
+
+        count = lambda n: f"{n:,}" if n is not None else ''
+        for level in self.levels:
+            table.add_row(
+                str(level['level']),
+                f"{level['size_factor']:.4g}",
+                count(level['nodes']),
+                count(level['triangles']),
+                count(level['tetrahedra']),
+                f"{level['mesh_time']:.1f}",
+                f"{level['write_time']:.1f}",
+                f"{level['peak_rss_mb']:.0f}",
+                level['file'],
+            )
+
+        Logger.console.print(table)
+
+    def write(self, fname):
+        with open(fname, 'w') as fp:
+            json.dump({ 'method': self.method, 'ratio': self.ratio, 'levels': self.levels }, fp, indent=4)
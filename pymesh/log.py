@@ -1,29 +1,148 @@
 """
 Log class for pymesh
+
+contract:
+    - must stream every message to the log files as soon as they are opened (Logger.open)
+    - must keep only a bounded number of lines in memory
+    - must not format messages that nobody will see
+
+Messages logged before Logger.open() (e.g. while reading the config, before
+the output filename is known) are kept in ring buffers of BUFFER_LINES
+lines, which are written out when the files are opened. The files are line
+buffered, so they are complete up to the last message even if the process
+is killed.
+
+Loggers have a level (indentation, deeper for lower level classes). Messages
+of loggers above Logger.verbosity are only written to the log files, and
+debug() messages are dropped unformatted unless Logger.verbosity >= DEBUG_LEVEL.
+Any part of a message can be a callable, which is only called if the
+message is emitted:
+
+    logger.debug(lambda: f"Deleting bead {bead} with volume = {bead.volume()}")
+
+Long loops report their progress every Logger.progress_interval seconds
+(Logger.progress() and Progress). The latest progress of the run is kept in
+Logger.last_progress, for the heartbeat and diagnostics of the watchdog.
 """
 
-from rich import print as rprint
-from rich.console import Console
-from rich.theme import Theme
+from pymesh.lazy import is_loaded
+
+from collections import deque
+from contextlib import contextmanager
 
 import datetime
+import json
+import resource
+import sys
+import time
 
-class Logger:
-    log_out_all = []
-    log_err_all = []
-    timestamp = "." + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+## Lines of stdout and stderr kept in memory
+BUFFER_LINES = 10000
+
+## Verbosity needed for debug() messages
+DEBUG_LEVEL = 3
 
-    custom_theme = Theme({
+class LazyConsole:
+    """
+    Creates the rich console on first use. Importing rich takes longer than
+    the whole run of some of the analysis tools.
+    """
+    theme = {
         "info" : 'bold green',
         "note": "bold magenta",
+        "debug": "dim",
         "warn": "bold yellow",
         "error": "bold red"
-    })
-    console = Console(theme = custom_theme)
+    }
+
+    def __get__(self, obj, cls):
+        from rich.console import Console
+        from rich.theme import Theme
+        cls.console = Console(theme = Theme(self.theme))
+        return cls.console
+
+class Logger:
+    log_out_all = deque(maxlen=BUFFER_LINES)
+    log_err_all = deque(maxlen=BUFFER_LINES)
+    log_counts = { 'out': 0, 'err': 0 }
+    log_files = {}
+    verbosity = 2
+    perf_all = []
+    stages = []
+    active = []
+    progress_interval = 60
+    last_progress = {}
+    timestamp = "." + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    start_time = time.perf_counter()
+
+    console = LazyConsole()
 
     def __init__(self, level=0):
         self.level = level
 
+    @classmethod
+    def reset(cls):
+        """
+        Clear the recorded logs and stages, and restart the run clock.
+        Used when a process runs more than one model.
+        """
+        cls.close()
+        cls.log_out_all = deque(maxlen=BUFFER_LINES)
+        cls.log_err_all = deque(maxlen=BUFFER_LINES)
+        cls.log_counts = { 'out': 0, 'err': 0 }
+        cls.perf_all = []
+        cls.stages = []
+        cls.active = []
+        cls.last_progress = {}
+        cls.timestamp = "." + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        cls.start_time = time.perf_counter()
+
+    @classmethod
+    def open(cls, fname, timestamp=False):
+        """
+        Stream all further messages to <fname>.stdout.log and <fname>.stderr.log,
+        starting with the buffered ones
+        """
+        cls.close()
+        ts = cls.timestamp if timestamp else ''
+        for stream, buffer in [ ('out', cls.log_out_all), ('err', cls.log_err_all) ]:
+            path = fname + ts + f".std{stream}.log"
+            cls.log_files[stream] = open(path, 'w', buffering=1)
+            cls.log_files[stream].write(cls.dropped(stream) + "".join(line + "\n" for line in buffer))
+
+    @classmethod
+    def close(cls):
+        for logfile in cls.log_files.values():
+            logfile.close()
+        cls.log_files = {}
+
+    @classmethod
+    def dropped(cls, stream):
+        """
+        Note on the lines that fell out of the ring buffer before the log files were opened
+        """
+        buffer = cls.log_out_all if stream == 'out' else cls.log_err_all
+        ndropped = cls.log_counts[stream] - len(buffer)
+        return f"NOTE: {ndropped} earlier lines were not kept in memory\n" if ndropped > 0 else ''
+
+    @classmethod
+    def record(cls, stream, line):
+        cls.log_counts[stream] += 1
+        (cls.log_out_all if stream == 'out' else cls.log_err_all).append(line)
+        if stream in cls.log_files:
+            cls.log_files[stream].write(line + "\n")
+
+    @staticmethod
+    def format(message):
+        """
+        Call the callable parts of message
+        """
+        return [ m() if callable(m) else m for m in message ]
+
+    @property
+    def verbose(self):
+        return self.level <= Logger.verbosity
+
     def rule(self, *message):
         Logger.console.rule(*message)
 
@@ -31,36 +150,102 @@ class Logger:
         """
         Default print (without Text wrapper) to be able to print dicts and other stuff
         """
-        Logger.log_out_all.extend([str(i) for i in message])
-        rprint(*message)
+        message = self.format(message)
+        for m in message:
+            Logger.record('out', str(m))
+        if self.verbose:
+            from rich import print as rprint
+            rprint(*message)
 
     def out(self, *message, style=None):
         """
         Write to stdout
         """
-        Logger.log_out_all.append(" ".join(['INFO:' + "".join([' ']*self.level), *message]))
-        Logger.console.print('INFO    :' + "".join([' ']*self.level), *message, style=style or 'info')
+        message = self.format(message)
+        Logger.record('out', " ".join(['INFO:' + "".join([' ']*self.level), *message]))
+        if self.verbose:
+            Logger.console.print('INFO    :' + "".join([' ']*self.level), *message, style=style or 'info')
+
+    def debug(self, *message):
+        """
+        Write to stdout if Logger.verbosity >= DEBUG_LEVEL, and don't format the message otherwise
+        """
+        if Logger.verbosity < DEBUG_LEVEL:
+            return
+        message = self.format(message)
+        Logger.record('out', " ".join(['DEBUG:' + "".join([' ']*self.level), *message]))
+        Logger.console.print('DEBUG   :' + "".join([' ']*self.level), *message, style='debug')
 
     def err(self, *message):
         """
         Write to "stderr"
         """
-        Logger.log_err_all.append(" ".join(['ERROR:', *message]))
+        message = self.format(message)
+        Logger.record('err', " ".join(['ERROR:', *message]))
         Logger.console.print('ERROR:', *message, style='error')
 
     def warn(self, *message):
         """
         Write to stderr
         """
-        Logger.log_err_all.append(" ".join(['WARN:', *message]))
+        message = self.format(message)
+        Logger.record('err', " ".join(['WARN:', *message]))
         Logger.console.print('WARN:', *message, style='warn')
 
     def note(self, *message):
         """
         Write to stderr
         """
-        Logger.log_out_all.append(" ".join(['NOTE:', *message]))
-        Logger.console.print('NOTE:', *message, style='note')
+        message = self.format(message)
+        Logger.record('out', " ".join(['NOTE:', *message]))
+        if self.verbose:
+            Logger.console.print('NOTE:', *message, style='note')
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the run and record its resource usage in Logger.perf_all
+
+        Records wall time, cpu time, peak RSS, and the gmsh entity and
+        element counts at the end of the stage. Stages may be nested.
+        """
+        self.out(name)
+
+        record = {
+            'stage': name,
+            'parent': Logger.stages[-1] if Logger.stages else None,
+            'depth': len(Logger.stages),
+            'start': time.perf_counter() - Logger.start_time,
+        }
+
+        Logger.stages.append(name)
+        Logger.active.append(record)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            Logger.stages.pop()
+            Logger.active.pop()
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = time.process_time() - cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            record.update(gmsh_counts())
+            Logger.perf_all.append(record)
+
+    def progress(self, iterable, what, total=None):
+        """
+        Iterate over iterable, reporting the number of items done as what
+        """
+        progress = Progress(what, total if total is not None else len(iterable), logger=self)
+        for item in iterable:
+            yield item
+            progress.update()
+        progress.close()
 
     def die(self, *message, exception=RuntimeError):
         """
@@ -71,10 +256,99 @@ class Logger:
 
     def write(self, fname, timestamp=False):
         """
-        write to files
+        Close the streamed log files, or write the buffered lines if they
+        weren't opened, and write the performance report
         """
         ts = Logger.timestamp if timestamp else ''
-        with open(fname + ts + '.stdout.log', 'w') as outfile:
-            outfile.write("\n".join(self.log_out_all))
-        with open(fname + ts + '.stderr.log', 'w') as errfile:
-            errfile.write("\n".join(self.log_err_all))
+        if Logger.log_files:
+            Logger.close()
+        else:
+            with open(fname + ts + '.stdout.log', 'w') as outfile:
+                outfile.write(Logger.dropped('out') + "\n".join(self.log_out_all))
+            with open(fname + ts + '.stderr.log', 'w') as errfile:
+                errfile.write(Logger.dropped('err') + "\n".join(self.log_err_all))
+        if Logger.perf_all:
+            self.write_perf(fname + ts + '.perf.json')
+
+    def write_perf(self, fname):
+        """
+        Write the recorded stages to a json file
+        """
+        report = {
+            'timestamp': Logger.timestamp[1:],
+            'total_wall_time': time.perf_counter() - Logger.start_time,
+            'total_cpu_time': time.process_time(),
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': sorted(Logger.perf_all, key=lambda r: r['start']),
+        }
+        with open(fname, 'w') as fp:
+            json.dump(report, fp, indent=4)
+
+
+class Progress:
+    """
+    Items done in a loop, reported every Logger.progress_interval seconds, with
+    an estimate of the time left. Short loops are not reported at all.
+    """
+
+    def __init__(self, what, total=None, logger=None):
+        self.logger = logger or Logger(level=1)
+        self.what = what
+        self.total = total
+        self.count = 0
+        self.start = time.perf_counter()
+        self.reported = self.start
+
+    def message(self, elapsed):
+        if not self.total:
+            return f"{self.what}: {self.count:,} in {elapsed:.0f} s"
+        left = elapsed * (self.total - self.count) / self.count if self.count else float('nan')
+        return f"{self.what}: {self.count:,}/{self.total:,} ({self.count / self.total:.0%}) in {elapsed:.0f} s, ~{left:.0f} s left"
+
+    def update(self, n=1):
+        self.count += n
+        now = time.perf_counter()
+        Logger.last_progress = {
+            'stage': Logger.stages[-1] if Logger.stages else None,
+            'what': self.what,
+            'count': self.count,
+            'total': self.total,
+            'time': now - Logger.start_time,
+        }
+        if Logger.progress_interval and now - self.reported >= Logger.progress_interval:
+            self.reported = now
+            self.logger.out(self.message(now - self.start))
+
+    def close(self):
+        if self.reported > self.start:
+            self.logger.out(self.message(time.perf_counter() - self.start))
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the process so far, in MB.
+    ru_maxrss is in kilobytes on Linux, and bytes on macOS.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+def gmsh_counts():
+    """
+    Entity and element counts of the current gmsh model, if gmsh is running.
+    Uses the mesh statistics options, which are cheap to query even for large meshes.
+    """
+    if not is_loaded('gmsh'):
+        return {}
+
+    gmsh = sys.modules['gmsh']
+
+    try:
+        if not gmsh.isInitialized():
+            return {}
+        return {
+            'entities': [ len(gmsh.model.getEntities(dim)) for dim in range(4) ],
+            'nodes': int(gmsh.option.getNumber('Mesh.NbNodes')),
+            'triangles': int(gmsh.option.getNumber('Mesh.NbTriangles')),
+            'tetrahedra': int(gmsh.option.getNumber('Mesh.NbTetrahedra')),
+        }
+    except Exception:
+        return {}
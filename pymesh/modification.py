@@ -0,0 +1,147 @@
+"""
+Bead contact modifications: bridges and cuts
+
+contract:
+    - must find bead contacts with a spatial neighbor query, never all pairs
+    - must compute the geometry of all bridges or cut caps at once
+    - must group the OCC operations, so that their number doesn't grow with the number of contacts
+    - numpy only (no gmsh): PackedBed creates the OCC entities
+
+Contacts are pairs of beads whose surfaces are closer than relative_gap times
+the smaller radius (overlapping pairs included), as in
+PackedBed.repair_contacts().
+
+bridge: a cylinder of radius relative_bridge_radius * min(r_i, r_j) along the
+    line of centers, from bridge_offset_ratio * r inside either bead. Bridges
+    are fused with the beads in batches of beads sorted by z.
+
+cut: both beads of a pair lose a cap, leaving two parallel flat faces
+    relative_gap * min(r_i, r_j) apart, centered on the radical plane of the
+    pair. A cap is removed by cutting the bead with a cylinder slightly larger
+    than the cap. Such a cylinder also reaches into the neighbors of the bead,
+    so beads are cut in groups that contain no neighbors (a coloring of the
+    neighbor graph): one OCC cut per group.
+"""
+
+from pymesh.spatial import bead_pairs
+
+import numpy as np
+
+## Relative size of the cap cutting tools beyond the caps
+CUT_MARGIN = 0.01
+
+def contacts(beads, relative_gap):
+    """
+    Pairs of beads whose surfaces are closer than relative_gap * min(r_i, r_j)
+
+    @input: beads as an (N,4) array of x, y, z, r
+    @output: i, j, surface distances, unit vectors from i to j
+    """
+    r = beads[:, 3]
+    i, j, gap, normals = bead_pairs(beads, relative_gap * r.max())
+    close = gap < relative_gap * np.minimum(r[i], r[j])
+    return i[close], j[close], gap[close], normals[close]
+
+def bridge_cylinders(beads, i, j, normals, relative_bridge_radius, bridge_offset_ratio):
+    """
+    Bridge cylinders between beads i and j
+
+    @input: beads as an (N,4) array of x, y, z, r, contact pairs and their unit center-to-center vectors
+    @output: base points (K,3), axis vectors (K,3) and radii (K,) of the cylinders.
+        Pairs too deeply overlapping to be bridged are left out: keep marks the bridged pairs.
+    """
+    r_i, r_j = beads[i, 3], beads[j, 3]
+    dist = np.einsum('ij,ij->i', beads[j, :3] - beads[i, :3], normals)
+
+    length = dist - bridge_offset_ratio * (r_i + r_j)
+    keep = length > 0
+
+    base = beads[i, :3] + (bridge_offset_ratio * r_i)[:, None] * normals
+    axis = length[:, None] * normals
+    radius = relative_bridge_radius * np.minimum(r_i, r_j)
+
+    return base[keep], axis[keep], radius[keep], keep
+
+def cut_caps(beads, i, j, normals, relative_gap):
+    """
+    Caps to remove from beads i and j, to leave a gap of relative_gap * min(r_i, r_j)
+    between them, centered on the radical plane of the pair.
+
+    @output: per cap: bead index, and base point (K,3), axis vector (K,3) and radius (K,) of the cutting cylinder
+    """
+    r_i, r_j = beads[i, 3], beads[j, 3]
+    dist = np.einsum('ij,ij->i', beads[j, :3] - beads[i, :3], normals)
+    half_gap = relative_gap * np.minimum(r_i, r_j) / 2
+
+    ## Distances from either center to its cut plane, along the line of centers
+    radical = (dist**2 + r_i**2 - r_j**2) / (2 * dist)
+    planes = [ (i, normals, radical - half_gap), (j, -normals, dist - radical - half_gap) ]
+
+    index = np.concatenate([ k for k, _, _ in planes ])
+    direction = np.concatenate([ n for _, n, _ in planes ])
+    depth = np.concatenate([ p for _, _, p in planes ])
+    r = beads[index, 3]
+
+    ## Only planes that actually cut their bead. Planes behind the center cut off more than half of it.
+    cuts = depth < r
+    index, direction, depth, r = index[cuts], direction[cuts], depth[cuts], r[cuts]
+
+    base = beads[index, :3] + depth[:, None] * direction
+    axis = ((r - depth) * (1 + CUT_MARGIN))[:, None] * direction
+    radius = np.where(depth > 0, np.sqrt(np.maximum(r**2 - depth**2, 0.0)), r) * (1 + CUT_MARGIN)
+
+    return index, base, axis, radius
+
+def color_groups(n, i, j):
+    """
+    Greedy coloring of a graph with n vertices and edges (i, j), such that no
+    two adjacent vertices share a color. Vertices are visited by decreasing
+    degree, so that dense packings need few colors (~ max degree / 2).
+
+    @output: color of every vertex
+    """
+    edges = np.concatenate([ np.stack([i, j], axis=1), np.stack([j, i], axis=1) ])
+    edges = edges[np.argsort(edges[:, 0], kind='stable')]
+    degree = np.bincount(edges[:, 0], minlength=n)
+    starts = np.concatenate([ [0], np.cumsum(degree) ])
+    neighbors = edges[:, 1]
+
+    colors = np.full(n, -1, dtype=np.int64)
+    for v in np.argsort(-degree, kind='stable'):
+        taken = colors[neighbors[starts[v]:starts[v+1]]]
+        free = np.ones(len(taken) + 1, dtype=bool)
+        free[taken[(taken >= 0) & (taken <= len(taken))]] = False
+        colors[v] = np.argmax(free)
+
+    return colors
+
+def z_batches(beads, batch_size):
+    """
+    Batch index of every bead, for batches of batch_size beads sorted by z
+    """
+    batch = np.empty(len(beads), dtype=np.int64)
+    batch[np.argsort(beads[:, 2], kind='stable')] = np.arange(len(beads)) // max(batch_size, 1)
+    return batch
+
+def bridge_volumes(beads, i, j, normals, relative_bridge_radius, bridge_offset_ratio):
+    """
+    Volumes added by the bridges between beads i and j, outside of the beads.
+    Assumes that the beads of a pair don't overlap.
+    """
+    base, axis, radius, keep = bridge_cylinders(beads, i, j, normals, relative_bridge_radius, bridge_offset_ratio)
+
+    def inside(r):
+        ## Half of the sphere-cylinder intersection (coaxial), minus the part of the bridge before its base
+        rho = radius / r
+        return 2/3 * np.pi * (1 - (1 - rho**2)**1.5) * r**3 - np.pi * radius**2 * bridge_offset_ratio * r
+
+    length = np.linalg.norm(axis, axis=1)
+    return np.pi * radius**2 * length - inside(beads[i[keep], 3]) - inside(beads[j[keep], 3])
+
+def cap_volumes(beads, index, axis):
+    """
+    Volumes of the caps removed by cut_caps()
+    """
+    r = beads[index, 3]
+    h = np.linalg.norm(axis, axis=1) / (1 + CUT_MARGIN)
+    return np.pi * h**2 * (3 * r - h) / 3
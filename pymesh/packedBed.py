@@ -12,25 +12,37 @@ contract:
 from pymesh.tools import bin_to_arr, grouper, get_surface_normals, get_volume_normals, store_mesh
 from pymesh.bead import Bead
 from pymesh.log import Logger
+from pymesh.spatial import bead_pairs, curve_order
+from pymesh.modification import contacts, bridge_cylinders, bridge_volumes, cut_caps, cap_volumes, color_groups, z_batches, CUT_MARGIN
 
 from pymesh.tools import add_nodes_multi, add_elements_multi
+from pymesh.lazy import lazy_import
 
 import struct
 import numpy as np
-import gmsh
+from pathlib import Path
 from types import SimpleNamespace
 
 from itertools import combinations
 
+gmsh = lazy_import('gmsh')
+
+MAX_SNAP_PASSES = 10
+
 class PackedBed:
 
-    def __init__(self, config, generate=True, logger=Logger(level=2)):
+    def __init__(self, config, generate=True, packing=None, original_index=None, logger=Logger(level=2)):
         """
         Initialize PackedBed
 
         > Read packing information
         > Move bed to center if config.auto_translate:bool == True
         > Generate entities (geometric) if generate == True
+
+        If packing is given as an (N,4) array of x, y, z, r (see to_array()),
+        it is used as is instead of reading and preprocessing the packing file.
+        original_index then gives the positions of its beads in the packing
+        file (see write()), and the beads are taken as already ordered.
         """
 
         self.logger = logger
@@ -54,16 +66,56 @@ class PackedBed:
         self.nproc = config.general_nproc
 
         self.target_volume = config.packedbed_target_volume
-
-        self.read_packing()
-        if self.auto_translate:
-            self.moveBedtoCenter()
+        self.ordering = config.packedbed_ordering
+
+        self.modification                        = config.packedbed_particles_modification
+        if self.modification == 'bridge':
+            self.relative_bridge_radius          = config.packedbed_particles_relative_bridge_radius
+            self.bridge_offset_ratio             = config.packedbed_particles_bridge_offset_ratio
+            self.fuse_batch_size                 = config.packedbed_particles_fuse_batch_size
+
+        ## Particle volumes after modification. Empty if the beads are used as is.
+        self.entities = []
+
+        self.contacts_repair                     = config.packedbed_contacts_repair
+        self.contacts_relative_min_gap           = config.packedbed_contacts_relative_min_gap
+        self.periodicity                         = config.container_periodicity + ('z' if config.container_linked and 'z' not in config.container_periodicity else '')
+        self.periodic_lengths                    = np.array(config.container_size[3:6], dtype=np.float64) if len(config.container_size) >= 6 else np.zeros(3)
+
+        self.center_bed_in_container             = config.general_center_bed_in_container
+        self.wall_gap_snap                       = config.container_wall_gap_snap
+        if self.wall_gap_snap:
+            self.wall_gap_relative_epsilon       = config.container_wall_gap_relative_epsilon
+            self.wall_gap_mode                   = config.container_wall_gap_mode
+
+        if packing is None:
+            with self.logger.stage('Reading packing'):
+                self.read_packing()
+            if self.auto_translate:
+                self.moveBedtoCenter()
+        else:
+            self.beads = [ Bead(x, y, z, r) for x, y, z, r in np.asarray(packing, dtype=np.float64).tolist() ]
+            self.original_index = np.arange(len(self.beads)) if original_index is None else np.asarray(original_index, dtype=np.int64)
+            self.logger.out(f"Using {len(self.beads)} preprocessed beads")
 
         self.updateBounds()
         self.logger.print(self.get_bounds())
 
-        if self.target_volume > 0.0: 
-            self.prune_to_volume(self.target_volume)
+        if packing is None and self.target_volume > 0.0: 
+            with self.logger.stage('Pruning packed bed'):
+                self.prune_to_volume(self.target_volume)
+
+        if packing is None and self.contacts_repair and self.modification:
+            self.logger.warn(f"Ignoring packedbed.contacts.repair: contacts are handled by packedbed.particles.modification = {self.modification}")
+        elif packing is None and self.contacts_repair:
+            with self.logger.stage('Repairing bead contacts'):
+                self.repair_contacts(self.contacts_relative_min_gap)
+
+        ## Preprocessed packings were ordered when they were read
+        self.ordered = packing is not None and original_index is not None and bool(self.ordering)
+        if packing is None and self.ordering:
+            with self.logger.stage('Ordering beads'):
+                self.order_beads(self.ordering)
 
         if generate: 
             self.generate()
@@ -82,9 +134,11 @@ class PackedBed:
         """
         # dataformat = "<f" ## For old packings with little endian floating point data. Use <d for new ones
         self.beads = []
+        ## Position of every bead in the packing file, kept in step with self.beads
+        original_index = []
         arr = bin_to_arr(self.fname, self.dataformat)
         if self.nBeads < 0:
-            for chunk in grouper(arr,4):
+            for index, chunk in enumerate(grouper(arr,4)):
                 if (chunk[2] >= self.zBot/self.scaling_factor) and (chunk[2] <= self.zTop/self.scaling_factor):
                     x = chunk[0] * self.scaling_factor
                     y = chunk[1] * self.scaling_factor
@@ -93,6 +147,7 @@ class PackedBed:
                     if r < self.particles_radius_lower_threshold:
                         continue
                     self.beads.append(Bead(x, y, z, r))
+                    original_index.append(index)
         else:
             for index, chunk in enumerate(grouper(arr,4)):
                 if index == self.nBeads:
@@ -104,22 +159,27 @@ class PackedBed:
                 if r < self.particles_radius_lower_threshold:
                     continue
                 self.beads.append(Bead(x, y, z, r))
+                original_index.append(index)
 
+        self.original_index = np.array(original_index, dtype=np.int64)
         self.logger.out(f"Found {len(self.beads)} beads")
 
     @property
     def dimTags(self):
-        # return [ (3,tag) for tag in self.entities ]
+        if self.entities:
+            return self.entities
         return [ (3,b.tag) for b in self.beads ]
 
     @property
     def tags(self):
-        # return self.entities
-        return [ b.tag for b in self.beads ]
+        return [ tag for _, tag in self.dimTags ]
 
     def write(self, filename, dataformat='<d'):
         """
         Output the current packed bed into a binary file (xyzd)
+
+        If the beads were ordered, their positions in the packing file are
+        written to <filename stem>.index (binary, '<q'), -1 for stacked copies.
         """
         with(open(filename, 'wb')) as output:
             for bead in self.beads:
@@ -128,6 +188,35 @@ class PackedBed:
                 output.write(struct.pack(dataformat,bead.z))
                 output.write(struct.pack(dataformat,bead.r * 2))
 
+        if self.ordered:
+            index = np.full(len(self.beads), -1, dtype='<i8')
+            index[:len(self.original_index)] = self.original_index
+            index.tofile(str(Path(filename).with_suffix('.index')))
+
+    def order_beads(self, curve):
+        """
+        Sort beads along a space-filling curve ('morton' or 'hilbert'), so that
+        beads close in space are close in the bead list too. OCC entities,
+        mesh tags and copymesh blocks then inherit that locality.
+        """
+        beads = self.to_array()
+        order = curve_order(beads[:, :3], curve)
+
+        step_before = np.linalg.norm(np.diff(beads[:, :3], axis=0), axis=1).mean() if len(beads) > 1 else 0.0
+        step_after = np.linalg.norm(np.diff(beads[order, :3], axis=0), axis=1).mean() if len(beads) > 1 else 0.0
+
+        self.beads = [ self.beads[k] for k in order.tolist() ]
+        self.original_index = self.original_index[order]
+        self.ordered = True
+
+        self.logger.out(f"Ordered {len(self.beads)} beads along a {curve} curve: mean distance between consecutive beads {step_before:.4g} -> {step_after:.4g}")
+
+    def to_array(self):
+        """
+        Beads as an (N,4) array of x, y, z, r
+        """
+        return np.array([ (b.x, b.y, b.z, b.r) for b in self.beads ], dtype=np.float64).reshape(-1, 4)
+
     def updateBounds(self):
         """
         Calculate bounding points for the packed bed.
@@ -175,6 +264,17 @@ class PackedBed:
         dz = (bContainer.zmax + bContainer.zmin - bPackedBed.zmax - bPackedBed.zmin) / 2.0
         self.translate(dx, dy, dz)
 
+    def fit_to_container(self, container):
+        """
+        Center the bed in the container and snap beads to its walls, as configured
+        """
+        if self.center_bed_in_container:
+            self.center_bed_in_bounds(container.get_bounds())
+
+        if self.wall_gap_snap and container.shape:
+            with self.logger.stage('Snapping beads to container walls'):
+                self.snap_to_walls(container, self.wall_gap_relative_epsilon, self.wall_gap_mode)
+
     def translate(self, xOff=0.0, yOff=0.0, zOff=0.0):
         for bead in self.beads:
             bead.translate(xOff, yOff, zOff)
@@ -184,8 +284,113 @@ class PackedBed:
         """
         Create packed bed entities
         """
-        for bead in self.beads:
-            bead.generate()
+        with self.logger.stage('Generating beads'):
+            for bead in self.logger.progress(self.beads, 'beads generated'):
+                bead.generate()
+
+    def modify(self):
+        """
+        Bridge or cut bead contacts, as configured by packedbed.particles.modification.
+
+        Must be called after the beads are generated and stacked, so that
+        contacts with periodic copies are included. The resulting particle
+        volumes replace the beads in dimTags. See pymesh/modification.py.
+        """
+        if not self.modification:
+            return
+
+        beads = self.to_array()
+        i, j, gap, normals = contacts(beads, self.contacts_relative_min_gap)
+
+        self.modification_stats = {
+            'modification': self.modification,
+            'contacts': len(i),
+            'overlapping_contacts': int(np.sum(gap < 0)),
+        }
+
+        if len(i) == 0:
+            self.logger.warn("No bead contacts to modify")
+            return
+
+        if self.modification == 'bridge':
+            with self.logger.stage('Bridging bead contacts') as record:
+                record['contacts'] = len(i)
+                self.bridge(beads, i, j, normals)
+        elif self.modification == 'cut':
+            with self.logger.stage('Cutting bead contacts') as record:
+                record['contacts'] = len(i)
+                self.cut(beads, i, j, normals)
+
+        self.logger.print(self.modification_stats)
+
+    def bridge(self, beads, i, j, normals):
+        """
+        Fuse beads with cylinders along their contacts, in batches of fuse_batch_size beads sorted by z
+        """
+        factory = gmsh.model.occ
+
+        base, axis, radius, keep = bridge_cylinders(beads, i, j, normals, self.relative_bridge_radius, self.bridge_offset_ratio)
+        bridges = np.array([ factory.addCylinder(*b, *a, rad) for b, a, rad in zip(base.tolist(), axis.tolist(), radius.tolist()) ], dtype=np.int64)
+
+        ## Bridges between batches are fused with the lower one. They overlap
+        ## the bead of the upper batch, which fragmenting the column resolves.
+        batch = z_batches(beads, self.fuse_batch_size)
+        bridge_batch = np.minimum(batch[i[keep]], batch[j[keep]])
+        tags = np.array(self.tags, dtype=np.int64)
+
+        entities = []
+        for b in range(batch.max() + 1):
+            objects = [ (3, tag) for tag in tags[batch == b].tolist() ]
+            tools = [ (3, tag) for tag in bridges[bridge_batch == b].tolist() ]
+            if tools:
+                fused, _ = factory.fuse(objects, tools)
+                entities.extend(fused)
+            else:
+                entities.extend(objects)
+
+        self.entities = entities
+
+        self.modification_stats.update({
+            'bridges': len(bridges),
+            'skipped_deep_overlaps': int(np.sum(~keep)),
+            'fuse_batches': int(batch.max() + 1),
+            'particle_volumes': len(entities),
+            'bridge_volume': float(bridge_volumes(beads, i, j, normals, self.relative_bridge_radius, self.bridge_offset_ratio).sum()),
+        })
+
+    def cut(self, beads, i, j, normals):
+        """
+        Cut caps off both beads of every contact, one OCC cut per group of non-neighboring beads
+        """
+        factory = gmsh.model.occ
+
+        index, base, axis, radius = cut_caps(beads, i, j, normals, self.contacts_relative_min_gap)
+        tools = np.array([ factory.addCylinder(*b, *a, rad) for b, a, rad in zip(base.tolist(), axis.tolist(), radius.tolist()) ], dtype=np.int64)
+
+        ## The cutting tools reach up to CUT_MARGIN * r beyond their bead
+        capped = np.unique(index)
+        ci, cj, _, _ = bead_pairs(beads[capped], 2 * CUT_MARGIN * beads[:, 3].max())
+        colors = np.full(len(beads), -1, dtype=np.int64)
+        colors[capped] = color_groups(len(capped), ci, cj)
+        tool_colors = colors[index]
+        tags = np.array(self.tags, dtype=np.int64)
+
+        entities = [ (3, tag) for tag in tags[colors < 0].tolist() ]
+        for c in range(colors.max() + 1):
+            objects = [ (3, tag) for tag in tags[colors == c].tolist() ]
+            ctools = [ (3, tag) for tag in tools[tool_colors == c].tolist() ]
+            pieces, _ = factory.cut(objects, ctools)
+            entities.extend(pieces)
+
+        self.entities = entities
+
+        self.modification_stats.update({
+            'caps': len(tools),
+            'beads_cut': len(capped),
+            'cut_groups': int(colors.max() + 1),
+            'particle_volumes': len(entities),
+            'cap_volume': float(cap_volumes(beads, index, axis).sum()),
+        })
 
     def set_mesh_fields(self):
         """
@@ -216,7 +421,7 @@ class PackedBed:
 
         factory.synchronize()
 
-        for bead in self.beads:
+        for bead in self.logger.progress(self.beads, 'bead fields created'):
 
             bead_size_ratio = bead.r/self.rref
 
@@ -582,13 +787,14 @@ class PackedBed:
 
         while delta_volume/target_volume > eps: 
 
-            del_zone_beads = list(filter(lambda b: b.z < self.zmin + self.rmax, self.beads)) + list(filter(lambda b: b.z > self.zmax - self.rmax, self.beads)) 
-            print(f"{len(del_zone_beads) = }")
-            out = min(del_zone_beads, key=lambda b: abs(b.volume() - delta_volume))
+            del_zone_beads = [ k for k, b in enumerate(self.beads) if b.z < self.zmin + self.rmax ] + [ k for k, b in enumerate(self.beads) if b.z > self.zmax - self.rmax ]
+            self.logger.debug(lambda: f"{len(del_zone_beads) = }")
+            k = min(del_zone_beads, key=lambda k: abs(self.beads[k].volume() - delta_volume))
 
-            self.beads.remove(out)
+            out = self.beads.pop(k)
+            self.original_index = np.delete(self.original_index, k)
 
-            self.logger.print(f"Deleting bead {out} with volume = {out.volume()}")
+            self.logger.debug(lambda: f"Deleting bead {out} with volume = {out.volume()}")
 
             self.updateBounds()
             delta_volume = self.volume() - target_volume
@@ -600,6 +806,158 @@ class PackedBed:
         self.updateBounds()
         self.logger.print(self.get_bounds())
 
+    def repair_contacts(self, relative_min_gap):
+        """
+        Separate beads that overlap or nearly touch, by shrinking only the beads involved.
+
+        Every pair of beads with a surface gap below relative_min_gap times the
+        smaller radius is widened to that gap, with both beads shrunk in
+        proportion to their radii. Shrinking never narrows any other gap, so a
+        single pass suffices. Beads that would shrink to nothing (duplicates or
+        near-coincident beads) can't be repaired this way: the run dies with
+        their positions in the packing file. Pairs across periodic container walls are
+        included, using the container size as the period.
+
+        Replaces the global packedbed.particles.scaling_factor workaround.
+        """
+        beads = self.to_array()
+        if len(beads) < 2:
+            return
+
+        periodic = tuple(d in self.periodicity for d in 'xyz')
+        box = None
+        if any(periodic):
+            lo = beads[:, :3].min(axis=0)
+            box = (lo, np.where(periodic, lo + self.periodic_lengths, beads[:, :3].max(axis=0)))
+
+        r = beads[:, 3]
+        i, j, gap, _ = bead_pairs(beads, relative_min_gap * r.max(), periodic, box)
+
+        required = relative_min_gap * np.minimum(r[i], r[j])
+        close = gap < required
+        i, j, gap, required = i[close], j[close], gap[close], required[close]
+
+        ## Shrink both beads by their share of the missing gap, the largest share over all their pairs
+        missing = required - gap
+        shrink = np.zeros(len(r))
+        np.maximum.at(shrink, i, missing * r[i] / (r[i] + r[j]))
+        np.maximum.at(shrink, j, missing * r[j] / (r[i] + r[j]))
+
+        ## Duplicate or near-coincident beads would shrink to nothing
+        vanishing = shrink >= r
+        if vanishing.any():
+            bad = vanishing[i] | vanishing[j]
+            pairs = ", ".join(f"({a}, {b})" for a, b in zip(self.original_index[i[bad]][:10].tolist(), self.original_index[j[bad]][:10].tolist()))
+            self.logger.die(f"Cannot repair contacts: {vanishing.sum()} beads would shrink to a zero or negative radius. Remove the duplicate or near-coincident beads at packing file positions: {pairs}{' ...' if bad.sum() > 10 else ''}")
+
+        shrunk = shrink > 0
+        relative = shrink / r
+        self.beads = [ Bead(x, y, z, rad - dr) for (x, y, z, rad), dr in zip(beads.tolist(), shrink.tolist()) ]
+        self.updateBounds()
+
+        self.contact_stats = {
+            'relative_min_gap': relative_min_gap,
+            'overlapping_pairs': int(np.sum(gap < 0)),
+            'near_contact_pairs': int(np.sum(gap >= 0)),
+            'beads_shrunk': int(shrunk.sum()),
+            'min_gap_before': float(gap.min()) if len(gap) else None,
+            'max_relative_shrink': float(relative.max()),
+            'mean_relative_shrink': float(relative[shrunk].mean()) if shrunk.any() else 0.0,
+            'volume_removed_fraction': float(1 - np.sum((r - shrink)**3) / np.sum(r**3)),
+        }
+        self.logger.print(self.contact_stats)
+
+        if relative.max() > 0.01:
+            self.logger.warn(f"Beads shrunk by up to {relative.max():.2%} to resolve contacts. Check the packing scaling and units.")
+
+    def snap_to_walls(self, container, relative_epsilon, mode='nearest'):
+        """
+        Remove near-tangencies between beads and container walls.
+
+        A bead whose surface is within relative_epsilon * r of a wall, inside
+        or outside, leaves a thin sliver of interstitial volume or a tiny cap
+        that the mesher must resolve. Such beads are either:
+            - intersect: moved along the wall normal, to cut the wall at a depth of relative_epsilon * r
+            - clearance: shrunk, to keep a gap of relative_epsilon * r to the wall
+            - nearest: whichever of the two changes the bead less
+        Walls are processed one after another, so beads in corners are snapped
+        to every wall they nearly touch. Shrinking a bead for one wall can make
+        it nearly touch another again, so passes are repeated until no bead
+        nearly touches any wall.
+        """
+        beads = self.to_array()
+        if len(beads) == 0:
+            return
+
+        original = beads.copy()
+        names, distances, _ = container.wall_distances(beads[:, :3])
+        r = beads[:, 3]
+        min_gap_before = np.min(np.abs(distances - r[:, None]) / r[:, None])
+
+        per_wall = { name: { 'moved': 0, 'shrunk': 0 } for name in names }
+        for npass in range(1, MAX_SNAP_PASSES + 1):
+            for w, name in enumerate(names):
+                _, distances, normals = container.wall_distances(beads[:, :3])
+                d, normal, r = distances[:, w], normals[:, w], beads[:, 3]
+                band = relative_epsilon * r
+                near = np.abs(d - r) < band
+
+                move = d - r + band
+                shrink = r - d / (1 + relative_epsilon)
+                if mode == 'intersect':
+                    moved = near
+                elif mode == 'clearance':
+                    moved = np.zeros_like(near)
+                else:
+                    moved = near & (move <= shrink)
+                shrunk = near & ~moved
+
+                beads[moved, :3] += move[moved, None] * normal[moved]
+                beads[shrunk, 3] -= shrink[shrunk]
+                per_wall[name]['moved'] += int(moved.sum())
+                per_wall[name]['shrunk'] += int(shrunk.sum())
+
+            _, distances, _ = container.wall_distances(beads[:, :3])
+            r = beads[:, 3]
+            ## Tolerance for roundoff in the snapped gaps
+            if not np.any(np.abs(distances - r[:, None]) < relative_epsilon * (1 - 1e-9) * r[:, None]):
+                break
+        else:
+            self.logger.warn(f"Beads still nearly touch container walls after {MAX_SNAP_PASSES} snapping passes")
+
+        displacement = np.linalg.norm(beads[:, :3] - original[:, :3], axis=1) / original[:, 3]
+        shrinkage = 1 - r / original[:, 3]
+        changed = (displacement > 0) | (shrinkage > 0)
+
+        self.beads = [ Bead(x, y, z, rad) for x, y, z, rad in beads.tolist() ]
+        self.updateBounds()
+
+        self.wall_gap_stats = {
+            'relative_epsilon': relative_epsilon,
+            'mode': mode,
+            'beads_adjusted': int(changed.sum()),
+            'beads_moved': int(np.sum(displacement > 0)),
+            'beads_shrunk': int(np.sum(shrinkage > 0)),
+            'walls': per_wall,
+            'passes': npass,
+            'max_relative_displacement': float(displacement.max()),
+            'max_relative_shrink': float(shrinkage.max()),
+            'min_relative_wall_gap_before': float(min_gap_before),
+            'min_relative_wall_gap_after': float(np.min(np.abs(distances - r[:, None]) / r[:, None])),
+        }
+
+        ## Moved beads may now overlap their neighbors
+        if np.any(displacement > 0):
+            i, j, gap, _ = bead_pairs(beads, 0.0)
+            before = np.linalg.norm(original[i, :3] - original[j, :3], axis=1) - original[i, 3] - original[j, 3]
+            self.wall_gap_stats['bead_overlaps_created'] = int(np.sum((gap < 0) & (before >= 0)))
+
+        self.logger.print(self.wall_gap_stats)
+        self.logger.out(f"Snapped {changed.sum()} beads to container walls")
+
+        if self.wall_gap_stats.get('bead_overlaps_created'):
+            self.logger.warn(f"Snapping to walls created {self.wall_gap_stats['bead_overlaps_created']} bead overlaps. Consider mode: clearance, or packedbed.contacts.repair")
+
     def scale(self, factor, cx = 0.0, cy = 0.0, cz = 0.0):
         for bead in self.beads:
             bead.scale(factor, cx, cy, cz)
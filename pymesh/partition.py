@@ -0,0 +1,239 @@
+"""
+MeshPartitioning class
+
+contract:
+    - must partition the current mesh into N parts balanced by element count, with gmsh's partitioner (metis) or a space-filling curve (hilbert)
+    - must write one file per partition, keeping the physical groups of the column in every part
+    - must optionally create ghost cells, and write a manifest of the partitions and their interfaces
+
+metis: gmsh's built-in METIS graph partitioner, on the element adjacency.
+    It partitions all the elements in the model: with linked columns, the
+    inlet and outlet are partitioned with the column, so the partitions of
+    the column file alone can be unbalanced. A warning is logged when the
+    written partitions are more than IMBALANCE_WARNING unbalanced.
+
+hilbert: elements of the highest dimension are sorted along a Hilbert curve
+    through their centroids, and the curve is cut into N pieces of equal
+    element counts. Lower dimensional elements follow the volume elements
+    they bound. Interfaces are larger than with metis, but the partitions
+    are computed in seconds for any mesh size.
+
+Partitioning is undone after writing, so that the same model can be written
+again (other column sections, fragments).
+
+gmsh can't write HDF5: the partitions of .h5/.hdf5 outputs are written as
+.msh files next to them (<file stem>_<k>.msh).
+
+The manifest (<file stem>.partitions.json) lists, for every partition, its
+file, number of nodes and elements of the highest dimension, elements per
+physical volume group, ghost elements, and its interface: the nodes it
+shares with each neighboring partition. Only elements written to the file
+(in physical groups) are counted, and balanced by hilbert.
+"""
+
+from pymesh.log import Logger
+from pymesh.spatial import curve_order
+from pymesh.tools import node_coordinates
+from pymesh.hdf5 import HDF5_SUFFIXES
+from pymesh.lazy import lazy_import
+
+from pathlib import Path
+
+import json
+
+import numpy as np
+
+gmsh = lazy_import('gmsh')
+
+## Options set while partitioning, restored afterwards
+PARTITION_OPTIONS = {
+    'Mesh.PartitionSplitMeshFiles': 1,
+    'Mesh.PartitionCreateTopology': 1,
+    'Mesh.PartitionCreatePhysicals': 0,
+}
+
+## Largest partition over the mean, in written elements, above which a warning is logged
+IMBALANCE_WARNING = 1.1
+
+def highest_dim_elements():
+    """
+    Element tags and (K, nodes per element) node tags of all elements of the highest dimension in the mesh
+    """
+    for dim in (3, 2, 1):
+        elementTypes, elementTags, nodeTags = gmsh.model.mesh.getElements(dim)
+        if len(elementTypes):
+            break
+    else:
+        return 0, np.zeros(0, dtype=np.int64), []
+
+    nodes = []
+    for elementType, elementNodes in zip(elementTypes, nodeTags):
+        numNodes = gmsh.model.mesh.getElementProperties(elementType)[3]
+        nodes.append(np.reshape(np.asarray(elementNodes, dtype=np.int64), (-1, numNodes)))
+
+    return dim, np.concatenate([ np.asarray(t, dtype=np.int64) for t in elementTags ]), nodes
+
+def tag_index(tags):
+    """
+    Lookup table from tags to their positions in tags (-1 for others)
+    """
+    index = np.full(tags.max() + 1 if len(tags) else 0, -1, dtype=np.int64)
+    index[tags] = np.arange(len(tags))
+    return index
+
+class MeshPartitioning:
+
+    def __init__(self, nparts, method='metis', ghost_cells=True, logger=Logger(level=1)):
+        """
+        @input:
+            - nparts: number of partitions
+            - method: 'metis' or 'hilbert'
+            - ghost_cells: create a layer of ghost elements around every partition
+        """
+        self.logger = logger
+        self.nparts = nparts
+        self.method = method
+        self.ghost_cells = ghost_cells
+
+    def hilbert_partitions(self, nodes, written):
+        """
+        Partition (1..nparts) of every element: pieces of a Hilbert curve through
+        the element centroids, with equal numbers of written elements
+        """
+        xyz = node_coordinates()
+        centroids = np.concatenate([ xyz[n].mean(axis=1) for n in nodes ]) if nodes else np.zeros((0, 3))
+
+        order = curve_order(centroids, 'hilbert')
+        position = np.cumsum(written[order]) - 1
+        partitions = np.empty(len(order), dtype=np.int64)
+        partitions[order] = np.clip(position * self.nparts // max(written.sum(), 1), 0, self.nparts - 1) + 1
+        return partitions
+
+    def element_partitions(self, dim, elementTags):
+        """
+        Partition of every element of dimension dim, as assigned by gmsh, and
+        the number of ghost elements per partition. Ghost elements are not assigned.
+        """
+        index = tag_index(elementTags)
+        partitions = np.zeros(len(elementTags), dtype=np.int64)
+        ghosts = np.zeros(self.nparts + 1, dtype=np.int64)
+        for _, tag in gmsh.model.getEntities(dim):
+            entity_partitions = gmsh.model.getPartitions(dim, tag)
+            if not len(entity_partitions):
+                continue
+            _, tags, _ = gmsh.model.mesh.getElements(dim, tag)
+            tags = np.concatenate([ np.asarray(t, dtype=np.int64) for t in tags ]) if len(tags) else np.zeros(0, dtype=np.int64)
+            if 'ghost' in gmsh.model.getType(dim, tag).lower():
+                ghosts[entity_partitions[0]] += len(tags)
+            else:
+                partitions[index[tags]] = entity_partitions[0]
+
+        return partitions, ghosts
+
+    def volume_groups(self, dim, elementTags):
+        """
+        Physical group name of every element of dimension dim ('' if none)
+        """
+        index = tag_index(elementTags)
+        names = np.full(len(elementTags), '', dtype=object)
+        for _, ptag in gmsh.model.getPhysicalGroups(dim):
+            name = gmsh.model.getPhysicalName(dim, ptag) or str(ptag)
+            for entity in gmsh.model.getEntitiesForPhysicalGroup(dim, ptag):
+                _, tags, _ = gmsh.model.mesh.getElements(dim, entity)
+                for t in tags:
+                    names[index[np.asarray(t, dtype=np.int64)]] = name
+        return names
+
+    def manifest(self, fname, dim, elementTags, nodes, partitions, groups, ghosts):
+        """
+        Sizes and interfaces of the partitions
+        """
+        offsets = np.cumsum([ 0 ] + [ len(n) for n in nodes ])
+        nodeTags = np.concatenate([ n.ravel() for n in nodes ]) if nodes else np.zeros(0, dtype=np.int64)
+        nodeParts = np.concatenate([ np.repeat(partitions[offsets[k]:offsets[k + 1]], n.shape[1]) for k, n in enumerate(nodes) ]) if nodes else np.zeros(0, dtype=np.int64)
+
+        ## Unique (node, partition) pairs of written elements, then the nodes in more than one partition
+        keys = np.unique((nodeTags * (self.nparts + 1) + nodeParts)[nodeParts > 0])
+        pairs = np.stack([ keys // (self.nparts + 1), keys % (self.nparts + 1) ], axis=1)
+        owners = np.bincount(pairs[:, 0]) if len(pairs) else np.zeros(0, dtype=np.int64)
+        shared = pairs[owners[pairs[:, 0]] > 1]
+
+        stem = Path(fname).stem
+        parts = []
+        for part in range(1, self.nparts + 1):
+            mine = partitions == part
+            interface = shared[shared[:, 1] == part, 0]
+            neighbors = {}
+            others = shared[np.isin(shared[:, 0], interface) & (shared[:, 1] != part)]
+            for other, count in zip(*np.unique(others[:, 1], return_counts=True)):
+                neighbors[int(other)] = int(count)
+
+            files = sorted(str(f) for f in Path(fname).parent.glob(f"{stem}_{part}.*"))
+            parts.append({
+                'partition': part,
+                'file': files[0] if files else None,
+                'elements': int(mine.sum()),
+                'nodes': int(np.sum(pairs[:, 1] == part)),
+                'groups': { str(name): int(count) for name, count in zip(*np.unique(groups[mine], return_counts=True)) if name },
+                'ghost_elements': int(ghosts[part]),
+                'interface_nodes': int(len(interface)),
+                'neighbors': neighbors,
+            })
+
+        counts = np.array([ p['elements'] for p in parts ])
+        return {
+            'mesh': str(fname),
+            'method': self.method,
+            'partitions': self.nparts,
+            'dim': dim,
+            'elements': int(np.sum(partitions > 0)),
+            'imbalance': float(counts.max() / counts.mean()) if counts.sum() else 1.0,
+            'ghost_cells': self.ghost_cells,
+            'physical_groups': [ gmsh.model.getPhysicalName(d, t) or str(t) for d, t in gmsh.model.getPhysicalGroups() ],
+            'parts': parts,
+        }
+
+    def write(self, fname):
+        """
+        Partition the current mesh, write one file per partition and the manifest, and undo the partitioning
+        """
+        if Path(fname).suffix in HDF5_SUFFIXES:
+            fname = str(Path(fname).with_suffix('.msh'))
+            self.logger.note(f"Writing partitions as {Path(fname).stem}_<k>.msh: gmsh can't write partitioned HDF5 files")
+
+        dim, elementTags, nodes = highest_dim_elements()
+        groups = self.volume_groups(dim, elementTags)
+
+        ## Only elements in physical groups are written: other column sections in the model don't count
+        written = groups != ''
+        if not written.any():
+            written[:] = True
+
+        options = dict(PARTITION_OPTIONS, **{ 'Mesh.PartitionCreateGhostCells': int(self.ghost_cells) })
+        previous = { option: gmsh.option.getNumber(option) for option in options }
+        for option, value in options.items():
+            gmsh.option.setNumber(option, value)
+
+        if self.method == 'hilbert':
+            partitions = self.hilbert_partitions(nodes, written)
+            gmsh.model.mesh.partition(self.nparts, elementTags.tolist(), partitions.tolist())
+        else:
+            gmsh.model.mesh.partition(self.nparts)
+
+        gmsh.write(fname)
+
+        partitions, ghosts = self.element_partitions(dim, elementTags)
+        data = self.manifest(fname, dim, elementTags, nodes, np.where(written, partitions, 0), groups, ghosts)
+
+        gmsh.model.mesh.unpartition()
+        for option, value in previous.items():
+            gmsh.option.setNumber(option, value)
+
+        manifest = Path(fname).with_suffix('.partitions.json')
+        manifest.write_text(json.dumps(data, indent=4))
+
+        self.logger.out(f"Wrote {self.nparts} partitions of {fname} ({self.method}, element imbalance {data['imbalance']:.3f}). See {manifest}")
+
+        if data['imbalance'] > IMBALANCE_WARNING:
+            reason = " metis partitions every section in the model, not only the written one." if self.method == 'metis' and not written.all() else ""
+            self.logger.warn(f"Partitions of {fname} are unbalanced (element imbalance {data['imbalance']:.3f}).{reason} Consider output.partitions.method = hilbert")
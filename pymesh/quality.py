@@ -0,0 +1,367 @@
+"""
+MeshQuality class
+
+contract:
+    - must compute element quality metrics per group with numpy only, without gmsh plugins or the GUI
+    - must visit every element once, in chunks, so that memory stays bounded
+    - must report histograms, inverted/degenerate counts and the worst elements by location
+
+Metrics are normalized so that equilateral elements score 1:
+
+    tetrahedra:
+        aspect_ratio        longest edge / (2 sqrt(6) inradius)              >= 1, worse when larger
+        min/max_dihedral    smallest/largest dihedral angle (degrees)         70.53 for equilateral
+        volume_edge_ratio   6 sqrt(2) signed volume / rms edge length^3       <= 1, < 0 when inverted
+    triangles:
+        aspect_ratio        longest edge / (2 sqrt(3) inradius)
+        min/max_angle       smallest/largest angle (degrees)                  60 for equilateral
+        area_edge_ratio     4 area / (sqrt(3) rms edge length^2)
+
+Elements with |volume_edge_ratio| (or area_edge_ratio) below degenerate_tol
+are counted as degenerate, tetrahedra with a negative volume beyond that as
+inverted. Both are excluded from the other statistics.
+"""
+
+from pymesh.log import Logger
+from pymesh.tools import node_coordinates, iter_elements
+from pymesh.lazy import lazy_import
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from math import sqrt
+
+import json
+
+import numpy as np
+
+gmsh = lazy_import('gmsh')
+
+ANGLE_BINS = np.linspace(0, 180, 19)
+ASPECT_RATIO_BINS = np.array([ 1, 1.25, 1.5, 2, 3, 5, 10, 100, np.inf ])
+SIZE_RATIO_BINS = np.array([ 0, 1e-3, 0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, np.inf ])
+
+## Histogram bins and which end is worse, per metric
+METRICS = {
+    3: {
+        'aspect_ratio'      : (ASPECT_RATIO_BINS, 'max'),
+        'min_dihedral_angle': (ANGLE_BINS, 'min'),
+        'max_dihedral_angle': (ANGLE_BINS, 'max'),
+        'volume_edge_ratio' : (SIZE_RATIO_BINS, 'min'),
+    },
+    2: {
+        'aspect_ratio'      : (ASPECT_RATIO_BINS, 'max'),
+        'min_angle'         : (ANGLE_BINS, 'min'),
+        'max_angle'         : (ANGLE_BINS, 'max'),
+        'area_edge_ratio'   : (SIZE_RATIO_BINS, 'min'),
+    },
+}
+
+## NOTE: Metrics work on component-major corner coordinates, shape (3, corners, K):
+##       all arithmetic then runs on contiguous arrays of length K, which is
+##       several times faster than on (K, corners, 3) arrays. Chunks are
+##       processed in blocks, small enough for the temporaries to stay in cache.
+BLOCK_SIZE = 16384
+
+def _cross(a, b):
+    return np.stack([ a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0] ])
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def tetrahedra_quality(p):
+    """
+    Quality metrics of tetrahedra, given as (3,4,K) corner coordinates
+    """
+    e01, e02, e03 = p[:, 1] - p[:, 0], p[:, 2] - p[:, 0], p[:, 3] - p[:, 0]
+    e12, e13, e23 = p[:, 2] - p[:, 1], p[:, 3] - p[:, 1], p[:, 3] - p[:, 2]
+    lengths2 = np.stack([ _dot(e, e) for e in (e01, e02, e03, e12, e13, e23) ])
+
+    ## Normals of the faces opposite each vertex, outward for positively oriented tetrahedra
+    ## (their norms are twice the face areas)
+    normals = [ _cross(e12, e13), _cross(e03, e02), _cross(e01, e03), _cross(e02, e01) ]
+    norms = [ np.sqrt(_dot(n, n)) for n in normals ]
+
+    volume = -_dot(e01, normals[1]) / 6
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        units = [ n / a for n, a in zip(normals, norms) ]
+
+        ## Dihedral angle at the edge shared by faces i and j: arccos(-n_i . n_j)
+        ## arccos is monotonic, so only the extreme cosines need it
+        cosines = np.stack([ -_dot(units[i], units[j]) for i in range(4) for j in range(i + 1, 4) ])
+
+        inradius = 6 * np.abs(volume) / (norms[0] + norms[1] + norms[2] + norms[3])
+        aspect_ratio = np.sqrt(lengths2.max(axis=0)) / (2 * sqrt(6) * inradius)
+        volume_edge_ratio = 6 * sqrt(2) * volume / lengths2.mean(axis=0)**1.5
+
+    return {
+        'aspect_ratio': aspect_ratio,
+        'min_dihedral_angle': np.degrees(np.arccos(np.clip(cosines.max(axis=0), -1.0, 1.0))),
+        'max_dihedral_angle': np.degrees(np.arccos(np.clip(cosines.min(axis=0), -1.0, 1.0))),
+        'volume_edge_ratio': volume_edge_ratio,
+    }
+
+def triangles_quality(p):
+    """
+    Quality metrics of triangles, given as (3,3,K) corner coordinates
+    """
+    e01, e02, e12 = p[:, 1] - p[:, 0], p[:, 2] - p[:, 0], p[:, 2] - p[:, 1]
+    l01, l02, l12 = _dot(e01, e01), _dot(e02, e02), _dot(e12, e12)
+    lengths2 = np.stack([ l01, l02, l12 ])
+
+    normal = _cross(e01, e02)
+    area = np.sqrt(_dot(normal, normal)) / 2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ## Cosines of the angles at vertices 0, 1 and 2
+        cosines = np.stack([
+            _dot(e01, e02) / np.sqrt(l01 * l02),
+            -_dot(e01, e12) / np.sqrt(l01 * l12),
+            _dot(e02, e12) / np.sqrt(l02 * l12),
+        ])
+
+        inradius = 2 * area / (np.sqrt(l01) + np.sqrt(l02) + np.sqrt(l12))
+        aspect_ratio = np.sqrt(lengths2.max(axis=0)) / (2 * sqrt(3) * inradius)
+        area_edge_ratio = 4 * area / (sqrt(3) * lengths2.mean(axis=0))
+
+    return {
+        'aspect_ratio': aspect_ratio,
+        'min_angle': np.degrees(np.arccos(np.clip(cosines.max(axis=0), -1.0, 1.0))),
+        'max_angle': np.degrees(np.arccos(np.clip(cosines.min(axis=0), -1.0, 1.0))),
+        'area_edge_ratio': area_edge_ratio,
+    }
+
+def element_quality(dim, coords, nodeTags, degenerate_tol):
+    """
+    Metrics, centroids and validity of a chunk of elements. Runs on worker threads.
+
+    @input: dimension, (3, maxNodeTag + 1) node coordinates, (K, corners) node tags, tolerance
+    """
+    quality = tetrahedra_quality if dim == 3 else triangles_quality
+
+    metrics = { key: np.empty(len(nodeTags)) for key in METRICS[dim] }
+    centroids = np.empty((len(nodeTags), 3))
+
+    for start in range(0, len(nodeTags), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        corners = nodeTags[block].T
+        p = np.stack([ coords[k][corners] for k in range(3) ])
+        for key, values in quality(p).items():
+            metrics[key][block] = values
+        centroids[block] = p.mean(axis=1).T
+
+    size_ratio = metrics['volume_edge_ratio' if dim == 3 else 'area_edge_ratio']
+
+    degenerate = ~(np.abs(size_ratio) >= degenerate_tol)
+    inverted = ~degenerate & (size_ratio < 0)
+
+    return metrics, centroids, degenerate, inverted
+
+def chunk_quality(name, dim, coords, tags, nodeTags, degenerate_tol, nworst):
+    """
+    Statistics of a chunk of elements, to be merged into the group's. Runs on worker threads.
+    """
+    chunk = GroupQuality(name, dim, nworst)
+    chunk.add(tags, *element_quality(dim, coords, nodeTags, degenerate_tol))
+    return chunk
+
+class GroupQuality:
+    """
+    Streaming statistics of one group of elements
+    """
+
+    def __init__(self, name, dim, nworst=10):
+        self.name = name
+        self.dim = dim
+        self.nworst = nworst
+
+        self.elements = 0
+        self.degenerate = 0
+        self.inverted = 0
+
+        self.histograms = { key: np.zeros(len(bins) - 1, dtype=np.int64) for key, (bins, _) in METRICS[dim].items() }
+        self.sums = dict.fromkeys(METRICS[dim], 0.0)
+        self.minima = dict.fromkeys(METRICS[dim], np.inf)
+        self.maxima = dict.fromkeys(METRICS[dim], -np.inf)
+
+        ## Worst elements per metric: (badness, tags, centroids, values)
+        self.worst = { key: (np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros(0)) for key in METRICS[dim] }
+
+    def add(self, tags, metrics, centroids, degenerate, inverted):
+        self.elements += len(tags)
+        self.degenerate += int(degenerate.sum())
+        self.inverted += int(inverted.sum())
+
+        valid = ~(degenerate | inverted)
+
+        for key, (bins, worse) in METRICS[self.dim].items():
+            values = metrics[key]
+            good = values[valid]
+
+            self.histograms[key] += np.histogram(good, bins=bins)[0]
+            if len(good):
+                self.sums[key] += good.sum()
+                self.minima[key] = min(self.minima[key], good.min())
+                self.maxima[key] = max(self.maxima[key], good.max())
+
+            ## Invalid elements are always the worst, then by metric value
+            badness = np.where(valid, values if worse == 'max' else -values, np.inf)
+            badness = np.nan_to_num(badness, nan=np.inf)
+            if len(badness) > self.nworst:
+                candidates = np.argpartition(badness, -self.nworst)[-self.nworst:]
+            else:
+                candidates = np.arange(len(badness))
+
+            self.keep_worst(key, badness[candidates], tags[candidates], centroids[candidates], values[candidates])
+
+    def keep_worst(self, key, *candidates):
+        merged = tuple(np.concatenate([ old, new ]) for old, new in zip(self.worst[key], candidates))
+        keep = np.argsort(-merged[0], kind='stable')[:self.nworst]
+        self.worst[key] = tuple(m[keep] for m in merged)
+
+    def merge(self, other):
+        """
+        Add the statistics of another GroupQuality (e.g. of a chunk)
+        """
+        self.elements += other.elements
+        self.degenerate += other.degenerate
+        self.inverted += other.inverted
+
+        for key in METRICS[self.dim]:
+            self.histograms[key] += other.histograms[key]
+            self.sums[key] += other.sums[key]
+            self.minima[key] = min(self.minima[key], other.minima[key])
+            self.maxima[key] = max(self.maxima[key], other.maxima[key])
+            self.keep_worst(key, *other.worst[key])
+
+    def report(self):
+        valid = self.elements - self.degenerate - self.inverted
+        metrics = {}
+        for key, (bins, worse) in METRICS[self.dim].items():
+            _, tags, centroids, values = self.worst[key]
+            metrics[key] = {
+                'worse': worse,
+                'min': float(self.minima[key]) if valid else None,
+                'max': float(self.maxima[key]) if valid else None,
+                'mean': self.sums[key] / valid if valid else None,
+                'bins': bins.tolist(),
+                'histogram': self.histograms[key].tolist(),
+                'worst': [ { 'element': int(t), 'x': float(c[0]), 'y': float(c[1]), 'z': float(c[2]), 'value': float(v) } for t, c, v in zip(tags, centroids, values) ],
+            }
+
+        return {
+            'dim': self.dim,
+            'elements': self.elements,
+            'degenerate': self.degenerate,
+            'inverted': self.inverted,
+            'metrics': metrics,
+        }
+
+class MeshQuality:
+
+    def __init__(self, groups, nworst=10, degenerate_tol=1e-4, chunksize=1000000, nthreads=1, logger=Logger(level=1)):
+        """
+        @input:
+            - groups: { name: (dim, [entity tags]) } of the current gmsh model. dim is 2 or 3.
+            - nworst: number of worst elements reported per metric
+            - degenerate_tol: elements with a smaller size ratio are degenerate
+            - chunksize: number of elements processed at once
+            - nthreads: threads computing chunk statistics while the next chunks are fetched from gmsh
+        """
+        self.logger = logger
+        self.groups = groups
+        self.nworst = nworst
+        self.degenerate_tol = degenerate_tol
+        self.chunksize = chunksize
+        self.nthreads = max(1, nthreads)
+
+        self.results = {}
+
+    @staticmethod
+    def physical_groups():
+        """
+        Groups for all 2D and 3D physical groups of the current model, named after them
+        """
+        groups = {}
+        for dim, tag in gmsh.model.getPhysicalGroups():
+            if dim not in METRICS:
+                continue
+            name = gmsh.model.getPhysicalName(dim, tag) or str(tag)
+            groups[f"{name} ({'volume' if dim == 3 else 'surface'} {tag})"] = (dim, list(gmsh.model.getEntitiesForPhysicalGroup(dim, tag)))
+        return groups
+
+    @staticmethod
+    def column_groups(columns):
+        """
+        Groups for the surfaces and volumes of Column objects: { section name: column }
+        """
+        groups = {}
+        for section, column in columns.items():
+            prefix = f"{section}/" if len(columns) > 1 else ''
+            for name, tags in column.volumes.items():
+                groups[f"{prefix}{name} (volume)"] = (3, list(tags))
+            for name, tags in column.surfaces.items():
+                groups[f"{prefix}{name} (surface)"] = (2, list(tags))
+        return groups
+
+    def run(self):
+        coords = np.ascontiguousarray(node_coordinates().T)
+
+        with ThreadPoolExecutor(self.nthreads) as pool:
+            for name, (dim, entities) in self.groups.items():
+                group = GroupQuality(name, dim, self.nworst)
+                pending = deque()
+
+                for tags, nodeTags in iter_elements(dim, entities, self.chunksize, self.logger):
+                    pending.append(pool.submit(chunk_quality, name, dim, coords, tags, nodeTags, self.degenerate_tol, self.nworst))
+                    if len(pending) > self.nthreads:
+                        group.merge(pending.popleft().result())
+
+                while pending:
+                    group.merge(pending.popleft().result())
+
+                self.results[name] = group
+
+        return self
+
+    def report(self):
+        return {
+            'degenerate_tol': self.degenerate_tol,
+            'groups': { name: group.report() for name, group in self.results.items() },
+        }
+
+    def print(self):
+        from rich.table import Table
+
+        table = Table(title="Mesh quality")
+        for column in [ 'group', 'elements', 'degenerate', 'inverted', 'aspect ratio (mean/max)', 'angle (min/max)', 'size ratio (min/mean)' ]:
+            table.add_column(column, justify='right')
+
+        for name, group in self.results.items():
+            report = group.report()
+            metrics = list(report['metrics'].values())
+            aspect, min_angle, max_angle, size = metrics
+            fmt = lambda v: '-' if v is None else f"{v:.3g}"
+            table.add_row(
+                name,
+                f"{report['elements']:,}",
+                f"{report['degenerate']:,}",
+                f"{report['inverted']:,}" if group.dim == 3 else '-',
+                f"{fmt(aspect['mean'])} / {fmt(aspect['max'])}",
+                f"{fmt(min_angle['min'])} / {fmt(max_angle['max'])}",
+                f"{fmt(size['min'])} / {fmt(size['mean'])}",
+                style='bold red' if report['degenerate'] or report['inverted'] else None,
+            )
+
+        Logger.console.print(table)
+
+        for name, group in self.results.items():
+            key = 'volume_edge_ratio' if group.dim == 3 else 'area_edge_ratio'
+            worst = group.report()['metrics'][key]['worst'][:3]
+            if worst and (group.degenerate or group.inverted):
+                locations = ', '.join(f"{w['element']} at ({w['x']:.4g}, {w['y']:.4g}, {w['z']:.4g})" for w in worst)
+                self.logger.warn(f"{name}: worst elements {locations}")
+
+    def write(self, fname):
+        with open(fname, 'w') as fp:
+            json.dump(self.report(), fp, indent=4)
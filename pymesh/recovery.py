@@ -0,0 +1,269 @@
+"""
+BooleanRecovery class
+
+contract:
+    - must detect failed column builds: OCC errors, mismatched periodic surfaces, missing volumes
+    - must find the offending beads by bisection, building only subsets of the bed
+    - must only modify the offending beads, with configurable remedies: shrink, nudge, drop
+    - must checkpoint the remedies, so that a restarted run doesn't bisect again
+
+Beads are bisected along z, so that subsets stay spatially compact and most
+OCC failures, which are local, stay within one half. If both halves of a
+failing set build fine, the failure needs beads from both sides: the beads
+around the split plane are bisected instead.
+
+Only failures that can be caused by the beads are recovered from: OCC errors
+(the plain Exceptions raised by gmsh), mismatched periodic surfaces
+(AssertionError) and missing volumes. Anything else, e.g. config errors from
+logger.die(), is raised as is. Before bisecting, the column is built with the
+single bead closest to the container center: if that fails too, the failure
+doesn't depend on the beads and is raised instead.
+
+Remedies are tried in the configured order for every offending bead. After
+each remedy, only the neighborhood of the offending beads is rebuilt, until
+it builds fine. Then the whole column is rebuilt, and bisection starts again
+if it still fails.
+"""
+
+from pymesh.packedBed import PackedBed
+from pymesh.container import Container
+from pymesh.log import Logger
+from pymesh.spatial import CellGrid
+from pymesh.lazy import lazy_import
+
+from pathlib import Path
+
+import hashlib
+import json
+
+import numpy as np
+
+gmsh = lazy_import('gmsh')
+
+MAX_ROUNDS = 10
+
+class BooleanRecovery:
+
+    def __init__(self, config, logger=Logger(level=1)):
+        self.logger = logger
+        self.config = config
+
+        self.remedies      = config.recovery_remedies
+        self.shrink_factor = config.recovery_shrink_factor
+        self.nudge_factor  = config.recovery_nudge_factor
+
+        self.checkpoint = Path(Path(config.output_filename).stem + '.recovery.json')
+
+        self.beads = np.zeros((0, 4))
+        self.original_index = np.zeros(0, dtype=np.int64)
+        self.dropped = np.zeros(0, dtype=bool)
+        self.levels = np.zeros(0, dtype=np.int64)
+        self.records = []
+        self.builds = 0
+        self.error = None
+
+    def preprocess(self, model, packing, original_index=None):
+        """
+        Read and preprocess the packing once, fitted to the container like model.build() would.
+        Keeps the positions of the beads in the packing file in self.original_index.
+        """
+        packedBed = PackedBed(self.config, generate=False, packing=packing, original_index=original_index)
+        packedBed.fit_to_container(Container(model.container_shape, model.container_size, generate=False))
+        self.original_index = packedBed.original_index
+        return packedBed.to_array()
+
+    def attempt(self, model, indices):
+        """
+        Build the column from a subset of beads in a fresh gmsh model
+        @output: True if the build succeeded
+        """
+        name = gmsh.model.getCurrent()
+        gmsh.model.remove()
+        gmsh.model.add(name)
+
+        self.builds += 1
+        try:
+            subset = np.sort(indices)
+            model.build(self.config, self.beads[subset], fit=False, original_index=self.original_index[subset])
+        except AssertionError as e:
+            self.error = e
+        except Exception as e:
+            ## gmsh raises plain Exceptions. Anything else doesn't depend on the beads.
+            if type(e) is not Exception:
+                raise
+            self.error = e
+        else:
+            if model.column.volumes.get('interstitial'):
+                return True
+            self.error = RuntimeError("No interstitial volume after fragmenting")
+
+        self.logger.warn(f"Column build with {len(indices)} beads failed: {type(self.error).__name__}: {self.error}")
+        return False
+
+    def baseline(self, model, active):
+        """
+        Raise the last build error if the column doesn't build with only the bead closest to the container center either
+        """
+        error = self.error
+        size = np.asarray(model.container_size[:6], dtype=np.float64)
+        center = size[:3] + size[3:6] / 2
+        single = active[[ np.argmin(np.linalg.norm(self.beads[active, :3] - center, axis=1)) ]]
+
+        if not self.attempt(model, single):
+            self.logger.err("The column build fails with a single bead too: the failure doesn't depend on the beads")
+            raise error
+
+    def bisect(self, model, indices):
+        """
+        Find the beads that make the build fail, from a failing set of bead indices (sorted by z)
+        """
+        if len(indices) == 1:
+            return list(indices)
+
+        half = len(indices) // 2
+        lower, upper = indices[:half], indices[half:]
+
+        offenders = []
+        if not self.attempt(model, lower):
+            offenders += self.bisect(model, lower)
+        if not self.attempt(model, upper):
+            offenders += self.bisect(model, upper)
+
+        if offenders:
+            return offenders
+
+        ## Both halves build fine: the failure needs beads from both sides of the split
+        zsplit = (self.beads[lower[-1], 2] + self.beads[upper[0], 2]) / 2
+        rmax = self.beads[indices, 3].max()
+        band = indices[np.abs(self.beads[indices, 2] - zsplit) < 2 * rmax]
+
+        if len(band) < len(indices) and not self.attempt(model, band):
+            return self.bisect(model, band)
+
+        self.logger.warn(f"Could not isolate the failure further than {len(band)} beads around z = {zsplit}")
+        return list(band)
+
+    def neighbors(self, offenders):
+        """
+        Pairs of (offending bead, other active bead) whose surfaces are closer than the largest bead diameter
+        """
+        active = np.flatnonzero(~self.dropped)
+        rmax = self.beads[active, 3].max()
+        grid = CellGrid(self.beads[active, :3], 4 * rmax)
+        iq, jg, _, dist = grid.query(self.beads[offenders, :3], 4 * rmax)
+
+        offenders = np.asarray(offenders)[iq]
+        others = active[jg]
+        gap = dist - self.beads[offenders, 3] - self.beads[others, 3]
+        close = (offenders != others) & (gap < 2 * rmax)
+
+        return offenders[close], others[close], gap[close]
+
+    def neighborhood(self, offenders):
+        """
+        Offending beads and the active beads within reach of them
+        """
+        _, others, _ = self.neighbors(offenders)
+        return np.unique(np.concatenate([ offenders, others ]))
+
+    def remedy(self, offenders):
+        """
+        Apply the next remedy to each offending bead
+        """
+        iq, jg, gap = self.neighbors(offenders)
+
+        for i in offenders:
+            remedy = self.remedies[min(self.levels[i], len(self.remedies) - 1)]
+            self.levels[i] += 1
+            before = self.beads[i].tolist()
+
+            if remedy == 'shrink':
+                self.beads[i, 3] *= 1 - self.shrink_factor
+            elif remedy == 'nudge':
+                ## Away from the closest other bead
+                direction = np.array([ 0.0, 0.0, 1.0 ])
+                mine = np.flatnonzero(iq == i)
+                if len(mine):
+                    delta = self.beads[i, :3] - self.beads[jg[mine[np.argmin(gap[mine])]], :3]
+                    if np.linalg.norm(delta) > 0:
+                        direction = delta / np.linalg.norm(delta)
+                self.beads[i, :3] += self.nudge_factor * self.beads[i, 3] * direction
+            elif remedy == 'drop':
+                self.dropped[i] = True
+
+            self.records.append({ 'index': int(i), 'remedy': remedy, 'before': before, 'after': self.beads[i].tolist() })
+            self.logger.note(f"Bead {i} at ({before[0]:.6g}, {before[1]:.6g}, {before[2]:.6g}), r = {before[3]:.6g}: {remedy}")
+
+    def packing_hash(self, beads):
+        return hashlib.sha1(np.ascontiguousarray(beads).tobytes()).hexdigest()
+
+    def load_checkpoint(self, original):
+        """
+        Reapply the remedies of a previous run on the same packing
+        """
+        if not self.checkpoint.exists():
+            return
+
+        data = json.loads(self.checkpoint.read_text())
+        if data.get('packing') != self.packing_hash(original):
+            self.logger.warn(f"Ignoring {self.checkpoint}: it was written for a different packing")
+            return
+
+        for record in data['records']:
+            i = record['index']
+            self.beads[i] = record['after']
+            self.dropped[i] |= record['remedy'] == 'drop'
+            self.levels[i] += 1
+            self.records.append(record)
+
+        self.logger.note(f"Reapplied {len(self.records)} remedies from {self.checkpoint}")
+
+    def write_checkpoint(self, original, status):
+        data = {
+            'packing': self.packing_hash(original),
+            'status': status,
+            'builds': self.builds,
+            'modified': len(set(r['index'] for r in self.records)),
+            'dropped': np.flatnonzero(self.dropped).tolist(),
+            'records': self.records,
+        }
+        self.checkpoint.write_text(json.dumps(data, indent=4))
+
+    def build(self, model, packing=None, original_index=None):
+        """
+        Build the model's columns, recovering from failures by modifying offending beads
+        """
+        original = self.preprocess(model, packing, original_index)
+
+        self.beads = original.copy()
+        self.dropped = np.zeros(len(original), dtype=bool)
+        self.levels = np.zeros(len(original), dtype=np.int64)
+
+        self.load_checkpoint(original)
+
+        for _ in range(MAX_ROUNDS):
+            active = np.flatnonzero(~self.dropped)
+            active = active[np.argsort(self.beads[active, 2], kind='stable')]
+
+            if self.attempt(model, active):
+                self.write_checkpoint(original, 'complete')
+                if self.records:
+                    self.logger.note(f"Recovered after {self.builds} builds: {len(set(r['index'] for r in self.records))} beads modified, {self.dropped.sum()} dropped. See {self.checkpoint}")
+                return
+
+            self.baseline(model, active)
+
+            with self.logger.stage('Bisecting offending beads'):
+                offenders = self.bisect(model, active)
+
+            ## Remedy until the neighborhood of the offenders builds
+            for _ in range(len(self.remedies)):
+                self.remedy(offenders)
+                self.write_checkpoint(original, 'incomplete')
+                offenders = [ i for i in offenders if not self.dropped[i] ]
+                region = self.neighborhood(offenders) if offenders else []
+                if len(region) == 0 or self.attempt(model, region):
+                    break
+
+        self.write_checkpoint(original, 'failed')
+        self.logger.die(f"Column build still failing after {MAX_ROUNDS} recovery rounds. See {self.checkpoint}")
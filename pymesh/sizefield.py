@@ -0,0 +1,227 @@
+"""
+GapSizeField class
+
+contract:
+    - must refine the mesh only near narrow bead-bead and bead-wall gaps, and coarsen gradually away from them
+    - must find the gaps with a spatial neighbor search, never all pairs
+    - must stay compact: the number of gmsh fields must not grow with the number of beads or gaps
+    - must predict the element count without meshing, and compare it with the size_in/size_out threshold fields
+
+Every bead pair and bead-wall pair whose surfaces are closer than
+elements_across * size_out (or overlap by less than that) is a gap. It is
+represented by the point midway between the surfaces, on the line of centers
+(or along the wall normal), with a target size of |gap| / elements_across,
+but at least size_min. Away from the point, the size grows by grading per unit
+distance, up to size_out.
+
+Target sizes are rounded down to a geometric series of size classes (ratio
+CLASS_RATIO, from size_min to size_out). Each class is one Distance field over
+its points and one Threshold field, and all classes are combined with a single
+Min background field: ~10 fields in total, regardless of the bed size.
+
+NOTE: Around a contact, the gap widens quadratically, while the size grows
+    linearly. The mesh is coarser than the target by at most a factor of ~2
+    around the narrowest point, which elements_across should account for.
+NOTE: Bead interiors are meshed with size_out, like the interstitial volume.
+    Use the field size method for differently sized bead interiors.
+"""
+
+from pymesh.log import Logger
+from pymesh.spatial import bead_pairs, CellGrid
+from pymesh.estimate import TETRAHEDRA_PER_VOLUME
+from pymesh.lazy import lazy_import
+
+from math import pi
+
+import json
+
+import numpy as np
+
+gmsh = lazy_import('gmsh')
+
+CLASS_RATIO = 2.0
+
+class GapSizeField:
+
+    def __init__(self, config, beads, container, logger=Logger(level=1)):
+        """
+        @input:
+            - config: loaded ConfigHandler
+            - beads: (N,4) array of x, y, z, r, as in PackedBed.to_array(), including stacked copies
+            - container: Container (generate=False is enough)
+        """
+        self.logger = logger
+
+        self.size_out         = config.mesh_field_threshold_size_out
+        self.size_min         = config.mesh_field_gap_size_min
+        self.elements_across  = config.mesh_field_gap_elements_across
+        self.grading          = config.mesh_field_gap_grading
+
+        self.beads = np.asarray(beads, dtype=np.float64).reshape(-1, 4)
+        self.container = container
+
+        self.points, self.gaps, self.kinds = self.find_gaps()
+        self.sizes = np.clip(np.abs(self.gaps) / self.elements_across, self.size_min, self.size_out)
+
+        ## Size classes: sizes rounded down to size_min * CLASS_RATIO^k
+        nclasses = max(int(np.ceil(np.log(self.size_out / self.size_min) / np.log(CLASS_RATIO))), 1)
+        self.class_sizes = self.size_min * CLASS_RATIO ** np.arange(nclasses)
+        self.classes = np.clip(np.floor(np.log(self.sizes / self.size_min) / np.log(CLASS_RATIO) + 1e-9).astype(np.int64), 0, nclasses - 1)
+
+    def find_gaps(self):
+        """
+        Gap points and widths of all bead pairs and bead-wall pairs narrow enough to need refinement
+        @output: points (K,3), signed gap widths (K,), kinds (K,): 0 for bead pairs, 1 for walls
+        """
+        reach = self.elements_across * self.size_out
+        r = self.beads[:, 3]
+
+        i, j, gap, normals = bead_pairs(self.beads, reach)
+        narrow = gap > -reach
+        i, j, gap, normals = i[narrow], j[narrow], gap[narrow], normals[narrow]
+        pair_points = self.beads[i, :3] + (r[i] + gap / 2)[:, None] * normals
+
+        wall_points = np.zeros((0, 3))
+        wall_gaps = np.zeros(0)
+        if self.container.shape:
+            _, distances, wall_normals = self.container.wall_distances(self.beads[:, :3])
+            wall_gap = distances - r[:, None]
+            bead, wall = np.nonzero(np.abs(wall_gap) < reach)
+            wall_gaps = wall_gap[bead, wall]
+            wall_points = self.beads[bead, :3] + (r[bead] + wall_gaps / 2)[:, None] * wall_normals[bead, wall]
+
+        points = np.concatenate([ pair_points, wall_points ])
+        gaps = np.concatenate([ gap, wall_gaps ])
+        kinds = np.concatenate([ np.zeros(len(gap), dtype=np.int64), np.ones(len(wall_gaps), dtype=np.int64) ])
+
+        return points, gaps, kinds
+
+    def apply(self):
+        """
+        Create the gap points, one Distance and Threshold field per size class, and the Min background field
+        """
+        factory = gmsh.model.occ
+        field = gmsh.model.mesh.field
+
+        ptags = np.array([ factory.addPoint(*p) for p in self.points.tolist() ], dtype=np.int64)
+        factory.synchronize()
+
+        ttags = []
+        for k, size in enumerate(self.class_sizes):
+            members = ptags[self.classes == k]
+            if not len(members):
+                continue
+
+            dtag = field.add('Distance')
+            field.setNumbers(dtag, 'PointsList', members.tolist())
+
+            ttag = field.add('Threshold')
+            ttags.append(ttag)
+            field.setNumber(ttag, "InField", dtag)
+            field.setNumber(ttag, "SizeMin", size)
+            field.setNumber(ttag, "SizeMax", self.size_out)
+            field.setNumber(ttag, "DistMin", 0.0)
+            field.setNumber(ttag, "DistMax", (self.size_out - size) / self.grading)
+
+        ## size_out everywhere else, also if there are no gaps at all
+        ctag = field.add('Constant')
+        field.setNumber(ctag, 'VIn', self.size_out)
+        field.setNumber(ctag, 'VOut', self.size_out)
+        ttags.append(ctag)
+
+        bftag = field.add('Min')
+        field.setNumbers(bftag, "FieldsList", ttags)
+        field.setAsBackgroundMesh(bftag)
+
+        gmsh.option.setNumber("Mesh.MeshSizeExtendFromBoundary", 0)
+        gmsh.option.setNumber("Mesh.MeshSizeFromPoints", 0)
+        gmsh.option.setNumber("Mesh.MeshSizeFromCurvature", 0)
+
+        self.logger.out(f"Gap size field: {len(self.points)} gap points in {len(ttags) - 1} size classes")
+
+    def size_at(self, points):
+        """
+        Mesh size of the field at the given points, as gmsh evaluates it (class sizes, linear grading)
+        """
+        sizes = np.full(len(points), self.size_out)
+        if not len(self.points):
+            return sizes
+
+        ## Only gap points within reach can be finer than size_out
+        reach = (self.size_out - self.size_min) / self.grading
+        grid = CellGrid(self.points, reach)
+        iq, jg, _, dist = grid.query(points, reach)
+        np.minimum.at(sizes, iq, self.class_sizes[self.classes[jg]] + self.grading * dist)
+        return sizes
+
+    def sample_container(self, nsamples, seed=0):
+        """
+        Uniformly distributed points in the container
+        """
+        rng = np.random.default_rng(seed)
+        c = self.container
+        c.update_bounds()
+        if c.shape == 'cylinder':
+            rho = c.r * np.sqrt(rng.random(nsamples))
+            phi = 2 * pi * rng.random(nsamples)
+            return np.stack([ c.x + rho * np.cos(phi), c.y + rho * np.sin(phi), c.zmin + c.zdelta * rng.random(nsamples) ], axis=1)
+        lo = np.array([ c.xmin, c.ymin, c.zmin ])
+        hi = np.array([ c.xmax, c.ymax, c.zmax ])
+        return lo + (hi - lo) * rng.random((nsamples, 3))
+
+    def estimate(self, reference=None, nsamples=200000):
+        """
+        Predicted tetrahedra of the gap field (Monte Carlo integral of 1/h^3 over
+        the container), against uniform meshes and the size_in/size_out fields.
+
+        @input: reference: tetrahedra predicted by MeshEstimate for the threshold fields
+        """
+        self.container.update_bounds()
+        volume = self.container.volume
+
+        samples = self.sample_container(nsamples)
+        density = np.mean(self.size_at(samples)**-3.0)
+
+        finest = self.class_sizes[self.classes].min() if len(self.points) else self.size_out
+        counts = {
+            'gap_field': TETRAHEDRA_PER_VOLUME * volume * density,
+            'uniform_size_out': TETRAHEDRA_PER_VOLUME * volume / self.size_out**3,
+            'uniform_finest_gap_size': TETRAHEDRA_PER_VOLUME * volume / finest**3,
+        }
+        if reference is not None:
+            counts['threshold_fields'] = reference
+
+        self.report_data = {
+            'gap_points': len(self.points),
+            'bead_pairs': int(np.sum(self.kinds == 0)),
+            'bead_walls': int(np.sum(self.kinds == 1)),
+            'size_min': self.size_min,
+            'size_out': self.size_out,
+            'finest_size': float(finest),
+            'elements_across': self.elements_across,
+            'grading': self.grading,
+            'class_sizes': self.class_sizes.tolist(),
+            'class_counts': np.bincount(self.classes, minlength=len(self.class_sizes)).tolist(),
+            'samples': nsamples,
+            'tetrahedra': { key: int(value) for key, value in counts.items() },
+            'reduction': { key: 1 - counts['gap_field'] / value for key, value in counts.items() if key != 'gap_field' },
+        }
+        return self.report_data
+
+    def print(self):
+        from rich.table import Table
+
+        data = self.report_data
+        table = Table(title=f"Gap size field: {data['gap_points']} gaps ({data['bead_pairs']} bead pairs, {data['bead_walls']} bead-wall), sizes {data['finest_size']:.3g} to {data['size_out']:.3g}")
+        table.add_column('size setup', justify='left')
+        table.add_column('tetrahedra', justify='right')
+        table.add_column('gap field reduction', justify='right')
+        for key, value in data['tetrahedra'].items():
+            reduction = data['reduction'].get(key)
+            table.add_row(key, f"{value:,}", f"{reduction:.1%}" if reduction is not None else '')
+
+        Logger.console.print(table)
+
+    def write(self, fname):
+        with open(fname, 'w') as fp:
+            json.dump(self.report_data, fp, indent=4)
@@ -0,0 +1,416 @@
+"""
+Spatial search helpers for beads
+
+contract:
+    - must find neighboring points/beads without O(N^2) pair loops
+    - must support periodic boxes
+    - must order points along space-filling curves, vectorized
+    - numpy only (no gmsh), so that analysis tools stay light
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import itertools
+
+import numpy as np
+
+OFFSETS = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+## (0, 0, 0) and one of every pair of opposite offsets
+HALF_OFFSETS = OFFSETS[13:]
+
+## Query points per block: memory scales with the block size, not 27 * N
+BLOCK_SIZE = 1 << 13
+
+## Beads larger than this quantile of the radii are searched on a separate, coarser grid
+LARGE_QUANTILE = 0.99
+
+class CellGrid:
+    """
+    Uniform grid of cubic cells over a set of points.
+
+    Any two points closer than cell_size are in the same or in adjacent cells,
+    so neighbor queries only need to check the 27 surrounding cells.
+    """
+
+    def __init__(self, points, cell_size, box=None, periodic=(False, False, False)):
+        """
+        @input:
+            - points: (N,3) array
+            - cell_size: minimum edge length of a cell. Queries with cutoff <= cell_size are exact.
+            - box: (lo, hi) bounds of the domain. Defaults to the bounds of the points. Required for periodic directions.
+            - periodic: periodicity in x, y, z. Points are wrapped into the box in periodic directions.
+        """
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.periodic = np.array(periodic, dtype=bool)
+
+        if box is None:
+            if self.periodic.any():
+                raise ValueError("CellGrid: box is required for periodic grids")
+            lo = self.points.min(axis=0) if len(self.points) else np.zeros(3)
+            hi = self.points.max(axis=0) if len(self.points) else np.zeros(3)
+        else:
+            lo, hi = np.asarray(box[0], dtype=np.float64), np.asarray(box[1], dtype=np.float64)
+
+        self.lo = lo
+        self.length = hi - lo
+
+        ## In periodic directions, the cells must tile the box exactly
+        ncells = np.floor(self.length / cell_size).astype(np.int64)
+        self.ncells = np.where(self.periodic, np.maximum(ncells, 1), ncells + 1)
+        self.cell_size = np.where(self.periodic, self.length / self.ncells, cell_size)
+
+        if self.periodic.any():
+            self.points = self.wrap(self.points)
+
+        ## Points are stored sorted by cell, so that neighbor lookups access memory mostly sequentially
+        keys = self.keys(self.cells(self.points))
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_points = self.points[self.order]
+        occupied, starts, counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+        ## Direct lookup tables if the grid isn't too sparse, binary search otherwise
+        self.dense = np.prod(self.ncells) <= 8 * len(self.points) + 1024
+        if self.dense:
+            self.starts = np.zeros(np.prod(self.ncells), dtype=np.int64)
+            self.counts = np.zeros(np.prod(self.ncells), dtype=np.int64)
+            self.starts[occupied] = starts
+            self.counts[occupied] = counts
+        else:
+            self.occupied, self.starts, self.counts = occupied, starts, counts
+
+    def wrap(self, points):
+        """ Wrap points into the box in periodic directions """
+        wrapped = points.copy()
+        for d in np.flatnonzero(self.periodic):
+            wrapped[:, d] = self.lo[d] + np.mod(points[:, d] - self.lo[d], self.length[d])
+        return wrapped
+
+    def cells(self, points):
+        cells = np.floor((points - self.lo) / self.cell_size).astype(np.int64)
+        ## Points on the upper boundary of a periodic box
+        return np.where(self.periodic, np.minimum(cells, self.ncells - 1), cells)
+
+    def keys(self, cells):
+        return cells[:, 0] + self.ncells[0] * (cells[:, 1] + self.ncells[1] * cells[:, 2])
+
+    def minimum_image(self, dvec):
+        for d in np.flatnonzero(self.periodic):
+            dvec[:, d] -= self.length[d] * np.round(dvec[:, d] / self.length[d])
+        return dvec
+
+    def query(self, points, cutoff=None, nthreads=1, radii=None):
+        """
+        Find all pairs (query point, grid point) closer than cutoff.
+
+        With radii = (radii of the query points, radii of the grid points),
+        find the pairs of spheres whose surfaces are closer than cutoff instead.
+        Pairs are filtered block by block, so that only close pairs are ever stored.
+
+        Query points are sorted by cell and processed in blocks of BLOCK_SIZE
+        points, i.e. blocks of cells, on nthreads threads. The output doesn't
+        depend on nthreads.
+
+        @output:
+            - iq: indices into the query points
+            - jg: indices into the grid points
+            - dvec: (grid point - query point), minimum image in periodic directions
+            - dist: norm of dvec
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if self.periodic.any():
+            points = self.wrap(points)
+
+        cells = self.cells(points)
+        qorder = np.argsort(self.keys(cells), kind='stable')
+        points = points[qorder]
+        cells = cells[qorder]
+
+        if radii is not None:
+            radii = (np.asarray(radii[0], dtype=np.float64)[qorder], np.asarray(radii[1], dtype=np.float64)[self.order])
+        cutoff = self.check_cutoff(cutoff, radii)
+
+        iq, jg = self.neighbors(points, cells, OFFSETS, cutoff, radii=radii, nthreads=nthreads)
+
+        ## Boxes with less than 3 cells in a periodic direction visit some cells twice
+        if np.any(self.periodic & (self.ncells < 3)):
+            _, unique = np.unique(iq * len(self.points) + jg, return_index=True)
+            iq, jg = iq[unique], jg[unique]
+
+        dvec = self.minimum_image(self.sorted_points[jg] - points[iq])
+        dist = np.sqrt(np.einsum('ij,ij->i', dvec, dvec))
+
+        return qorder[iq], self.order[jg], dvec, dist
+
+    def pairs(self, cutoff=None, nthreads=1, radii=None):
+        """
+        Find all unique pairs (i < j) of grid points closer than cutoff, or
+        of spheres with the given radii whose surfaces are closer than cutoff.
+        See query() for the output.
+
+        Only half of the neighbor cells are visited: every pair is found once,
+        from the cell of its first point.
+        """
+        if radii is not None:
+            radii = np.asarray(radii, dtype=np.float64)[self.order]
+            radii = (radii, radii)
+        cutoff = self.check_cutoff(cutoff, radii)
+
+        points = self.sorted_points
+        si, sj = self.neighbors(points, self.cells(points), HALF_OFFSETS, cutoff, upper=True, radii=radii, nthreads=nthreads)
+
+        if np.any(self.periodic & (self.ncells < 3)):
+            lo, hi = np.minimum(si, sj), np.maximum(si, sj)
+            _, unique = np.unique(lo * len(points) + hi, return_index=True)
+            unique = unique[si[unique] != sj[unique]]
+            si, sj = si[unique], sj[unique]
+
+        i, j = self.order[si], self.order[sj]
+        dvec = self.minimum_image(np.take(points, sj, axis=0) - np.take(points, si, axis=0))
+        swap = i > j
+        i, j = np.where(swap, j, i), np.where(swap, i, j)
+        dvec[swap] *= -1
+        dist = np.sqrt(np.einsum('ij,ij->i', dvec, dvec))
+
+        return i, j, dvec, dist
+
+    def check_cutoff(self, cutoff, radii=None):
+        if radii is None:
+            cutoff = self.cell_size.min() if cutoff is None else cutoff
+            reach = cutoff
+        else:
+            cutoff = 0.0 if cutoff is None else cutoff
+            reach = cutoff + sum(r.max() if len(r) else 0.0 for r in radii)
+        ## Periodic directions with a single cell visit all points
+        limit = np.where(self.periodic & (self.ncells == 1), np.inf, self.cell_size).min()
+        if reach > limit * (1 + 1e-12):
+            raise ValueError(f"CellGrid: cutoff ({reach}) larger than cell size ({limit})")
+        return cutoff
+
+    def neighbors(self, points, cells, offsets, cutoff, upper=False, radii=None, nthreads=1):
+        """
+        Pairs of query points and grid points closer than cutoff, in cells at the given offsets.
+
+        @input:
+            - points, cells: query points sorted by cell, and their cells
+            - upper: the query points are the sorted grid points: only keep jg > iq within a cell
+            - radii: None, or (radii of points, radii of the sorted grid points)
+        @output: iq: indices into points, jg: indices into the sorted grid points
+        """
+        blocks = [ slice(start, start + BLOCK_SIZE) for start in range(0, len(points), BLOCK_SIZE) ]
+        block_neighbors = lambda block: self.block_neighbors(points, cells, block, offsets, cutoff, upper, radii)
+
+        if nthreads > 1 and len(blocks) > 1:
+            with ThreadPoolExecutor(nthreads) as pool:
+                results = list(pool.map(block_neighbors, blocks))
+        else:
+            results = [ block_neighbors(block) for block in blocks ]
+
+        if not results:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        iq, jg = zip(*results)
+        return np.concatenate(iq), np.concatenate(jg)
+
+    def block_neighbors(self, points, cells, block, offsets, cutoff, upper, radii):
+        start = block.start
+        points, cells = points[block], cells[block]
+        if radii is not None:
+            qradii, gradii = radii[0][block], radii[1]
+        iqs, jgs = [], []
+
+        for offset in offsets:
+            ncells = cells + offset
+            ncells = np.where(self.periodic, np.mod(ncells, self.ncells), ncells)
+            valid = np.all((ncells >= 0) & (ncells < self.ncells), axis=1)
+
+            qidx = np.flatnonzero(valid)
+            keys = self.keys(ncells[qidx])
+
+            if self.dense:
+                counts = self.counts[keys]
+                starts = self.starts[keys]
+            elif len(self.occupied):
+                pos = np.minimum(np.searchsorted(self.occupied, keys), len(self.occupied) - 1)
+                found = self.occupied[pos] == keys
+                counts = np.where(found, self.counts[pos], 0)
+                starts = self.starts[pos]
+            else:
+                continue
+
+            iq = np.repeat(qidx, counts)
+            within = np.arange(len(iq)) - np.repeat(np.cumsum(counts) - counts, counts)
+            jg = np.repeat(starts, counts) + within
+
+            ## np.take is much faster than fancy indexing for rows
+            dvec = self.minimum_image(np.take(self.sorted_points, jg, axis=0) - np.take(points, iq, axis=0))
+            if radii is None:
+                close = np.einsum('ij,ij->i', dvec, dvec) < cutoff**2
+            else:
+                close = np.einsum('ij,ij->i', dvec, dvec) < (cutoff + qradii[iq] + gradii[jg])**2
+            if upper and not offset.any():
+                close &= jg > iq + start
+
+            iqs.append(iq[close] + start)
+            jgs.append(jg[close])
+
+        if not iqs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(iqs), np.concatenate(jgs)
+
+def contact_pairs(centers, radii, gap=0.0, box=None, periodic=(False, False, False), nthreads=1, subset=None):
+    """
+    Find all pairs (i < j) of spheres whose surfaces are closer than gap.
+    With subset (boolean mask), only the pairs with at least one sphere in subset.
+
+    Pairs of beads up to the LARGE_QUANTILE radius are found on a grid sized
+    for them. The few larger beads are queried on a second grid, sized for the
+    largest bead, so that the tail of a wide radius distribution doesn't
+    inflate the number of candidate pairs of all the others.
+
+    @output: i, j, dvec (center j - center i, minimum image in periodic directions), dist
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64)
+    if len(centers) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros(0)
+
+    split = np.quantile(radii, LARGE_QUANTILE)
+    large = radii > split
+    small = np.flatnonzero(~large)
+
+    grid = CellGrid(centers[small], 2 * split + gap, box=box, periodic=periodic)
+    if subset is None:
+        i, j, dvec, dist = grid.pairs(gap, nthreads=nthreads, radii=radii[small])
+        i, j = small[i], small[j]
+    else:
+        queries = small[subset[small]]
+        i, j, dvec, dist = grid.query(centers[queries], gap, nthreads=nthreads, radii=(radii[queries], radii[small]))
+        i, j = queries[i], small[j]
+
+        ## Pairs of two beads of the subset are found from both sides
+        keep = (i != j) & (~subset[j] | (i < j))
+        i, j, dvec, dist = i[keep], j[keep], dvec[keep], dist[keep]
+
+        swap = i > j
+        dvec[swap] *= -1
+        i, j = np.where(swap, j, i), np.where(swap, i, j)
+
+    if large.any():
+        queries = np.flatnonzero(large)
+        grid = CellGrid(centers, 2 * radii.max() + gap, box=box, periodic=periodic)
+        iq, jg, dq, distq = grid.query(centers[queries], gap, nthreads=nthreads, radii=(radii[queries], radii))
+        iq = queries[iq]
+
+        ## Pairs of two large beads are found from both sides
+        keep = ~large[jg] | (iq < jg)
+        if subset is not None:
+            keep &= subset[iq] | subset[jg]
+        iq, jg, dq, distq = iq[keep], jg[keep], dq[keep], distq[keep]
+
+        swap = iq > jg
+        dq[swap] *= -1
+        i = np.concatenate([i, np.where(swap, jg, iq)])
+        j = np.concatenate([j, np.where(swap, iq, jg)])
+        dvec = np.concatenate([dvec, dq])
+        dist = np.concatenate([dist, distq])
+
+    return i, j, dvec, dist
+
+def bead_pairs(beads, gap=0.0, periodic=(False, False, False), box=None):
+    """
+    Find all pairs of beads whose surfaces are closer than gap (overlapping
+    beads have negative surface distance).
+
+    @input: beads as an (N,4) array of x, y, z, r
+    @output: i, j, surface distances, center-to-center unit vectors
+    """
+    beads = np.asarray(beads, dtype=np.float64).reshape(-1, 4)
+    if len(beads) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 3))
+
+    i, j, dvec, dist = contact_pairs(beads[:, :3], beads[:, 3], gap, box=box, periodic=periodic)
+
+    surface_distance = dist - beads[i, 3] - beads[j, 3]
+    mask = surface_distance < gap
+    i, j, dvec, dist, surface_distance = i[mask], j[mask], dvec[mask], dist[mask], surface_distance[mask]
+
+    normals = dvec / np.maximum(dist, np.finfo(np.float64).tiny)[:, None]
+
+    return i, j, surface_distance, normals
+
+def quantize(points, bits):
+    """
+    Integer coordinates in [0, 2^bits) of points in their bounding box
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if not len(points):
+        return np.zeros((0, 3), dtype=np.uint64)
+    lo = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - lo, np.finfo(np.float64).tiny)
+    ## One common scale, so that cells stay cubic
+    scale = ((1 << bits) - 1) / extent.max()
+    return np.floor((points - lo) * scale).astype(np.uint64)
+
+def spread_bits(v):
+    """
+    Insert two zero bits between each of the lower 21 bits of v
+    """
+    v = v & np.uint64(0x1fffff)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v << np.uint64(8)))  & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v << np.uint64(4)))  & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v << np.uint64(2)))  & np.uint64(0x1249249249249249)
+    return v
+
+def interleave(x, y, z):
+    return (spread_bits(x) << np.uint64(2)) | (spread_bits(y) << np.uint64(1)) | spread_bits(z)
+
+def morton_keys(points, bits=21):
+    """
+    Position of every point along a Morton (Z-order) curve through their bounding box
+    """
+    q = quantize(points, bits)
+    return interleave(q[:, 0], q[:, 1], q[:, 2])
+
+def hilbert_keys(points, bits=21):
+    """
+    Position of every point along a Hilbert curve through their bounding box.
+
+    Skilling's transform (AIP Conf. Proc. 707, 381 (2004)) of the coordinates
+    to the "transposed" Hilbert index, whose bits are then interleaved like a
+    Morton key. Vectorized over the points, looping over bits only.
+    """
+    x = [ q.copy() for q in quantize(points, bits).T ]
+    if not len(x[0]):
+        return np.zeros(0, dtype=np.uint64)
+
+    ## Inverse undo excess work
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = np.uint64(q - 1)
+        for i in range(3):
+            high = (x[i] & np.uint64(q)) != 0
+            t = (x[0] ^ x[i]) & p
+            x[0] = np.where(high, x[0] ^ p, x[0] ^ t)
+            if i:
+                x[i] = np.where(high, x[i], x[i] ^ t)
+        q >>= 1
+
+    ## Gray encode
+    x[1] ^= x[0]
+    x[2] ^= x[1]
+    t = np.zeros_like(x[0])
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((x[2] & np.uint64(q)) != 0, t ^ np.uint64(q - 1), t)
+        q >>= 1
+    x = [ xi ^ t for xi in x ]
+
+    return interleave(x[0], x[1], x[2])
+
+def curve_order(points, curve='hilbert'):
+    """
+    Permutation that sorts points along a space-filling curve ('morton' or 'hilbert')
+    """
+    keys = { 'morton': morton_keys, 'hilbert': hilbert_keys }[curve](points)
+    return np.argsort(keys, kind='stable')
@@ -2,10 +2,12 @@ import struct
 import itertools
 from functools import reduce
 
-import gmsh
 import numpy as np
 
-from pymesh.log import Logger
+from pymesh.log import Logger, Progress
+from pymesh.lazy import lazy_import
+
+gmsh = lazy_import('gmsh')
 
 def bin_to_arr(filename, format):
     """
@@ -237,53 +239,56 @@ def add_nodes_multi(m, nodeTagsOffset:int, offsets:list, boundaries=False, auto_
     num_nodes = max([ max(v[1][0]) for k,v in m.items() if len( v[1][0] ) != 0 ])
     entities =  list(m.keys())
 
-    logger.out(f"Adding nodes (multi) for {num_objects} objects.")
-
     num_points = len([(x,y) for x,y in entities if x == 0])
     num_lines = len([(x,y) for x,y in entities if x == 1])
     num_surfaces = len([(x,y) for x,y in entities if x == 2])
     num_volumes = len([(x,y) for x,y in entities if x == 3])
 
     tagss = []
+    progress = Progress('entities copied (nodes)', num_objects * len(m), logger=logger)
 
-    for index, (xoff,yoff,zoff,scale) in enumerate(offsets): 
-
-        tags = []
-
-        if auto_tag: 
-            tags = [ -1 ] * num_objects
-        else: 
-            tags.extend(list(range(tag_offsets[0] + (index)*num_points  +1   , tag_offsets[0] + (index+1)*num_points  +1)))
-            tags.extend(list(range(tag_offsets[1] + (index)*num_lines   +1   , tag_offsets[1] + (index+1)*num_lines   +1) ))
-            tags.extend(list(range(tag_offsets[2] + (index)*num_surfaces+1   , tag_offsets[2] + (index+1)*num_surfaces+1)))
-            tags.extend(list(range(tag_offsets[3] + (index)*num_volumes +1   , tag_offsets[3] + (index+1)*num_volumes +1) ))
-
-        tagss.append(tags)
-
-        for e,tag in zip(sorted(m), tags):
-            coords = np.array(m[e][1][1])
+    with logger.stage("Adding nodes (multi)") as record:
+        record['objects'] = num_objects
+        for index, (xoff,yoff,zoff,scale) in enumerate(offsets): 
 
-            coords[0::3] *= scale
-            coords[1::3] *= scale
-            coords[2::3] *= scale
+            tags = []
 
-            coords[0::3] += xoff
-            coords[1::3] += yoff
-            coords[2::3] += zoff
-
-            # Because beads are copied, relying on boundaries is not easy
-            # since boundaries do not get automatically moved, and we get wrongly
-            # matched volume boundaries
-            if boundaries: 
-                boundaries_tags = [b[1] for b in m[e][0]] 
+            if auto_tag: 
+                tags = [ -1 ] * num_objects
             else: 
-                boundaries_tags = []
-
-            _tag = gmsh.model.addDiscreteEntity(e[0], tag, boundaries_tags)
-            gmsh.model.mesh.addNodes(e[0], _tag, 
-                    [ nodeTagsOffset + num_nodes * index + t for t in m[e][1][0] ], 
-                    coords.tolist()
-                    )
+                tags.extend(list(range(tag_offsets[0] + (index)*num_points  +1   , tag_offsets[0] + (index+1)*num_points  +1)))
+                tags.extend(list(range(tag_offsets[1] + (index)*num_lines   +1   , tag_offsets[1] + (index+1)*num_lines   +1) ))
+                tags.extend(list(range(tag_offsets[2] + (index)*num_surfaces+1   , tag_offsets[2] + (index+1)*num_surfaces+1)))
+                tags.extend(list(range(tag_offsets[3] + (index)*num_volumes +1   , tag_offsets[3] + (index+1)*num_volumes +1) ))
+
+            tagss.append(tags)
+
+            for e,tag in zip(sorted(m), tags):
+                coords = np.array(m[e][1][1])
+
+                coords[0::3] *= scale
+                coords[1::3] *= scale
+                coords[2::3] *= scale
+
+                coords[0::3] += xoff
+                coords[1::3] += yoff
+                coords[2::3] += zoff
+
+                # Because beads are copied, relying on boundaries is not easy
+                # since boundaries do not get automatically moved, and we get wrongly
+                # matched volume boundaries
+                if boundaries: 
+                    boundaries_tags = [b[1] for b in m[e][0]] 
+                else: 
+                    boundaries_tags = []
+
+                _tag = gmsh.model.addDiscreteEntity(e[0], tag, boundaries_tags)
+                gmsh.model.mesh.addNodes(e[0], _tag, 
+                        [ nodeTagsOffset + num_nodes * index + t for t in m[e][1][0] ], 
+                        coords.tolist()
+                        )
+                progress.update()
+        progress.close()
     ntoff = nodeTagsOffset + num_nodes * num_objects
 
     logger.out("Done adding nodes")
@@ -304,14 +309,18 @@ def add_elements_multi(m, nodeTagsOffset:int, elemTagsOffset:int, tagss:list):
     num_objects = len(tagss)
 
     logger = Logger()
-    logger.out(f"Adding elements (multi) for {num_objects} objects.")
-
-    for index,tags in enumerate(tagss): 
-        for e, tag in zip(sorted(m), tags):
-            gmsh.model.mesh.addElementsCustom(e[0], tag, 
-                    m[e][2][0], 
-                    [ elemTagsOffset + num_elements * index + t for t in m[e][2][1]] , 
-                    [ nodeTagsOffset + num_nodes * index + t for t in m[e][2][2] ] )
+    progress = Progress('entities copied (elements)', num_objects * len(m), logger=logger)
+
+    with logger.stage("Adding elements (multi)") as record:
+        record['objects'] = num_objects
+        for index,tags in enumerate(tagss): 
+            for e, tag in zip(sorted(m), tags):
+                gmsh.model.mesh.addElementsCustom(e[0], tag, 
+                        m[e][2][0], 
+                        [ elemTagsOffset + num_elements * index + t for t in m[e][2][1]] , 
+                        [ nodeTagsOffset + num_nodes * index + t for t in m[e][2][2] ] )
+                progress.update()
+        progress.close()
 
     etoff = elemTagsOffset + num_elements * num_objects
     logger.out(f"Done adding elements")
@@ -336,3 +345,75 @@ def store_mesh(maxDim=-1):
     etoff = max([ max(v[2][1][elemtypeindex]) for k,v in m.items() for elemtypeindex,_ in enumerate(v[2][0]) if  len(v[2][1][elemtypeindex]) != 0 ])
 
     return m, int(ntoff), int(etoff)
+
+def physical_group_nodes(dim, tag):
+    """
+    Node coordinates of a physical group as an (maxNodeTag + 1, 3) lookup
+    table indexed by node tag. Rows of nodes outside the group are NaN.
+    """
+    nodeTags, coords = gmsh.model.mesh.getNodesForPhysicalGroup(dim, tag)
+    nodeTags = np.asarray(nodeTags, dtype=np.int64)
+    xyz = np.full((nodeTags.max() + 1 if len(nodeTags) else 0, 3), np.nan)
+    xyz[nodeTags] = np.reshape(coords, (-1, 3))
+    return xyz
+
+def node_coordinates():
+    """
+    Coordinates of all nodes of the model as an (maxNodeTag + 1, 3) lookup
+    table indexed by node tag. Rows of unused tags are NaN.
+    """
+    nodeTags, coords, _ = gmsh.model.mesh.getNodes(returnParametricCoord=False)
+    nodeTags = np.asarray(nodeTags, dtype=np.int64)
+    xyz = np.full((nodeTags.max() + 1 if len(nodeTags) else 0, 3), np.nan)
+    xyz[nodeTags] = np.reshape(coords, (-1, 3))
+    return xyz
+
+ELEMENT_FAMILIES = { 2: ('Triangle', 'Mesh.NbTriangles'), 3: ('Tetrahedron', 'Mesh.NbTetrahedra') }
+
+def _extent(bbox, dim):
+    """ Volume (dim 3) or surface measure (dim 2) of a bounding box, used to split work """
+    xmin, ymin, zmin, xmax, ymax, zmax = bbox
+    dx, dy, dz = xmax - xmin, ymax - ymin, zmax - zmin
+    return dx * dy * dz if dim == 3 else dx * dy + dy * dz + dx * dz
+
+def iter_elements(dim, entities, chunksize=1000000, logger=Logger(level=1)):
+    """
+    Iterate over the triangles (dim 2) or tetrahedra (dim 3) of a list of
+    entities in chunks, so that memory stays bounded for large meshes.
+    Higher order elements are reduced to their corner nodes.
+
+    gmsh doesn't tell the number of elements of an entity without fetching
+    them, so the chunks per entity are estimated from its share of the
+    model's bounding box. Chunks are about chunksize elements for the
+    interstitial volume or the walls, and single chunks for particles.
+
+    @output: yields (element tags, (K,3|4) corner node tags) per chunk
+    """
+    family, statistic = ELEMENT_FAMILIES[dim]
+    total = gmsh.option.getNumber(statistic)
+    model_extent = max(_extent(gmsh.model.getBoundingBox(-1, -1), dim), np.finfo(np.float64).tiny)
+
+    for entity in entities:
+        share = _extent(gmsh.model.getBoundingBox(dim, entity), dim) / model_extent
+        numTasks = max(1, int(np.ceil(total * min(share, 1.0) / chunksize)))
+
+        for elementType in gmsh.model.mesh.getElementTypes(dim, entity):
+            name, _, _, numNodes, _, numPrimaryNodes = gmsh.model.mesh.getElementProperties(elementType)
+            if not name.startswith(family):
+                logger.warn(f"Skipping {name} elements in entity ({dim}, {entity}): only {family.lower()} elements are supported")
+                continue
+
+            for task in range(numTasks):
+                elementTags, nodeTags = gmsh.model.mesh.getElementsByType(elementType, entity, task, numTasks)
+                if len(elementTags):
+                    yield np.asarray(elementTags), np.reshape(nodeTags, (-1, numNodes))[:, :numPrimaryNodes].astype(np.int64)
+
+def tetrahedra_volumes(xyz):
+    """
+    Signed volumes of tetrahedra given as (K,4,3) corner coordinates.
+    Negative for inverted elements.
+    """
+    a = xyz[:, 1] - xyz[:, 0]
+    b = xyz[:, 2] - xyz[:, 0]
+    c = xyz[:, 3] - xyz[:, 0]
+    return np.einsum('ij,ij->i', a, np.cross(b, c)) / 6
@@ -0,0 +1,143 @@
+"""
+Watchdog class
+
+contract:
+    - must report that long stages are still running, with their latest progress, while they run
+    - must end the run when a stage exceeds its time limit, instead of letting it stall for hours
+    - must leave a diagnostic dump of the state of the run when it ends it
+
+A background thread looks at the running Logger stages every POLL_INTERVAL
+seconds. Every Logger.progress_interval seconds, it logs how long the
+innermost stage has been running, with the latest progress (of a pymesh loop,
+or gmsh's last info message and percentage, see GmshLogCapture).
+
+Time limits (seconds) are given per stage name, or fnmatch pattern of stage
+names (general.time_limits), e.g. { 'Meshing': 3600, 'Creating * section': 7200 }.
+When a running stage exceeds its limit, the watchdog writes <output stem>.watchdog.json
+with:
+
+    - the running stages and their elapsed times, and the exceeded limit
+    - the latest progress
+    - the completed stages, as in .perf.json
+    - the Python stack of every thread: the main thread's shows the gmsh call it's stuck in
+
+and the performance report, then ends the process with exit code
+EXIT_TIME_LIMIT. OCC and gmsh calls can't be interrupted from Python, so
+the process is ended with os._exit(): output files being written are
+incomplete.
+"""
+
+from pymesh.log import Logger, peak_rss_mb
+
+from fnmatch import fnmatch
+from pathlib import Path
+
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+## Seconds between checks of the running stages
+POLL_INTERVAL = 1.0
+
+## Exit code of runs ended by a time limit, as timeout(1)
+EXIT_TIME_LIMIT = 124
+
+class Watchdog:
+
+    def __init__(self, limits, fname, timestamp=False, logger=Logger(level=1)):
+        """
+        @input:
+            - limits: { stage name or pattern: seconds }
+            - fname, timestamp: output filename, and timestamp option of the logs, as in Logger.write()
+        """
+        self.logger = logger
+        self.limits = limits or {}
+        self.dump_file = Path(fname).stem + '.watchdog.json'
+        self.perf_file = fname + (Logger.timestamp if timestamp else '') + '.perf.json'
+        self.stopped = threading.Event()
+        self.thread = None
+        self.reported = time.perf_counter()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True, name='watchdog')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(POLL_INTERVAL):
+            now = time.perf_counter() - Logger.start_time
+            stages = list(Logger.active)
+
+            for record in stages:
+                elapsed = now - record['start']
+                for pattern, limit in self.limits.items():
+                    if fnmatch(record['stage'], pattern) and elapsed > limit:
+                        self.expire(record, pattern, limit, stages, now)
+
+            if stages and Logger.progress_interval and time.perf_counter() - self.reported >= Logger.progress_interval:
+                self.reported = time.perf_counter()
+                self.heartbeat(stages[-1], now)
+
+    def heartbeat(self, record, now):
+        progress = Logger.last_progress
+
+        ## Loops report their own progress, unless they are stuck in an item
+        if progress.get('stage') == record['stage'] and progress['what'] != 'gmsh' and now - progress['time'] < Logger.progress_interval:
+            return
+
+        message = f"Still running: {record['stage']} ({now - record['start']:.0f} s)"
+        if progress.get('stage') == record['stage']:
+            if progress['what'] == 'gmsh':
+                percent = f"[{progress['percent']}%] " if progress['percent'] is not None else ''
+                message += f", gmsh: {percent}{progress['message']}"
+            else:
+                total = f"/{progress['total']:,}" if progress['total'] else ''
+                message += f", {progress['what']}: {progress['count']:,}{total}"
+            message += f" ({now - progress['time']:.0f} s ago)"
+
+        self.logger.out(message)
+
+    def dump(self, record, pattern, limit, stages, now):
+        """
+        State of the run when the limit was exceeded
+        """
+        names = { thread.ident: thread.name for thread in threading.enumerate() }
+        threads = { names.get(ident, str(ident)): traceback.format_stack(frame) for ident, frame in sys._current_frames().items() }
+
+        return {
+            'reason': f"Stage '{record['stage']}' exceeded its time limit ('{pattern}': {limit} s)",
+            'stage': record['stage'],
+            'limit': limit,
+            'elapsed': now - record['start'],
+            'total_wall_time': now,
+            'running_stages': [ { 'stage': r['stage'], 'elapsed': now - r['start'] } for r in stages ],
+            'last_progress': Logger.last_progress,
+            'peak_rss_mb': peak_rss_mb(),
+            'completed_stages': sorted(Logger.perf_all, key=lambda r: r['start']),
+            'threads': threads,
+        }
+
+    def expire(self, record, pattern, limit, stages, now):
+        """
+        Write the diagnostic dump and the performance report, and end the process
+        """
+        self.logger.err(f"Stage '{record['stage']}' exceeded its time limit of {limit} s. Ending the run. See {self.dump_file}")
+
+        with open(self.dump_file, 'w') as fp:
+            json.dump(self.dump(record, pattern, limit, stages, now), fp, indent=4, default=str)
+
+        Logger.perf_all.extend(dict(r, failed=True, wall_time=now - r['start']) for r in stages)
+        self.logger.write_perf(self.perf_file)
+        Logger.close()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(EXIT_TIME_LIMIT)
@@ -50,7 +50,8 @@ REQUIRED = [
 # What packages are optional?
 EXTRAS = {
         'Colored logging': ['rich'],
-        'GMSH': ['gmsh']
+        'GMSH': ['gmsh'],
+        'HDF5 output': ['h5py']
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -129,7 +130,7 @@ setup(
     packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*"]),
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['pymesh'],
-    scripts=['bin/mesh', 'bin/mesh-volume', 'bin/pack-info'],
+    scripts=['bin/mesh', 'bin/mesh-volume', 'bin/mesh-quality', 'bin/pack-info', 'bin/pack-gen', 'bin/mesh-sweep'],
 
     # entry_points={
     #     'console_scripts': ['mycli=mymodule:cli'],